@@ -12,12 +12,18 @@ Options:
      --headers=LIST      Comma separated list of dicom header names to print.
      --oneseries         Only show one series (useful for just exam info)
      --showheaders       Just list all of the headers for each archive
+     --workers N         The number of archives to read at once. Defaults to
+                         the number of CPUs (at most 8).
+     --cache FILE        An archive cache (sqlite) file to read headers from
+                         and store them in, so that unchanged archives
+                         aren't read again. Not used with --showheaders.
 """
 
 from docopt import docopt
 import pandas as pd
 
 import datman
+import datman.archive_cache
 import datman.utils
 
 default_headers = [
@@ -30,11 +36,21 @@ default_headers = [
 
 def main():
     arguments = docopt(__doc__)
+    workers = (arguments['--workers'] and
+               datman.utils.get_positive_int(arguments, '--workers'))
+    cache = None
+    # Cached headers leave out large values, so list headers from the dicoms
+    if arguments['--cache'] and not arguments['--showheaders']:
+        cache = datman.archive_cache.ArchiveCache(arguments['--cache'])
+    manifests = datman.utils.get_headers_for_archives(arguments['<archive>'],
+                                                      workers=workers,
+                                                      cache=cache)
+    if cache:
+        cache.close()
 
     if arguments['--showheaders']:
         for archive in arguments['<archive>']:
-            manifest = datman.utils.get_archive_headers(archive,
-                                                        stop_after_first=False)
+            manifest = get_manifest(manifests, archive)
             filepath, headers = list(manifest.items())[0]
             print(",".join([archive, filepath]))
             print("\t" + "\n\t".join(headers.dir()))
@@ -46,7 +62,7 @@ def main():
 
     rows = []
     for archive in arguments["<archive>"]:
-        manifest = datman.utils.get_archive_headers(archive)
+        manifest = get_manifest(manifests, archive)
         sortedseries = sorted(manifest.items(),
                               key=lambda x: x[1].get('SeriesNumber'))
         for path, dataset in sortedseries:
@@ -60,5 +76,12 @@ def main():
     print(data.to_csv(index=False))
 
 
+def get_manifest(manifests, archive):
+    manifest = manifests[archive]
+    if isinstance(manifest, Exception):
+        raise manifest
+    return manifest
+
+
 if __name__ == "__main__":
     main()
@@ -79,6 +79,7 @@ import sys
 from docopt import docopt
 import pandas as pd
 
+import datman.archive_cache
 import datman.config
 import datman.scanid
 import datman.utils
@@ -87,6 +88,9 @@ logger = logging.getLogger(os.path.basename(__file__))
 
 already_linked = {}
 lookup = None
+# Dicom headers read ahead of time, by archive path
+archive_headers = {}
+ARCHIVE_CACHE = None
 DRYRUN = None
 
 
@@ -95,6 +99,7 @@ def main():
     global already_linked
     global lookup
     global DRYRUN
+    global ARCHIVE_CACHE
 
     arguments = docopt(__doc__)
     verbose = arguments["--verbose"]
@@ -129,6 +134,7 @@ def main():
 
     # setup the config object
     cfg = datman.config.config(study=study)
+    ARCHIVE_CACHE = datman.archive_cache.get_cache(cfg)
     if not lookup_path:
         lookup_path = os.path.join(cfg.get_path("meta"), "scans.csv")
 
@@ -171,6 +177,15 @@ def main():
                     if os.path.splitext(archive)[1] == ".zip"]
 
     logger.info("Found {} archives".format(len(archives)))
+
+    # Read the headers of all archives that will need them at once
+    unnamed = [archive for archive in archives
+               if os.path.isfile(archive)
+               and os.path.realpath(archive) not in already_linked
+               and not get_scanid_from_lookup_table(archive)]
+    archive_headers.update(datman.utils.get_headers_for_archives(
+        unnamed, stop_after_first=True, cache=ARCHIVE_CACHE))
+
     for archive in archives:
         link_archive(archive, dicom_path, scanid_field, cfg)
 
@@ -257,9 +272,14 @@ def get_archive_headers(archive_path):
     # get some DICOM headers from the archive
     header = None
     try:
-        header = datman.utils.get_archive_headers(archive_path,
-                                                  stop_after_first=True)
-        header = list(header.values())[0]
+        if archive_path in archive_headers:
+            manifest = archive_headers[archive_path]
+        else:
+            manifest = datman.utils.get_archive_headers(
+                archive_path, stop_after_first=True, cache=ARCHIVE_CACHE)
+        if isinstance(manifest, Exception):
+            raise manifest
+        header = list(manifest.values())[0]
     except Exception:
         logger.warn("Archive: {} contains no DICOMs".format(archive_path))
     return header
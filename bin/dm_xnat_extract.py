@@ -26,6 +26,23 @@ Options:
                              login used should be valid for all servers.
     --dont-update-dashboard  Dont update the dashboard database
     -t --tag tag,...         List of scan tags to download
+    --download-workers N     Number of series to download from XNAT at once.
+                             Series are converted as their downloads finish,
+                             so downloads and conversion overlap. Note that
+                             XnatPoolSize should be at least this large.
+                             [default: 1]
+    -j --jobs N              Number of experiments to process at once. Each
+                             job runs in its own process with its own XNAT
+                             connection. A summary of the experiments that
+                             succeeded and failed is logged at the end.
+                             [default: 1]
+    --request-stats          Log a summary of the requests made to XNAT
+                             (counts, failures, latency percentiles and
+                             transfer rates for each kind of request) when
+                             finished. Like the summary of experiments
+                             processed, it's logged at the info level.
+    --request-log FILE       Append a line of JSON describing each request
+                             made to XNAT to FILE. Implies --request-stats.
 
 OUTPUT FOLDERS
     Each dicom series will be converted and placed into a subfolder of the
@@ -68,14 +85,18 @@ DEPENDENCIES
     dcm2nii
 
 """
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                wait, as_completed, FIRST_COMPLETED)
 from datetime import datetime
 from glob import glob
 import logging
+import multiprocessing
 import os
 import platform
 import shutil
 import sys
 import re
+import tempfile
 import zipfile
 
 from docopt import docopt
@@ -84,6 +105,7 @@ import pydicom as dicom
 import datman.dashboard as dashboard
 import datman.config
 import datman.xnat
+import datman.xnat_stats
 import datman.utils
 import datman.scan
 import datman.scanid
@@ -99,6 +121,10 @@ cfg = None
 DRYRUN = False
 db_ignore = False  # if True dont update the dashboard db
 wanted_tags = None
+DOWNLOAD_WORKERS = 1
+# The largest dicom archive held in memory while it's unpacked, in bytes
+STAGING_MEMORY = 64 * 1024 * 1024
+STATS = None
 
 
 def main():
@@ -108,6 +134,8 @@ def main():
     global DRYRUN
     global wanted_tags
     global db_ignore
+    global DOWNLOAD_WORKERS
+    global STATS
 
     arguments = docopt(__doc__)
     verbose = arguments['--verbose']
@@ -119,6 +147,11 @@ def main():
     username = arguments['--username']
     db_ignore = arguments['--dont-update-dashboard']
     SERVER_OVERRIDE = arguments['--server']
+    request_log = arguments['--request-log']
+
+    DOWNLOAD_WORKERS = datman.utils.get_positive_int(arguments,
+                                                     '--download-workers')
+    jobs = datman.utils.get_positive_int(arguments, '--jobs')
 
     if arguments['--dry-run']:
         DRYRUN = True
@@ -126,20 +159,167 @@ def main():
 
     configure_logging(study, quiet, verbose, debug)
 
+    temp_log = None
+    if arguments['--request-stats'] or request_log:
+        if jobs > 1 and not request_log:
+            # Worker processes need a log to share their requests through
+            temp_log = tempfile.NamedTemporaryFile(
+                prefix='dm_xnat_extract_', suffix='.jsonl', delete=False)
+            temp_log.close()
+            request_log = temp_log.name
+        STATS = datman.xnat_stats.RequestStats(log_file=request_log)
+
     cfg = datman.config.config(study=study)
     if username:
         AUTH = datman.xnat.get_auth(username)
 
     if experiment:
-        experiments = collect_experiment(experiment, study, cfg)
+        experiments = collect_experiment(experiment, study, cfg) or []
     else:
         experiments = collect_all_experiments(cfg)
 
     logger.info("Found {} experiments for study {}".format(
         len(experiments), study))
 
-    for xnat, project, experiment in experiments:
-        process_experiment(xnat, project, experiment)
+    if jobs > 1 and len(experiments) > 1:
+        worker_settings = {
+            'study': study,
+            'log_levels': (quiet, verbose, debug),
+            'auth': AUTH,
+            'server_override': SERVER_OVERRIDE,
+            'dryrun': DRYRUN,
+            'db_ignore': db_ignore,
+            'wanted_tags': wanted_tags,
+            'download_workers': DOWNLOAD_WORKERS,
+            'request_log': request_log if STATS else None
+        }
+        results = process_in_parallel(experiments, jobs, worker_settings)
+    else:
+        results = []
+        for xnat, project, ident, xnat_experiment in experiments:
+            label = ident.get_xnat_experiment_id()
+            try:
+                success = process_experiment(xnat, project, ident,
+                                             xnat_experiment)
+            except Exception as e:
+                logger.error("Unexpected error processing experiment {}. "
+                             "{}: {}".format(label, type(e).__name__, e))
+                success = False
+            results.append((label, success))
+
+    report_results(results)
+
+    if STATS:
+        report_request_stats(STATS, combine=jobs > 1)
+    if temp_log:
+        os.remove(temp_log.name)
+
+
+def process_in_parallel(experiments, jobs, worker_settings):
+    """Process experiments in a pool of worker processes.
+
+    XNAT connections can't be shared between processes, so each worker opens
+    its own connection to the server an experiment was found on.
+
+    Args:
+        experiments (list): A list of (:obj:`datman.xnat.xnat`, str,
+            :obj:`datman.scanid.Identifier`, :obj:`datman.xnat.XNATExperiment`)
+            tuples to process.
+        jobs (int): The number of worker processes to use.
+        worker_settings (dict): The command line settings to initialize each
+            worker with. See init_worker() for the expected keys.
+
+    Returns:
+        list: A list of (experiment name, bool) tuples, with the bool
+            indicating whether the experiment was processed successfully.
+    """
+    results = []
+    # Workers are started fresh rather than forked so that they don't
+    # inherit open sockets (XNAT, dashboard database) from this process
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context,
+                             initializer=init_worker,
+                             initargs=(worker_settings,)) as pool:
+        futures = {}
+        for xnat, project, ident, xnat_experiment in experiments:
+            future = pool.submit(process_experiment_in_worker, xnat.server,
+                                 project, ident, xnat_experiment)
+            futures[future] = ident.get_xnat_experiment_id()
+
+        for future in as_completed(futures):
+            label = futures[future]
+            try:
+                success = future.result()
+            except Exception as e:
+                logger.error("Unexpected error processing experiment {}. "
+                             "{}: {}".format(label, type(e).__name__, e))
+                success = False
+            results.append((label, success))
+    return results
+
+
+def init_worker(settings):
+    """Set up the global state of a worker process to match the parent's."""
+    global AUTH
+    global SERVER_OVERRIDE
+    global cfg
+    global DRYRUN
+    global wanted_tags
+    global db_ignore
+    global DOWNLOAD_WORKERS
+    global STATS
+
+    AUTH = settings['auth']
+    SERVER_OVERRIDE = settings['server_override']
+    DRYRUN = settings['dryrun']
+    db_ignore = settings['db_ignore']
+    wanted_tags = settings['wanted_tags']
+    DOWNLOAD_WORKERS = settings['download_workers']
+    if settings['request_log']:
+        STATS = datman.xnat_stats.RequestStats(
+            log_file=settings['request_log'])
+
+    configure_logging(settings['study'], *settings['log_levels'])
+    cfg = datman.config.config(study=settings['study'])
+
+
+def process_experiment_in_worker(server, project, ident,
+                                 xnat_experiment=None):
+    xnat = datman.xnat.get_connection(cfg,
+                                      site=ident.site,
+                                      url=server,
+                                      auth=AUTH,
+                                      server_cache=SERVERS,
+                                      stats=STATS)
+    return process_experiment(xnat, project, ident, xnat_experiment)
+
+
+def report_request_stats(stats, combine=False):
+    """Log a summary of the XNAT requests made.
+
+    Args:
+        stats (:obj:`datman.xnat_stats.RequestStats`): The requests recorded
+            by this process.
+        combine (bool, optional): Whether to report on every request in the
+            stats log file instead, to include the requests made by worker
+            processes. Defaults to False.
+    """
+    stats.close()
+    records = None
+    if combine and stats.log_file:
+        records = datman.xnat_stats.read_log(stats.log_file)
+    logger.info(stats.report(records))
+
+
+def report_results(results):
+    failed = [label for label, success in results if not success]
+    logger.info("Processed {} experiments. {} succeeded, {} failed.".format(
+        len(results), len(results) - len(failed), len(failed)))
+    for label, success in sorted(results):
+        if success:
+            logger.info("{} - succeeded".format(label))
+        else:
+            logger.error("{} - failed".format(label))
 
 
 def configure_logging(study, quiet=None, verbose=None, debug=None):
@@ -186,7 +366,8 @@ def collect_experiment(user_exper, study, cfg):
                                       site=ident.site,
                                       url=SERVER_OVERRIDE,
                                       auth=AUTH,
-                                      server_cache=SERVERS)
+                                      server_cache=SERVERS,
+                                      stats=STATS)
 
     # get the list of XNAT projects linked to the datman study
     xnat_projects = cfg.get_xnat_projects(study)
@@ -199,22 +380,26 @@ def collect_experiment(user_exper, study, cfg):
                      "existing experiment ID in XNAT.".format(user_exper))
         return
 
-    return [(xnat, xnat_project, ident)]
+    return [(xnat, xnat_project, ident, None)]
 
 
 def collect_all_experiments(config):
     experiments = []
 
-    # for each XNAT project send out URL request for list of experiment IDs
-    # then validate and add (connection, XNAT project, subject ID) to output
+    # for each XNAT project send out one URL request to list its experiments
+    # then validate and add (connection, XNAT project, subject ID,
+    # XNAT experiment) to output
     for project, sites in get_projects(config).items():
         for site in sites:
             xnat = datman.xnat.get_connection(config,
                                               site=site,
                                               url=SERVER_OVERRIDE,
                                               auth=AUTH,
-                                              server_cache=SERVERS)
-            for exper_id in xnat.get_experiment_ids(project):
+                                              server_cache=SERVERS,
+                                              stats=STATS)
+            listing = xnat.get_experiment_listing(project)
+            idents = []
+            for exper_id in [entry["label"] for entry in listing]:
                 try:
                     ident = datman.utils.validate_subject_id(exper_id, config)
                 except datman.scanid.ParseException:
@@ -229,7 +414,23 @@ def collect_all_experiments(config):
                     continue
                 if ident.modality != "MR":
                     continue
-                experiments.append((xnat, project, ident))
+                idents.append(ident)
+
+            # Fetch the metadata for the whole project at once. Anything
+            # that fails here is retried individually in process_experiment
+            try:
+                found = xnat.get_project_experiments(
+                    project,
+                    labels=[i.get_xnat_experiment_id() for i in idents],
+                    listing=listing)
+            except datman.exceptions.XnatException as e:
+                logger.error("Failed getting experiments for project {}. "
+                             "Reason - {}".format(project, e))
+                found = {}
+
+            for ident in idents:
+                xnat_experiment = found.get(ident.get_xnat_experiment_id())
+                experiments.append((xnat, project, ident, xnat_experiment))
 
     return experiments
 
@@ -251,18 +452,34 @@ def get_projects(config):
     return projects
 
 
-def process_experiment(xnat, project, ident):
+def process_experiment(xnat, project, ident, xnat_experiment=None):
+    """Export all resources and scans from an XNAT experiment.
+
+    Args:
+        xnat (:obj:`datman.xnat.xnat`): A connection to the XNAT server.
+        project (:obj:`str`): The XNAT project the experiment belongs to.
+        ident (:obj:`datman.scanid.Identifier`): The experiment's ID.
+        xnat_experiment (:obj:`datman.xnat.XNATExperiment`, optional): The
+            experiment's metadata, if it has already been retrieved. If not
+            given it will be requested from the server.
+
+    Returns:
+        bool: False if the experiment couldn't be retrieved from XNAT,
+            True otherwise.
+    """
     experiment_label = ident.get_xnat_experiment_id()
 
     logger.info("Processing experiment: {}".format(experiment_label))
 
-    try:
-        xnat_experiment = xnat.get_experiment(
-            project, ident.get_xnat_subject_id(), experiment_label)
-    except Exception as e:
-        logger.error("Unable to retrieve experiment {} from XNAT server. "
-                     "{}: {}".format(experiment_label, type(e).__name__, e))
-        return
+    if xnat_experiment is None:
+        try:
+            xnat_experiment = xnat.get_experiment(
+                project, ident.get_xnat_subject_id(), experiment_label)
+        except Exception as e:
+            logger.error("Unable to retrieve experiment {} from XNAT server. "
+                         "{}: {}".format(experiment_label, type(e).__name__,
+                                         e))
+            return False
 
     if not db_ignore:
         logger.debug("Adding session {} to dashboard".format(experiment_label))
@@ -280,6 +497,8 @@ def process_experiment(xnat, project, ident):
     if xnat_experiment.scans:
         process_scans(xnat, ident, xnat_experiment)
 
+    return True
+
 
 def set_date(session, experiment):
     if not experiment.date:
@@ -324,7 +543,15 @@ def process_resources(xnat, ident, xnat_experiment):
             logger.error("Failed creating resources dir {}".format(base_path))
             return
 
-    for label in xnat_experiment.resource_IDs:
+    try:
+        listing = xnat_experiment.get_resource_files(
+            xnat, list(xnat_experiment.resource_IDs.values()))
+    except Exception as e:
+        logger.error("Failed listing resources for experiment {}. "
+                     "Reason - {}".format(xnat_experiment.name, e))
+        return
+
+    for label, xnat_resource_id in xnat_experiment.resource_IDs.items():
         if label == 'No Label':
             target_path = os.path.join(base_path, 'MISC')
         else:
@@ -337,36 +564,24 @@ def process_resources(xnat, ident, xnat_experiment):
                          .format(target_path))
             continue
 
-        xnat_resource_id = xnat_experiment.resource_IDs[label]
-
-        try:
-            resources = xnat.get_resource_list(xnat_experiment.project,
-                                               xnat_experiment.subject,
-                                               xnat_experiment.name,
-                                               xnat_resource_id)
-        except Exception as e:
-            logger.error("Failed getting resource {} for experiment {}. "
-                         "Reason - {}".format(xnat_resource_id,
-                                              xnat_experiment.name,
-                                              e))
-            continue
-
-        if not resources:
-            continue
+        resources = [item for item in listing
+                     if item['resource'] == xnat_resource_id or
+                     (item['resource'] is None and
+                      item['collection'] == label)]
 
         for resource in resources:
-            resource_path = os.path.join(target_path, resource['URI'])
+            resource_path = os.path.join(target_path, resource['path'])
             if os.path.isfile(resource_path):
                 logger.debug("Resource {} from experiment {} already exists"
-                             .format(resource['name'], xnat_experiment.name))
+                             .format(resource['path'], xnat_experiment.name))
 
             else:
                 logger.info("Downloading {} from experiment {}"
-                            .format(resource['name'], xnat_experiment.name))
+                            .format(resource['path'], xnat_experiment.name))
                 download_resource(xnat,
                                   xnat_experiment,
                                   xnat_resource_id,
-                                  resource['URI'],
+                                  resource['path'],
                                   resource_path)
 
 
@@ -436,6 +651,7 @@ def process_scans(xnat, ident, xnat_experiment):
                      .format(cfg.study_name, ident.site))
         return
 
+    exports = []
     for scan in xnat_experiment.scans:
 
         if not scan.raw_dicoms_exist():
@@ -474,12 +690,19 @@ def process_scans(xnat, ident, xnat_experiment):
         if not db_ignore:
             update_dashboard(scan.names)
 
+        scan_exports = []
         for fname, tag in zip(scan.names, scan.tags):
             if wanted_tags and (tag not in wanted_tags):
                 continue
             export_formats = get_export_formats(ident, fname, tags, tag)
             if export_formats:
-                get_scans(xnat, ident, scan, fname, export_formats)
+                scan_exports.append((fname, export_formats))
+
+        if scan_exports:
+            exports.append((scan, scan_exports))
+
+    if exports:
+        get_scans(xnat, ident, exports)
 
 
 def update_dashboard(scan_names):
@@ -536,95 +759,140 @@ def series_is_processed(ident, file_stem, export_formats):
     return remaining_formats
 
 
-def get_scans(xnat, ident, xnat_scan, output_name, export_formats):
-    logger.info("Getting scan from XNAT")
+def get_scans(xnat, ident, exports):
+    """Download series from XNAT and export them to all needed formats.
+
+    Up to DOWNLOAD_WORKERS series are downloaded at once. Each series is
+    exported as soon as its download completes and its files are deleted
+    afterwards, so at most twice that many series are held on disk at any
+    time. A failure for one series is logged and does not affect the others.
+
+    Args:
+        xnat (:obj:`datman.xnat.xnat`): A connection to the XNAT server.
+        ident (:obj:`datman.scanid.Identifier`): A valid datman Identifier to
+            name files after.
+        exports (list): A list of (:obj:`datman.xnat.XNATScan`, list) tuples,
+            where the list holds an (output_name, export_formats) tuple for
+            each file to make from the scan.
+    """
+    logger.info("Getting {} scans from XNAT".format(len(exports)))
+
+    remaining = iter(enumerate(exports))
+    pending = {}
+    with datman.utils.make_temp_directory(prefix='dm_xnat_extract_') as temp, \
+            ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        while True:
+            # Limit the series downloaded ahead of conversion to keep the
+            # space used in the temp dir bounded
+            while len(pending) < 2 * DOWNLOAD_WORKERS:
+                try:
+                    num, (xnat_scan, scan_exports) = next(remaining)
+                except StopIteration:
+                    break
+                scan_dir = os.path.join(temp, str(num))
+                os.mkdir(scan_dir)
+                download = pool.submit(get_dicom_archive_from_xnat,
+                                       xnat, xnat_scan, scan_dir)
+                pending[download] = (xnat_scan, scan_exports, scan_dir)
+
+            if not pending:
+                break
 
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for download in done:
+                xnat_scan, scan_exports, scan_dir = pending.pop(download)
+                try:
+                    src_dir = download.result()
+                except Exception as e:
+                    logger.error("Unexpected error downloading series {} for "
+                                 "experiment {}. {}: {}".format(
+                                     xnat_scan.series, xnat_scan.experiment,
+                                     type(e).__name__, e))
+                    src_dir = None
+
+                if not src_dir:
+                    logger.error("Failed getting series {} for experiment {} "
+                                 "from XNAT".format(xnat_scan.series,
+                                                    xnat_scan.experiment))
+                else:
+                    for output_name, export_formats in scan_exports:
+                        export_scan(ident, xnat_scan, src_dir, output_name,
+                                    export_formats)
+
+                shutil.rmtree(scan_dir, ignore_errors=True)
+
+    logger.info('Completed exports')
+
+
+def export_scan(ident, xnat_scan, src_dir, output_name, export_formats):
+    """Export a downloaded dicom series to each of the given formats."""
     # setup the export functions for each format
     xporters = {'mnc': export_mnc_command,
                 'nii': export_nii_command,
                 'nrrd': export_nrrd_command,
                 'dcm': export_dcm_command}
 
-    # scan hasn't been completely processed, get it from XNAT
-    with datman.utils.make_temp_directory(prefix='dm_xnat_extract_') as temp:
-        src_dir = get_dicom_archive_from_xnat(xnat, xnat_scan, temp)
-
-        if not src_dir:
-            logger.error("Failed getting series {} for experiment {} from XNAT"
-                         .format(xnat_scan.series, xnat_scan.experiment))
+    for export_format in export_formats:
+        target_base_dir = cfg.get_path(export_format)
+        target_dir = os.path.join(
+            target_base_dir,
+            ident.get_full_subjectid_with_timepoint())
+        try:
+            target_dir = datman.utils.define_folder(target_dir)
+        except OSError:
+            logger.error("Failed creating target folder: {}"
+                         .format(target_dir))
             return
 
-        for export_format in export_formats:
-            target_base_dir = cfg.get_path(export_format)
-            target_dir = os.path.join(
-                target_base_dir,
-                ident.get_full_subjectid_with_timepoint())
-            try:
-                target_dir = datman.utils.define_folder(target_dir)
-            except OSError:
-                logger.error("Failed creating target folder: {}"
-                             .format(target_dir))
-                return
-
-            try:
-                exporter = xporters[export_format]
-            except KeyError:
-                logger.error("Export format {} not defined".format(
-                             export_format))
-
-            logger.info('Exporting scan {} to format {}'
-                        ''.format(xnat_scan.names, export_format))
-            try:
-                exporter(src_dir, target_dir, output_name, xnat_scan)
-            except Exception:
-                logger.error("An error happened exporting {} from scan {} "
-                             "in experiment {}".format(
-                                 export_format, xnat_scan.series,
-                                 xnat_scan.experiment))
+        try:
+            exporter = xporters[export_format]
+        except KeyError:
+            logger.error("Export format {} not defined".format(
+                         export_format))
+            continue
 
-    logger.info('Completed exports')
+        logger.info('Exporting scan {} to format {}'
+                    ''.format(xnat_scan.names, export_format))
+        try:
+            exporter(src_dir, target_dir, output_name, xnat_scan)
+        except Exception:
+            logger.error("An error happened exporting {} from scan {} "
+                         "in experiment {}".format(
+                             export_format, xnat_scan.series,
+                             xnat_scan.experiment))
 
 
 def get_dicom_archive_from_xnat(xnat, xnat_scan, tempdir):
     """
     Downloads and extracts a dicom archive from XNAT to a local temp folder
-    Returns the path to the tempdir (for later cleanup) as well as the
-    path to the .dcm files inside the tempdir
+    Returns the path to the folder holding the .dcm files inside the tempdir
+
+    Archives smaller than STAGING_MEMORY are held in memory and unpacked
+    directly from there, larger ones are staged in a temporary file in
+    tempdir.
     """
-    # make a copy of the dicom files in a local directory
     logger.info("Downloading dicoms for: {}, series: {}"
                 .format(xnat_scan.experiment, xnat_scan.series))
     try:
-        dicom_archive = xnat.get_dicom(xnat_scan.project,
-                                       xnat_scan.subject,
-                                       xnat_scan.experiment,
-                                       xnat_scan.series)
+        dicom_archive = xnat.stream_dicom(xnat_scan.project,
+                                          xnat_scan.subject,
+                                          xnat_scan.experiment,
+                                          xnat_scan.series,
+                                          memory_limit=STAGING_MEMORY,
+                                          temp_dir=tempdir)
     except Exception:
-        logger.error("Failed to download dicom archive for: {}, series: {}"
-                     .format(xnat_scan.subject, xnat_scan.series))
+        logger.error("Failed to download dicom archive for: {}, series: "
+                     "{}".format(xnat_scan.subject, xnat_scan.series))
         return None
 
     logger.info("Unpacking archive")
-
-    try:
-        with zipfile.ZipFile(dicom_archive, 'r') as myzip:
-            myzip.extractall(tempdir)
-    except Exception:
-        logger.error("An error occurred unpacking dicom archive for: {}. "
-                     "Skipping".format(xnat_scan.subject))
-        os.remove(dicom_archive)
-        return None
-
-    logger.info("Deleting archive file")
-    os.remove(dicom_archive)
-
-    # get the root dir for the extracted files
-    archive_files = []
-    for root, dirname, filenames in os.walk(tempdir):
-        for filename in filenames:
-            f = os.path.join(root, filename)
-            if is_valid_dicom(f):
-                archive_files.append(f)
+    with dicom_archive:
+        try:
+            archive_files = unpack_dicoms(dicom_archive, tempdir)
+        except Exception:
+            logger.error("An error occurred unpacking dicom archive for: {}. "
+                         "Skipping".format(xnat_scan.subject))
+            return None
 
     try:
         base_dir = os.path.dirname(archive_files[0])
@@ -635,14 +903,32 @@ def get_dicom_archive_from_xnat(xnat, xnat_scan, tempdir):
     return base_dir
 
 
+def unpack_dicoms(archive, dest):
+    """Extract a zip file, returning the paths of the dicoms it held.
+
+    Only the start of each extracted file is read to decide whether it's a
+    dicom.
+
+    Args:
+        archive: The path to a zip file or a seekable file object holding one.
+        dest (:obj:`str`): The folder to extract into.
+
+    Returns:
+        list: The full paths of the extracted dicom files.
+    """
+    dicoms = []
+    with zipfile.ZipFile(archive, 'r') as myzip:
+        for member in myzip.infolist():
+            if member.is_dir():
+                continue
+            path = myzip.extract(member, dest)
+            if is_valid_dicom(path):
+                dicoms.append(path)
+    return dicoms
+
+
 def is_valid_dicom(filename):
-    try:
-        dicom.read_file(filename)
-    except IOError:
-        return
-    except dicom.errors.InvalidDicomError:
-        return
-    return True
+    return datman.utils.has_dicom_preamble(filename)
 
 
 def export_mnc_command(seriesdir, outputdir, stem, scan=None):
@@ -790,7 +1076,8 @@ def export_dcm_command(seriesdir, outputdir, stem, scan=None):
         dcm_dict = {}
         for path in glob(seriesdir + '/*'):
             try:
-                dcm_echo_num = dicom.read_file(path).EchoNumbers
+                dcm_echo_num = datman.utils.read_dicom_header(
+                    path, specific_tags=['EchoNumbers']).EchoNumbers
                 if dcm_echo_num not in dcm_dict.keys():
                     dcm_dict[int(dcm_echo_num)] = path
                 if len(dcm_dict.keys()) == 2:
@@ -800,12 +1087,9 @@ def export_dcm_command(seriesdir, outputdir, stem, scan=None):
 
     else:
         for path in glob(seriesdir + '/*'):
-            try:
-                dicom.read_file(path)
+            if is_valid_dicom(path):
                 dcmfile = path
                 break
-            except dicom.filereader.InvalidDicomError:
-                pass
 
     if scan and scan.multiecho:
         for echo_num, dcm_echo_num in zip(scan.echo_dict.keys(),
@@ -18,6 +18,15 @@ Options:
                           you are prompted for a password. Note that if
                           multiple servers are configured for a study the
                           login used should be valid for all servers.
+    --upload-workers N    Number of non-dicom resource files to upload to
+                          XNAT at once. Note that XnatPoolSize should be at
+                          least this large. [default: 4]
+    --verify              Decide whether data still needs uploading by
+                          comparing file counts, sizes and (if XNAT stores
+                          them) checksums against XNAT's file catalog,
+                          instead of reading every dicom header. Set
+                          'ArchiveCache' in the configuration to avoid
+                          recomputing this for unchanged archives.
     -v --verbose          Be chatty
     -d --debug            Be very chatty
     -q --quiet            Be quiet
@@ -31,6 +40,7 @@ import urllib.request
 
 from docopt import docopt
 
+import datman.archive_cache
 import datman.config
 import datman.utils
 import datman.scanid
@@ -43,12 +53,18 @@ SERVERS = {}
 SERVER_OVERRIDE = None
 AUTH = None
 CFG = None
+UPLOAD_WORKERS = 4
+VERIFY = False
+ARCHIVE_CACHE = None
 
 
 def main():
     global SERVER_OVERRIDE
     global AUTH
     global CFG
+    global UPLOAD_WORKERS
+    global VERIFY
+    global ARCHIVE_CACHE
 
     arguments = docopt(__doc__)
     verbose = arguments["--verbose"]
@@ -58,6 +74,9 @@ def main():
     SERVER_OVERRIDE = arguments["--server"]
     username = arguments["--username"]
     archive = arguments["<archive>"]
+    UPLOAD_WORKERS = datman.utils.get_positive_int(arguments,
+                                                   "--upload-workers")
+    VERIFY = arguments["--verify"]
 
     # setup logging
     ch = logging.StreamHandler(sys.stdout)
@@ -81,6 +100,7 @@ def main():
     logger.addHandler(ch)
 
     CFG = datman.config.config(study=study)
+    ARCHIVE_CACHE = datman.archive_cache.get_cache(CFG)
     if username:
         AUTH = datman.xnat.get_auth(username)
 
@@ -104,8 +124,14 @@ def main():
     logger.debug("Processing files in: {}".format(dicom_dir))
     logger.info("Processing {} files".format(len(archives)))
 
+    failed = []
     for file_name in archives:
-        process_archive(file_name, dicom_dir)
+        failed.extend(process_archive(file_name, dicom_dir))
+
+    if failed:
+        logger.error("Failed uploading {} files: {}".format(
+            len(failed), ", ".join(failed)))
+        sys.exit(1)
 
 
 def is_valid_id(archive):
@@ -116,14 +142,17 @@ def is_valid_id(archive):
 
 
 def process_archive(file_name, dicom_dir):
-    """Upload data from a zip archive to the xnat server"""
+    """Upload data from a zip archive to the xnat server
+
+    Returns a list of the files that failed to upload
+    """
 
     try:
         scanid = get_scanid(file_name)
     except datman.scanid.ParseException as e:
         logger.error("Failed to find valid identifier for {}. Reason: {}"
                      "".format(file_name, e))
-        return
+        return []
 
     # Make full path after ID conversion, in case user gave different naming
     # convention than file system uses.
@@ -138,7 +167,7 @@ def process_archive(file_name, dicom_dir):
     xnat_subject = get_xnat_subject(scanid, xnat)
     if not xnat_subject:
         # failed to get xnat info
-        return
+        return []
 
     exper_id = scanid.get_xnat_experiment_id()
     try:
@@ -147,15 +176,20 @@ def process_archive(file_name, dicom_dir):
         data_exists = False
         resource_exists = False
     else:
+        if VERIFY:
+            check = verify_files_exist
+        else:
+            check = check_files_exist
         try:
-            data_exists, resource_exists = check_files_exist(archive_file,
-                                                             xnat_experiment,
-                                                             xnat)
+            data_exists, resource_exists = check(archive_file,
+                                                 xnat_experiment,
+                                                 xnat)
         except Exception:
             logger.error("Failed checking xnat for experiment {}".format(
                 exper_id))
-            return
+            return []
 
+    failed = []
     if not data_exists:
         logger.info("Uploading dicoms from {}".format(archive_file))
         try:
@@ -165,15 +199,20 @@ def process_archive(file_name, dicom_dir):
                          "for subject {}. Check Prearchive. Reason - {}"
                          .format(archive_file, xnat_subject.project,
                                  xnat_subject.name, e))
+            failed.append(archive_file)
 
     if not resource_exists:
         logger.debug("Uploading resource from: {}".format(archive_file))
         try:
-            upload_non_dicom_data(archive_file, xnat_subject.project, scanid,
-                                  xnat)
+            failed.extend(upload_non_dicom_data(archive_file,
+                                                xnat_subject.project, scanid,
+                                                xnat))
         except Exception as e:
-            logger.debug("An exception occurred: {}".format(e))
-            pass
+            logger.error("Failed uploading non-dicom data from {}. "
+                         "Reason - {}".format(archive_file, e))
+            failed.append(archive_file)
+
+    return failed
 
 
 def get_xnat_subject(ident, xnat):
@@ -272,9 +311,9 @@ def get_scanid(archivefile):
 
 def resource_data_exists(xnat_resources, archive):
     with zipfile.ZipFile(archive) as zf:
-        local_resources = datman.utils.get_resources(zf)
+        local_resources = datman.utils.get_resources(zf, cache=ARCHIVE_CACHE)
         local_resources_mod = [item for item in local_resources
-                               if zf.read(item)]
+                               if zf.getinfo(item).file_size]
     empty_files = list(set(local_resources) - set(local_resources_mod))
     if empty_files:
         logger.warn("Cannot upload empty resource files {}, omitting."
@@ -315,7 +354,8 @@ def check_files_exist(archive, xnat_experiment, xnat):
     If the session UIDs don't match raises a warning"""
     logger.info("Checking {} contents on xnat".format(xnat_experiment.name))
     try:
-        local_headers = datman.utils.get_archive_headers(archive)
+        local_headers = datman.utils.get_archive_headers(
+            archive, cache=ARCHIVE_CACHE)
     except Exception:
         logger.error("Failed getting zip file headers for: {}".format(archive))
         return False, False
@@ -341,30 +381,80 @@ def check_files_exist(archive, xnat_experiment, xnat):
     return scans_exist, resources_exist
 
 
+def verify_files_exist(archive, xnat_experiment, xnat):
+    """Check whether the local archive has been uploaded to xnat using file
+    sizes and checksums from xnat's catalog, instead of dicom headers.
+
+    Dicom files are renamed (and possibly anonymized) by xnat on import so
+    only their number is compared. Resource files must all exist on xnat
+    with the same size and, when xnat has a checksum for them, contents.
+
+    Returns a tuple of whether the dicoms and resources exist on xnat
+    """
+    logger.info("Verifying {} contents on xnat".format(xnat_experiment.name))
+    xnat_files = xnat_experiment.get_file_manifest(xnat)
+    checksums = any(item["md5"] for item in xnat_files["resources"])
+
+    try:
+        local_files = datman.utils.get_archive_manifest(
+            archive, checksums=checksums, cache=ARCHIVE_CACHE)
+    except Exception as e:
+        logger.error("Failed reading contents of {}. Reason - {}".format(
+            archive, e))
+        return False, False
+
+    scans_exist = len(xnat_files["dicoms"]) >= len(local_files["dicoms"])
+    if not scans_exist:
+        logger.info("Found {} dicoms for {} on xnat, expected {}".format(
+            len(xnat_files["dicoms"]), xnat_experiment.name,
+            len(local_files["dicoms"])))
+
+    # Empty files can't be uploaded, so don't expect to find them
+    local_resources = [item for item in local_files["resources"]
+                       if item["size"]]
+    missing = datman.utils.find_unsynced_files(local_resources,
+                                               xnat_files["resources"])
+    if missing:
+        logger.info("Resources missing or incomplete on xnat for {}: "
+                    "{}".format(xnat_experiment.name, ", ".join(missing)))
+
+    return scans_exist, not missing
+
+
 def upload_non_dicom_data(archive, xnat_project, scanid, xnat):
+    """Upload the non-dicom files in an archive as resources.
+
+    Returns a list of the files that failed to upload
+    """
     with zipfile.ZipFile(archive) as zf:
-        resource_files = datman.utils.get_resources(zf)
+        resource_files = datman.utils.get_resources(zf, cache=ARCHIVE_CACHE)
         logger.info("Uploading {} files of non-dicom data..."
                     .format(len(resource_files)))
-        uploaded_files = []
-        for item in resource_files:
-            # convert to HTTP language
-            try:
-                contents = zf.read(item)
-                # By default files are placed in a MISC subfolder
-                # if this is changed it may require changes to
-                # check_duplicate_resources()
-                xnat.put_resource(xnat_project,
-                                  scanid.get_xnat_subject_id(),
-                                  scanid.get_xnat_experiment_id(),
-                                  item,
-                                  contents,
-                                  "MISC")
-                uploaded_files.append(item)
-            except Exception as e:
-                logger.error("Failed uploading file {} with error:{}"
-                             .format(item, str(e)))
-        return uploaded_files
+        # Stream each file from the archive instead of reading it into memory
+        uploads = [(item, datman.xnat.UploadStream.from_zip(zf, item))
+                   for item in resource_files]
+        try:
+            # By default files are placed in a MISC subfolder
+            # if this is changed it may require changes to
+            # check_duplicate_resources()
+            # Overwriting replaces files that --verify found incomplete on
+            # xnat, and lets uploads be retried if the server is unavailable
+            uploaded = xnat.put_resources(xnat_project,
+                                          scanid.get_xnat_subject_id(),
+                                          scanid.get_xnat_experiment_id(),
+                                          uploads,
+                                          "MISC",
+                                          workers=UPLOAD_WORKERS,
+                                          overwrite=True)
+        except datman.exceptions.XnatException as e:
+            logger.error("Failed uploading non-dicom data from {} with "
+                         "error:{}".format(archive, str(e)))
+            uploaded = []
+        finally:
+            for _, stream in uploads:
+                stream.close()
+    return [os.path.join(archive, item) for item in resource_files
+            if item not in uploaded]
 
 
 def upload_dicom_data(archive, xnat_project, scanid, xnat):
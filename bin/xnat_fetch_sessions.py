@@ -37,6 +37,13 @@ Options:
                             the given site. Only relevant if <study> is given.
     -l, --log-to-server     Set whether to log to the logging server.
                             Only used if <study> is given.
+    --verify                Decide whether a zip file needs to be updated by
+                            comparing the names, sizes and (if XNAT stores
+                            them) checksums of its files against XNAT's file
+                            catalog. This catches truncated or corrupted
+                            files and avoids reading dicom headers. Set
+                            'ArchiveCache' in the configuration to avoid
+                            recomputing this for unchanged zip files.
     -n, --dry-run           Do nothing
     -v, --verbose
     -d, --debug
@@ -53,11 +60,14 @@ from zipfile import ZipFile
 
 from docopt import docopt
 
+import datman.archive_cache
 import datman.config
 import datman.xnat
 import datman.utils
 
 DRYRUN = False
+VERIFY = False
+ARCHIVE_CACHE = None
 
 logging.basicConfig(level=logging.WARN,
                     format="[%(name)s] %(levelname)s: %(message)s")
@@ -66,6 +76,8 @@ logger = logging.getLogger(os.path.basename(__file__))
 
 def main():
     global DRYRUN
+    global VERIFY
+    global ARCHIVE_CACHE
     arguments = docopt(__doc__)
     xnat_project = arguments['<project>']
     xnat_server = arguments['<server>']
@@ -76,6 +88,7 @@ def main():
     given_site = arguments['--site']
     use_server = arguments['--log-to-server']
     DRYRUN = arguments['--dry-run']
+    VERIFY = arguments['--verify']
 
     if arguments['--debug']:
         logger.setLevel(logging.DEBUG)
@@ -90,6 +103,7 @@ def main():
         return
 
     config = datman.config.config(study=study)
+    ARCHIVE_CACHE = datman.archive_cache.get_cache(config)
 
     if use_server:
         add_server_handler(config)
@@ -142,7 +156,8 @@ def download_subjects(xnat, xnat_project, destination):
 
         zip_name = subject.name.upper() + ".zip"
         zip_path = os.path.join(destination, zip_name)
-        if zip_name in current_zips and not update_needed(
+        check_update = verify_update_needed if VERIFY else update_needed
+        if zip_name in current_zips and not check_update(
                 zip_path, experiment, xnat):
             logger.debug("All data downloaded for {}. Passing.".format(
                 experiment.name))
@@ -172,7 +187,8 @@ def update_needed(zip_file, experiment, xnat):
     does not get noticed. Both of them need an update at some later date,
     preferably to use XNAT's metadata on num of files and file size.
     """
-    zip_headers = datman.utils.get_archive_headers(zip_file)
+    zip_headers = datman.utils.get_archive_headers(zip_file,
+                                                   cache=ARCHIVE_CACHE)
     zip_experiment_ids = get_experiment_ids(zip_headers)
     if len(set(zip_experiment_ids)) > 1:
         logger.error("Zip file contains more than one experiment: "
@@ -198,6 +214,42 @@ def update_needed(zip_file, experiment, xnat):
     return False
 
 
+def verify_update_needed(zip_file, experiment, xnat):
+    """
+    Checks if an update is needed by comparing every file on XNAT with the
+    zip file's contents by name and size, and by checksum if XNAT has one.
+    Unlike update_needed() this notices files that are missing, truncated
+    or corrupted.
+    """
+    try:
+        xnat_files = experiment.get_file_manifest(xnat)
+    except Exception as e:
+        logger.error("Can't list XNAT's files for {}. Passing. Reason: {}"
+                     "".format(experiment.name, e))
+        return False
+    xnat_files = xnat_files['dicoms'] + xnat_files['resources']
+    checksums = any(item['md5'] for item in xnat_files)
+
+    try:
+        zip_files = datman.utils.get_archive_manifest(
+            zip_file, checksums=checksums, cache=ARCHIVE_CACHE)
+    except Exception as e:
+        logger.error("Can't read contents of {}. Passing. Reason: {}".format(
+            zip_file, e))
+        return False
+    zip_files = zip_files['dicoms'] + zip_files['resources']
+
+    missing = datman.utils.find_unsynced_files(xnat_files, zip_files)
+    if missing:
+        logger.error("{} of XNAT's files for {} are missing or differ on "
+                     "the file system. Zip file will be deleted and "
+                     "recreated".format(len(missing), experiment.name))
+        logger.debug("Unsynced files: {}".format(", ".join(missing)))
+        return True
+
+    return False
+
+
 def get_experiment_ids(zip_file_headers):
     return [scan.StudyInstanceUID for scan in zip_file_headers.values()]
 
@@ -208,7 +260,7 @@ def get_scan_uids(zip_file_headers):
 
 def get_resources(zip_file):
     with ZipFile(zip_file) as zf:
-        zip_resources = datman.utils.get_resources(zf)
+        zip_resources = datman.utils.get_resources(zf, cache=ARCHIVE_CACHE)
     return zip_resources
 
 
@@ -0,0 +1,128 @@
+"""A local cache of information computed from archives on disk.
+
+Reading a large zip or tar archive to find its contents (e.g. file
+checksums) can take minutes. This cache stores the results (e.g. file
+manifests and the dicom headers of each series, see
+:py:func:`datman.utils.get_archive_headers`) so that they only need to be
+computed again when an archive changes. An entry is
+discarded as soon as its archive's size or modification time differs from
+when the entry was stored.
+
+The cache is off unless the 'ArchiveCache' setting names a database for
+it, or is True to keep 'archive_cache.sqlite' next to the study's other
+metadata.
+"""
+
+import json
+import logging
+import os
+
+from datman.utils import SqliteCache, get_meta_file_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_NAME = "archive_cache.sqlite"
+
+
+def get_cache_path(config, site=None):
+    """Find the archive cache file configured for a study (or site).
+
+    Args:
+        config (:obj:`datman.config.config`): A study's configuration
+        site (:obj:`str`, optional): A valid site for the current study.
+            Defaults to None.
+
+    Returns:
+        str: The full path to the cache file, or None if the cache has not
+            been enabled.
+    """
+    return get_meta_file_setting(
+        config, "ArchiveCache", DEFAULT_CACHE_NAME, site=site
+    )
+
+
+def get_cache(config, site=None):
+    """Open the archive cache configured for a study, if any.
+
+    Returns:
+        :obj:`ArchiveCache`: The study's cache, or None if it's not enabled
+            or can't be opened.
+    """
+    path = get_cache_path(config, site=site)
+    if not path:
+        return None
+    try:
+        return ArchiveCache(path)
+    except Exception as e:
+        logger.error(
+            f"Failed to open archive cache {path}, continuing without it. "
+            f"Reason - {e}"
+        )
+        return None
+
+
+class ArchiveCache(SqliteCache):
+    """Stores information about archives in an sqlite database.
+
+    Each archive may have several kinds of entry (e.g. a file manifest, an
+    index of its contents), stored as JSON. The cache may be shared by
+    multiple threads and processes.
+
+    Args:
+        path (:obj:`str`): The full path to the cache database. It will be
+            created if it doesn't exist.
+    """
+
+    def __init__(self, path):
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS archives ("
+            "archive TEXT, kind TEXT, size INTEGER, mtime REAL, "
+            "data TEXT, PRIMARY KEY (archive, kind))",
+        )
+
+    def get(self, archive, kind):
+        """Retrieve an entry for an archive, if it's still current.
+
+        Args:
+            archive (:obj:`str`): The path to the archive.
+            kind (:obj:`str`): The kind of entry to retrieve.
+
+        Returns:
+            The stored entry, or None if there isn't one or the archive has
+                changed since it was stored.
+        """
+        try:
+            size, mtime = self._get_stat(archive)
+        except OSError:
+            return None
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime, data FROM archives "
+                "WHERE archive = ? AND kind = ?",
+                (os.path.abspath(archive), kind),
+            ).fetchone()
+
+        if not row or row[0] != size or row[1] != mtime:
+            return None
+        return json.loads(row[2])
+
+    def put(self, archive, kind, data):
+        """Store an entry for an archive.
+
+        Args:
+            archive (:obj:`str`): The path to the archive.
+            kind (:obj:`str`): The kind of entry being stored.
+            data: Any JSON serializable value.
+        """
+        size, mtime = self._get_stat(archive)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?)",
+                (os.path.abspath(archive), kind, size, mtime, json.dumps(data)),
+            )
+
+    def _get_stat(self, archive):
+        stat = os.stat(archive)
+        return stat.st_size, stat.st_mtime
@@ -7,11 +7,23 @@ The system is identified from ``os.environ['DM_SYSTEM']`` and can be used to
 switch between multiple installations of datman or different computing systems.
 
 These can both be overridden at ``__init__.py``
+
+Parsed configuration files are shared by all config instances in a process.
+If ``os.environ['DM_CONFIG_CACHE']`` names a folder, a snapshot of each
+parsed file is also stored there, so that other processes can skip parsing
+it. A file is parsed again whenever its size or modification time changes.
+Snapshots are only read back if they belong to the current user and can't
+be written by anyone else, since loading one can run arbitrary code.
 """
 
+import copy
+import hashlib
 import inspect
 import logging
 import os
+import pickle
+import stat
+import tempfile
 
 import wrapt
 import yaml
@@ -22,26 +34,146 @@ from datman.exceptions import ConfigException, UndefinedSetting
 
 logger = logging.getLogger(__name__)
 
-
-@wrapt.decorator
-def study_required(func, instance, args, kwargs):
+# Use libyaml's parser when pyyaml was built with it, it's much faster
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Pickled contents of each yaml file read, by full path
+_loaded_yaml = {}
+# Pickled study tag -> project indexes, by config folder
+_tag_indexes = {}
+
+
+def read_yaml(filename):
+    """Read a yaml file, reusing the parsed contents if it hasn't changed.
+
+    Args:
+        filename (:obj:`str`): The path to a yaml file.
+
+    Returns:
+        The file's contents. Each call returns a new copy, so it's safe to
+        modify.
+    """
+    path = os.path.abspath(filename)
+    version = _get_version(path)
+
+    cached = _loaded_yaml.get(path)
+    if cached is None or cached[0] != version:
+        contents = _read_snapshot(path, version)
+        if contents is None:
+            with open(path, "r") as stream:
+                config_yaml = yaml.load(stream, Loader=YAML_LOADER)
+            contents = pickle.dumps(config_yaml)
+            _write_snapshot(path, version, contents)
+        cached = (version, contents)
+        _loaded_yaml[path] = cached
+
+    # Unpickling is a much faster way to copy than copy.deepcopy
+    return pickle.loads(cached[1])
+
+
+def _get_version(path):
+    file_stat = os.stat(path)
+    return (file_stat.st_size, file_stat.st_mtime_ns)
+
+
+def _get_version_if_exists(path):
+    try:
+        return _get_version(path)
+    except OSError:
+        return None
+
+
+def _get_snapshot_path(path):
+    cache_dir = os.environ.get("DM_CONFIG_CACHE")
+    if not cache_dir:
+        return None
+    name = hashlib.sha1(path.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, f"{name}.pickle")
+
+
+def _read_snapshot(path, version):
+    snapshot = _get_snapshot_path(path)
+    if not snapshot:
+        return None
+    try:
+        with open(snapshot, "rb") as fh:
+            if not _is_trusted(os.fstat(fh.fileno())):
+                logger.debug(
+                    f"Ignoring config snapshot {snapshot} - not owned by the "
+                    "current user or writable by others"
+                )
+                return None
+            stored_path, stored_version, contents = pickle.load(fh)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.debug(f"Ignoring unreadable config snapshot {snapshot} - {e}")
+        return None
+    if stored_path != path or tuple(stored_version) != version:
+        return None
+    return contents
+
+
+def _is_trusted(snapshot_stat):
+    if snapshot_stat.st_uid != os.getuid():
+        return False
+    return not snapshot_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _write_snapshot(path, version, contents):
+    snapshot = _get_snapshot_path(path)
+    if not snapshot:
+        return
+    temp = None
+    try:
+        os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+        # Write to a temp file first so other processes never read a
+        # partial snapshot
+        handle, temp = tempfile.mkstemp(dir=os.path.dirname(snapshot))
+        with os.fdopen(handle, "wb") as fh:
+            pickle.dump((path, version, contents), fh)
+        os.replace(temp, snapshot)
+    except Exception as e:
+        logger.debug(f"Failed to store config snapshot {snapshot} - {e}")
+        if temp and os.path.exists(temp):
+            os.remove(temp)
+
+
+def study_required(func):
     # This is needed in case user passes keyword args as positional parameters
     # e.g. config.get_path('nii', 'SPINS') instead of
-    # config.get_path('nii', study='SPINS')
-    found_kwargs = inspect.getcallargs(func, *args, **kwargs)
-    if "study" in found_kwargs and found_kwargs["study"]:
-        instance.set_study(found_kwargs["study"])
-    if not instance.study_config:
-        raise ConfigException("Study not set.")
-    return func(*args, **kwargs)
+    # config.get_path('nii', study='SPINS'). The position is found once here
+    # since these methods are called very often.
+    params = list(inspect.signature(func).parameters)
+    # Bound methods won't receive 'self' in args
+    position = params.index("study") - 1 if "study" in params else None
+
+    @wrapt.decorator
+    def wrapper(wrapped, instance, args, kwargs):
+        study = kwargs.get("study")
+        if study is None and position is not None and len(args) > position:
+            study = args[position]
+        if study and not (
+            instance.study_config and study.upper() == instance.study_name
+        ):
+            instance.set_study(study)
+        if not instance.study_config:
+            raise ConfigException("Study not set.")
+        return wrapped(*args, **kwargs)
+
+    return wrapper(func)
 
 
 class config(object):
+    system_config_file = None
     system_config = None
     study_config = None
     install_config = None
     study_name = None
     study_config_file = None
+    # Resolved settings, for the study_config they were found with
+    _key_cache = None
+    _key_cache_study = None
 
     def __init__(self, filename=None, system=None, study=None):
         """
@@ -66,6 +198,7 @@ class config(object):
             except KeyError:
                 raise ConfigException("Failed to find main config file")
 
+        self.system_config_file = os.path.abspath(filename)
         self.system_config = self.load_yaml(filename)
 
         if not system:
@@ -91,10 +224,7 @@ class config(object):
             raise ConfigException(
                 f"configuration file {filename} not found. Try again."
             )
-        with open(filename, "r") as stream:
-            config_yaml = yaml.load(stream, Loader=yaml.SafeLoader)
-
-        return config_yaml
+        return read_yaml(filename)
 
     def set_study(self, study_name):
         """
@@ -191,42 +321,89 @@ class config(object):
             self.set_study(tag)
             return tag
 
-        for project in projects.keys():
-            # search each project for a match to the study tag,
-            # this loop exits as soon as a match is found.
-            logger.debug(f"Searching project: {project}")
+        try:
+            project = self.get_tag_index()[tag.lower()]
+        except KeyError:
+            # didn't find a match throw a warning
+            logger.warn(f"Failed to find a valid project for xnat id: {tag}")
+            raise ValueError
+
+        # Hack to deal with DTI not being a unique tag :(
+        if project.upper() == "DTI15T" or project.upper() == "DTI3T":
+            if parts.site == "TGH":
+                project = "DTI15T"
+            else:
+                project = "DTI3T"
+        self.set_study(project)
+        return project
 
-            self.set_study(project)
-            site_tags = []
+    def get_tag_index(self):
+        """Map every study and site tag to the project that uses it.
+
+        Tags are matched case insensitively, so are stored in lower case. If
+        several projects use a tag it belongs to the first one listed in
+        'Projects'. The index is rebuilt whenever the size or modification
+        time of the main config or any study's config file changes, and is
+        stored with the other config snapshots if DM_CONFIG_CACHE is set.
 
-            if "Sites" not in self.study_config.keys():
+        Returns:
+            dict: A dictionary mapping each tag to a project name.
+        """
+        config_dir = self.get_key("ConfigDir")
+        projects = self.get_key("Projects")
+        key = f"{self.system_config_file}:{os.path.abspath(config_dir)}"
+        files = [
+            os.path.join(config_dir, study_yaml)
+            for study_yaml in projects.values()
+        ]
+        if self.system_config_file:
+            files.append(self.system_config_file)
+        version = (
+            tuple(projects.items()),
+            tuple(_get_version_if_exists(path) for path in files),
+        )
+
+        cached = _tag_indexes.get(key)
+        if cached is None or cached[0] != version:
+            contents = _read_snapshot(f"tag_index:{key}", version)
+            if contents is None:
+                contents = pickle.dumps(self._make_tag_index(projects))
+                _write_snapshot(f"tag_index:{key}", version, contents)
+            cached = (version, contents)
+            _tag_indexes[key] = cached
+        return pickle.loads(cached[1])
+
+    def _make_tag_index(self, projects):
+        index = {}
+        # Read each study's settings with a copy, to leave this one's alone
+        reader = copy.copy(self)
+        for project in projects:
+            logger.debug(f"Searching project: {project}")
+            try:
+                reader.set_study(project)
+            except Exception as e:
+                logger.error(f"Can't read config for {project} - {e}")
+                continue
+
+            if "Sites" not in reader.study_config.keys():
                 logger.debug(f"No sites defined for {project}")
                 continue
 
-            for key, site_config in self.get_key("Sites").items():
-                try:
-                    add_tags = [t.lower() for t in site_config["SiteTags"]]
-                except KeyError:
-                    add_tags = []
-                site_tags.extend(add_tags)
-
-            site_tags.append(self.study_config["StudyTag"].lower())
-
-            if tag.lower() in site_tags:
-                # Hack to deal with DTI not being a unique tag :(
-                if project.upper() == "DTI15T" or project.upper() == "DTI3T":
-                    if parts.site == "TGH":
-                        project = "DTI15T"
-                    else:
-                        project = "DTI3T"
-                # Needs to be set here in addition to at the top of the loop in
-                # case the wrong DTI study settings were encountered
-                # for the last set_study call. Ugh.
-                self.set_study(project)
-                return project
-        # didn't find a match throw a warning
-        logger.warn(f"Failed to find a valid project for xnat id: {tag}")
-        raise ValueError
+            site_tags = []
+            for site_config in reader.get_key("Sites").values():
+                add_tags = site_config.get("SiteTags", [])
+                if isinstance(add_tags, str):
+                    add_tags = [add_tags]
+                site_tags.extend(t.lower() for t in add_tags)
+
+            try:
+                site_tags.append(reader.study_config["StudyTag"].lower())
+            except KeyError:
+                logger.debug(f"No study tag defined for {project}")
+
+            for site_tag in site_tags:
+                index.setdefault(site_tag, project)
+        return index
 
     def _search_site_conf(self, site, key):
         """
@@ -362,9 +539,39 @@ class config(object):
         If 'ignore_defaults' is set the search is restricted to only site (if
         site was given) or only the current study (if site was not).
 
+        Results (and failed searches) are remembered until a different study
+        is set. Lists and dictionaries aren't copied (copying them cost more
+        than the search being saved), so callers must copy a setting before
+        changing it.
+
         Raises UndefinedSetting if no value is found
         """
+        if (
+            self._key_cache is None
+            or self._key_cache_study is not self.study_config
+        ):
+            self._key_cache = {}
+            self._key_cache_study = self.study_config
+
+        cache_key = (key, site, ignore_defaults, defaults_only)
+        try:
+            value = self._key_cache[cache_key]
+        except KeyError:
+            try:
+                value = self._find_key(
+                    key, site, ignore_defaults, defaults_only
+                )
+            except (UndefinedSetting, ConfigException) as e:
+                # Keep the exception's type and message, not the exception
+                # itself, so its traceback doesn't grow with every raise
+                value = _FailedSearch(type(e), e.args)
+            self._key_cache[cache_key] = value
+
+        if isinstance(value, _FailedSearch):
+            raise value.error(*value.args)
+        return value
 
+    def _find_key(self, key, site, ignore_defaults, defaults_only):
         value = None
         if site and not defaults_only:
             value = self._get_setting(
@@ -486,6 +693,14 @@ class config(object):
         return tags
 
 
+class _FailedSearch(object):
+    __slots__ = ("error", "args")
+
+    def __init__(self, error, args):
+        self.error = error
+        self.args = args
+
+
 class TagInfo(object):
     def __init__(self, export_settings, site_settings=None):
         if not site_settings:
@@ -58,6 +58,14 @@ class Identifier(ABC):
         else:
             return self.get_full_subjectid_with_timepoint()
 
+    def __reduce__(self):
+        # The regex match each instance holds can't be pickled, so rebuild
+        # from the original ID instead (e.g. when passed to another process)
+        # and then restore everything else, in case it changed after parsing
+        state = self.__dict__.copy()
+        del state["_match_groups"]
+        return (self.__class__, (self.orig_id, self._settings), state)
+
 
 class DatmanIdentifier(Identifier):
     """
@@ -97,6 +105,7 @@ class DatmanIdentifier(Identifier):
             raise ParseException(f"Invalid Datman ID {identifier}")
 
         self._match_groups = match
+        self._settings = settings
         self.orig_id = match.group("id")
         self.study = match.group("study")
         self.site = match.group("site")
@@ -163,6 +172,7 @@ class KCNIIdentifier(Identifier):
             raise ParseException(f"Invalid KCNI ID {identifier}")
 
         self._match_groups = match
+        self._settings = settings
         self.orig_id = match.group("id")
         self.study = get_field(match, "Study", settings=settings)
         self.site = get_field(match, "Site", settings=settings)
@@ -2,18 +2,23 @@
 A collection of utilities for generally munging imaging data.
 """
 import contextlib
+import hashlib
 import io
 import logging
+import multiprocessing
 import os
 import random
 import re
 import shutil
+import sqlite3
 import subprocess as proc
 import sys
 import tarfile
 import tempfile
+import threading
 import time
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import pydicom as dcm
 import pyxnat
@@ -29,6 +34,11 @@ from datman.exceptions import (
 
 logger = logging.getLogger(__name__)
 
+# The default number of threads (or processes) used to read dicom headers
+HEADER_WORKERS = min(8, os.cpu_count() or 1)
+# Header values larger than this (in bytes) are left out of archive caches
+HEADER_CACHE_LIMIT = 1024
+
 
 def locate_metadata(filename, study=None, subject=None, config=None, path=None):
     if not (path or study or config or subject):
@@ -50,6 +60,42 @@ def locate_metadata(filename, study=None, subject=None, config=None, path=None):
     return file_path
 
 
+def get_meta_file_setting(config, key, default, site=None):
+    """Find the file named by a setting that may point to the metadata folder.
+
+    The setting may be True (to use 'default' in the study's metadata
+    folder), the name of a file in the metadata folder, or a full path.
+
+    Args:
+        config (:obj:`datman.config.config`): A study's configuration
+        key (:obj:`str`): The name of the setting to read.
+        default (:obj:`str`): The file name to use if the setting is True.
+        site (:obj:`str`, optional): A valid site for the current study.
+            Defaults to None.
+
+    Returns:
+        str: The full path to the file, or None if the setting is undefined
+            or turned off.
+    """
+    if not config:
+        return None
+
+    try:
+        setting = config.get_key(key, site=site)
+    except datman.config.UndefinedSetting:
+        return None
+
+    if not setting:
+        return None
+
+    if setting is True:
+        setting = default
+
+    if os.path.dirname(setting):
+        return setting
+    return locate_metadata(setting, config=config)
+
+
 def read_checklist(
     study=None,
     subject=None,
@@ -698,7 +744,9 @@ def get_extension(path):
         return os.path.splitext(path)[1]
 
 
-def get_archive_headers(path, stop_after_first=False):
+def get_archive_headers(
+    path, stop_after_first=False, workers=None, cache=None
+):
     """
     Get dicom headers from a scan archive.
 
@@ -707,119 +755,413 @@ def get_archive_headers(path, stop_after_first=False):
     into folders for each series.
 
     The entire archive is scanned and dicom headers from a single file in each
-    folder are returned as a dictionary that maps path->headers.
+    folder are returned as a dictionary that maps path->headers. Folders of
+    zip files and directories are searched by up to 'workers' threads at
+    once (default HEADER_WORKERS).
 
     If stop_after_first == True only a single set of dicom headers are
     returned for the entire archive, which is useful if you only care about the
     exam details.
+
+    If a cache (:obj:`datman.archive_cache.ArchiveCache`) is given, the
+    headers of zip files are read from it instead, unless the archive
+    has changed since they were stored. Large binary values (over
+    HEADER_CACHE_LIMIT bytes) are not cached and are None in cached headers.
+    Tarballs are cached as an index of where their headers are stored
+    instead (see :py:func:`get_tarfile_headers`).
     """
+    if is_tarball(path):
+        return get_tarfile_headers(path, stop_after_first, cache)
+
+    if cache:
+        manifest = get_cached_headers(cache, path, stop_after_first)
+        if manifest is not None:
+            return manifest
+
     if os.path.isdir(path):
-        return get_folder_headers(path, stop_after_first)
+        return get_folder_headers(path, stop_after_first, workers)
     elif zipfile.is_zipfile(path):
-        return get_zipfile_headers(path, stop_after_first)
-    elif os.path.isfile(path) and path.endswith(".tar.gz"):
-        return get_tarfile_headers(path, stop_after_first)
+        manifest = get_zipfile_headers(path, stop_after_first, workers)
     else:
         raise Exception(f"{path} must be a file (zip/tar) or folder.")
 
+    if cache:
+        cache_headers(cache, path, stop_after_first, manifest)
+    return manifest
+
+
+def get_headers_for_archives(
+    paths, stop_after_first=False, workers=None, cache=None
+):
+    """Get the dicom headers from many scan archives at once.
+
+    Archives are read in up to 'workers' separate processes, since parsing
+    headers is mostly CPU bound.
+
+    Args:
+        paths (list): A list of full paths to archives (see
+            :py:func:`get_archive_headers`).
+        stop_after_first (bool, optional): Only read one header per archive.
+            Defaults to False.
+        workers (int, optional): The number of archives to read at once.
+            Defaults to HEADER_WORKERS.
+        cache (:obj:`datman.archive_cache.ArchiveCache`, optional): A cache
+            to read headers from (or add them to). Only archives that aren't
+            in the cache are read. Defaults to None.
 
-def get_tarfile_headers(path, stop_after_first=False):
+    Returns:
+        dict: A dictionary mapping each path to its manifest, in the same
+            order as 'paths'. If an archive couldn't be read the exception
+            raised is returned in place of its manifest.
     """
-    Get headers for dicom files within a tarball
+    manifests = dict.fromkeys(paths)
+    indexes = {}
+    if cache:
+        for path in paths:
+            if is_tarball(path):
+                indexes[path] = get_tar_index(cache, path, stop_after_first)
+            else:
+                manifests[path] = get_cached_headers(
+                    cache, path, stop_after_first
+                )
+    missing = [path for path in manifests if manifests[path] is None]
+    missing_indexes = [indexes.get(path) for path in missing]
+
+    workers = min(workers or HEADER_WORKERS, len(missing))
+    if workers <= 1:
+        found = [
+            _read_archive_headers(path, stop_after_first, index)
+            for path, index in zip(missing, missing_indexes)
+        ]
+    else:
+        # Workers are started fresh rather than forked so that they don't
+        # inherit open sockets or locks (e.g. the cache's) from this process
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=context
+        ) as pool:
+            found = list(pool.map(
+                _read_archive_headers, missing,
+                [stop_after_first] * len(missing), missing_indexes
+            ))
+
+    for path, (manifest, index) in zip(missing, found):
+        manifests[path] = manifest
+        if not cache or isinstance(manifest, Exception):
+            continue
+        if index is not None:
+            cache.put(path, "tar_index", index)
+        elif not is_tarball(path):
+            cache_headers(cache, path, stop_after_first, manifest)
+    return manifests
+
+
+def _read_archive_headers(path, stop_after_first, index=None):
+    # Each archive gets its own process, so don't start more threads.
+    # The cache can't be shared with the process, so a tarball's index is
+    # passed in and any new one is returned with the headers.
+    try:
+        if is_tarball(path):
+            return _read_tarfile_headers(path, stop_after_first, index)
+        return get_archive_headers(path, stop_after_first, workers=1), None
+    except Exception as e:
+        return e, None
+
+
+def get_cached_headers(cache, path, stop_after_first=False):
+    """Get an archive's dicom headers from an archive cache.
+
+    Args:
+        cache (:obj:`datman.archive_cache.ArchiveCache`): The cache to search.
+        path (:obj:`str`): The full path to a zip archive.
+        stop_after_first (bool, optional): Whether to get the headers stored
+            for a single series. Defaults to False.
+
+    Returns:
+        dict: A dictionary mapping folders to :obj:`pydicom.dataset.Dataset`
+            headers, or None if the archive's headers aren't cached or it
+            has changed since they were.
     """
-    tar = tarfile.open(path)
-    members = tar.getmembers()
+    if not os.path.isfile(path):
+        # A folder's modification time doesn't change when the files
+        # inside its subfolders do
+        return None
+
+    stored = cache.get(path, _get_header_kind(stop_after_first))
+    if stored is None:
+        return None
+    try:
+        return {
+            folder: dcm.Dataset.from_json(
+                header, bulk_data_uri_handler=_get_bulk_data
+            )
+            for folder, header in stored.items()
+        }
+    except Exception as e:
+        logger.debug(f"Ignoring unreadable cached headers for {path} - {e}")
+        return None
 
-    manifest = {}
-    # for each dir, we want to inspect files inside of it until we find a dicom
-    # file that has header information
-    for f in [x for x in members if x.isfile()]:
-        dirname = os.path.dirname(f.name)
-        if dirname in manifest:
-            continue
-        try:
-            manifest[dirname] = dcm.read_file(tar.extractfile(f))
-            if stop_after_first:
-                break
-        except dcm.filereader.InvalidDicomError:
-            continue
-    return manifest
 
+def cache_headers(cache, path, stop_after_first, manifest):
+    """Store an archive's dicom headers in an archive cache.
 
-def get_zipfile_headers(path, stop_after_first=False):
+    Headers for folders (instead of zip or tar files) are not stored. See
+    :py:func:`get_cached_headers`.
     """
-    Get headers for a dicom file within a zipfile
+    if not os.path.isfile(path):
+        return
+    try:
+        stored = {
+            folder: header.to_json(
+                bulk_data_threshold=HEADER_CACHE_LIMIT,
+                bulk_data_element_handler=_skip_bulk_data,
+            )
+            for folder, header in manifest.items()
+        }
+        cache.put(path, _get_header_kind(stop_after_first), stored)
+    except Exception as e:
+        logger.debug(f"Failed to cache headers for {path} - {e}")
+
+
+def _get_header_kind(stop_after_first):
+    return "first_header" if stop_after_first else "headers"
+
+
+def _skip_bulk_data(data_element):
+    return ""
+
+
+def _get_bulk_data(*args):
+    return None
+
+
+def is_tarball(path):
+    return os.path.isfile(path) and path.endswith(".tar.gz")
+
+
+def get_tarfile_headers(path, stop_after_first=False, cache=None):
     """
-    zf = zipfile.ZipFile(path)
+    Get headers for dicom files within a tarball
 
-    manifest = {}
-    for f in zf.namelist():
-        dirname = os.path.dirname(f)
-        if dirname in manifest:
-            continue
-        try:
-            manifest[dirname] = dcm.read_file(io.BytesIO(zf.read(f)))
+    Members of a compressed tarball can only be reached by decompressing
+    everything before them, so the archive is read in a single pass and only
+    as far as needed. If a cache (:obj:`datman.archive_cache.ArchiveCache`) is
+    given the location of the first dicom in each folder is stored in it, so
+    later reads can go straight to them without listing the whole archive.
+    """
+    index = get_tar_index(cache, path, stop_after_first) if cache else None
+    manifest, index = _read_tarfile_headers(path, stop_after_first, index)
+    if cache and index is not None:
+        cache.put(path, "tar_index", index)
+    return manifest
+
+
+def get_tar_index(cache, path, stop_after_first=False):
+    """Get the index of a tarball's dicom headers from an archive cache.
+
+    The index is a dictionary. Its 'members' entry holds a [folder, member
+    name, data offset, size] list for the first dicom in each folder, and
+    'complete' is False if the tarball was only read as far as its first
+    dicom.
+
+    Returns:
+        dict: The index, or None if there isn't one with enough entries for
+            the headers requested or the tarball has changed since it was
+            stored.
+    """
+    index = cache.get(path, "tar_index")
+    if not isinstance(index, dict):
+        return None
+    if not (index.get("complete") or stop_after_first):
+        return None
+    return index
+
+
+def _read_tarfile_headers(path, stop_after_first=False, index=None):
+    """Read a tarball's headers, using its index if one is given.
+
+    Returns:
+        tuple: The headers found, and a new index for the tarball (or None
+            if the index given was used).
+    """
+    with tarfile.open(path) as tar:
+        if index is not None:
+            try:
+                manifest = _read_indexed_headers(
+                    tar, index["members"], stop_after_first
+                )
+                return manifest, None
+            except (
+                dcm.filereader.InvalidDicomError,
+                tarfile.TarError,
+                KeyError,
+                ValueError,
+            ) as e:
+                logger.debug(f"Ignoring outdated index for {path} - {e}")
+
+        manifest = {}
+        members = []
+        complete = True
+        # for each dir, we want to inspect files inside of it until we find a
+        # dicom file that has header information
+        for member in tar:
+            if not member.isfile():
+                continue
+            dirname = os.path.dirname(member.name)
+            if dirname in manifest:
+                continue
+            try:
+                manifest[dirname] = read_dicom_header(tar.extractfile(member))
+            except dcm.filereader.InvalidDicomError:
+                continue
+            members.append(
+                [dirname, member.name, member.offset_data, member.size]
+            )
             if stop_after_first:
+                complete = False
                 break
-        except dcm.filereader.InvalidDicomError:
-            continue
-        except zipfile.BadZipfile:
-            logger.warning(f"Error in zipfile:{path}")
+
+    return manifest, {"complete": complete, "members": members}
+
+
+def _read_indexed_headers(tar, index, stop_after_first=False):
+    """Read the headers of the members in a tarball's index.
+
+    Each index entry is a [folder, member name, data offset, size] list.
+    Members are read in the order they're stored, so a compressed archive is
+    only decompressed once and only up to the last one needed.
+    """
+    manifest = {}
+    for dirname, name, offset, size in sorted(index, key=lambda x: x[2]):
+        member = tarfile.TarInfo(name)
+        member.offset_data = offset
+        member.size = size
+        manifest[dirname] = read_dicom_header(tar.extractfile(member))
+        if stop_after_first:
             break
     return manifest
 
 
-def get_folder_headers(path, stop_after_first=False):
+def get_zipfile_headers(path, stop_after_first=False, workers=None):
+    """
+    Get headers for a dicom file within a zipfile
+
+    Members are read directly from the archive and only until the end of
+    their headers, so pixel data is never decompressed.
+    """
+
+    def find_header(names):
+        for name in names:
+            try:
+                with zf.open(name) as fh:
+                    return read_dicom_header(fh)
+            except dcm.filereader.InvalidDicomError:
+                continue
+            except zipfile.BadZipfile:
+                logger.warning(f"Error in zipfile:{path}")
+                return None
+        return None
+
+    with zipfile.ZipFile(path) as zf:
+        names = [name for name in zf.namelist() if not name.endswith("/")]
+        if stop_after_first:
+            for name in names:
+                header = find_header([name])
+                if header is not None:
+                    return {os.path.dirname(name): header}
+            return {}
+
+        folders = {}
+        for name in names:
+            folders.setdefault(os.path.dirname(name), []).append(name)
+        return _find_headers(list(folders.items()), find_header, workers)
+
+
+def get_folder_headers(path, stop_after_first=False, workers=None):
     """
     Generate a dictionary of subfolders and dicom headers.
     """
 
-    manifest = {}
+    def find_header(filepaths):
+        for filepath in filepaths:
+            try:
+                return read_dicom_header(filepath)
+            except dcm.filereader.InvalidDicomError:
+                continue
+        return None
 
     # for each dir, we want to inspect files inside of it until we find a dicom
     # file that has header information
-    subdirs = []
-    for filename in os.listdir(path):
-        filepath = os.path.join(path, filename)
-        try:
-            if os.path.isdir(filepath):
-                subdirs.append(filepath)
-                continue
-            manifest[path] = dcm.read_file(filepath)
+    folders = []
+    for dirname, _, filenames in os.walk(path):
+        folders.append(
+            (dirname, [os.path.join(dirname, name) for name in filenames])
+        )
+        if stop_after_first:
             break
-        except dcm.filereader.InvalidDicomError:
-            pass
+    return _find_headers(folders, find_header, workers)
 
-    if stop_after_first:
-        return manifest
 
-    # recurse
-    for subdir in subdirs:
-        manifest.update(get_folder_headers(subdir, stop_after_first))
-    return manifest
+def _find_headers(folders, find_header, workers=None):
+    """Find the headers for each folder of an archive, using several threads.
+
+    Args:
+        folders (list): A list of (folder, files) tuples.
+        find_header (callable): A function that returns the header of the
+            first dicom in a list of files, or None if there isn't one.
+        workers (int, optional): The number of threads to use. Defaults to
+            HEADER_WORKERS.
+
+    Returns:
+        dict: A dictionary mapping each folder that holds a dicom to its
+            header, in the same order as 'folders'.
+    """
+    workers = min(workers or HEADER_WORKERS, len(folders))
+    files = [item[1] for item in folders]
+    if workers <= 1:
+        headers = map(find_header, files)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            headers = list(pool.map(find_header, files))
+    return {
+        folder: header
+        for (folder, _), header in zip(folders, headers)
+        if header is not None
+    }
 
 
-def get_all_headers_in_folder(path, recurse=False):
+def get_all_headers_in_folder(path, recurse=False, workers=None):
     """
     Get DICOM headers for all files in the given path.
 
-    Returns a dictionary mapping path->headers for *all* files (headers == None
-    for files that are not dicoms).
+    Returns a dictionary mapping path->headers for every dicom file. Files
+    are read by up to 'workers' threads at once (default HEADER_WORKERS).
     """
 
-    manifest = {}
+    def read_header(filepath):
+        try:
+            return read_dicom_header(filepath)
+        except dcm.filereader.InvalidDicomError:
+            return None
+
+    filepaths = []
     for dirname, dirnames, filenames in os.walk(path):
         for filename in filenames:
-            filepath = os.path.join(dirname, filename)
-            headers = None
-            try:
-                headers = dcm.read_file(filepath)
-            except dcm.filereader.InvalidDicomError:
-                continue
-            manifest[filepath] = headers
+            filepaths.append(os.path.join(dirname, filename))
         if not recurse:
             break
-    return manifest
+
+    workers = min(workers or HEADER_WORKERS, len(filepaths))
+    if workers <= 1:
+        headers = map(read_header, filepaths)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            headers = list(pool.map(read_header, filepaths))
+    return {
+        filepath: header
+        for filepath, header in zip(filepaths, headers)
+        if header is not None
+    }
 
 
 def define_folder(path):
@@ -1052,6 +1394,37 @@ class cd(object):
         os.chdir(self.old_path)
 
 
+class SqliteCache(object):
+    """A base for caches stored in an sqlite database.
+
+    The connection can be shared by multiple threads, with access serialized
+    by a lock, and by multiple processes.
+
+    Args:
+        path (:obj:`str`): The full path to the database. It will be created
+            if it doesn't exist.
+        schema (:obj:`str`): A statement to create the cache's table if it
+            doesn't already exist.
+    """
+
+    def __init__(self, path, schema):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(schema)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __str__(self):
+        return f"<{type(self).__module__}.{type(self).__name__} {self.path}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
 class XNATConnection(object):
     def __init__(self, xnat_url, user_name, password):
         self.server = xnat_url
@@ -1068,6 +1441,28 @@ class XNATConnection(object):
         self.connection.disconnect()
 
 
+def get_positive_int(arguments, option):
+    """Read a command line option that must be a positive integer.
+
+    Exits with an error if the value given isn't a positive integer.
+
+    Args:
+        arguments (:obj:`dict`): Command line arguments, as parsed by docopt.
+        option (:obj:`str`): The name of the option to read.
+
+    Returns:
+        int: The option's value.
+    """
+    try:
+        value = int(arguments[option])
+    except ValueError:
+        value = 0
+    if value < 1:
+        print(f"{option} must be a positive integer. Exiting.")
+        sys.exit(1)
+    return value
+
+
 def get_xnat_credentials(config, xnat_cred):
     if not xnat_cred:
         xnat_cred = os.path.join(config.get_path("meta"), "xnat-credentials")
@@ -1274,7 +1669,26 @@ def submit_job(
         sys.exit(1)
 
 
-def get_resources(open_zipfile):
+def get_resources(open_zipfile, cache=None):
+    """List the non-dicom files in a zip archive.
+
+    Only the first 132 bytes of each file are decompressed to check whether
+    it's a dicom.
+
+    Args:
+        open_zipfile (:obj:`zipfile.ZipFile`): An open zip file.
+        cache (:obj:`datman.archive_cache.ArchiveCache`, optional): A cache
+            to read the list from (or add it to). Defaults to None.
+
+    Returns:
+        list: The names of all files in the archive that aren't dicoms.
+    """
+    archive = open_zipfile.filename
+    if cache and archive:
+        resource_files = cache.get(archive, "resources")
+        if resource_files is not None:
+            return resource_files
+
     # filter dirs
     files = open_zipfile.namelist()
     files = [f for f in files if not f.endswith("/")]
@@ -1286,24 +1700,171 @@ def get_resources(open_zipfile):
     resource_files = []
     for f in files:
         try:
-            if not is_dicom(io.BytesIO(open_zipfile.read(f))):
-                resource_files.append(f)
+            with open_zipfile.open(f) as fh:
+                if not has_dicom_preamble(io.BytesIO(fh.read(132))):
+                    resource_files.append(f)
         except zipfile.BadZipfile:
             logger.error(f"Error in zipfile:{f}")
+
+    if cache and archive:
+        cache.put(archive, "resources", resource_files)
     return resource_files
 
 
+def get_archive_manifest(archive, checksums=False, cache=None):
+    """List the files in a zip archive with their sizes and checksums.
+
+    Sizes are read from the zip's directory, so are cheap to get. Checksums
+    require reading every file in the archive. If a cache is given, the
+    manifest is only computed again when the archive changes.
+
+    Args:
+        archive (:obj:`str`): The full path to a zip file.
+        checksums (bool, optional): Whether to compute an md5 checksum for
+            each file. Defaults to False.
+        cache (:obj:`datman.archive_cache.ArchiveCache`, optional): A cache
+            to read the manifest from (or add it to). Defaults to None.
+
+    Returns:
+        dict: A dictionary with the keys 'dicoms' and 'resources' that each
+            contain a list of files. Each file is a dictionary with the keys
+            'name' (the path in the archive), 'size' and 'md5' (None if
+            checksums weren't requested).
+    """
+    if cache:
+        manifest = cache.get(archive, "manifest")
+        if manifest and (manifest["checksums"] or not checksums):
+            return manifest
+
+    with zipfile.ZipFile(archive) as zf:
+        resources = set(get_resources(zf, cache=cache))
+        manifest = {"checksums": checksums, "dicoms": [], "resources": []}
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            entry = {
+                "name": info.filename,
+                "size": info.file_size,
+                "md5": _get_md5(zf, info) if checksums else None,
+            }
+            if info.filename in resources:
+                manifest["resources"].append(entry)
+            else:
+                manifest["dicoms"].append(entry)
+
+    if cache:
+        cache.put(archive, "manifest", manifest)
+    return manifest
+
+
+def _get_md5(zip_file, info):
+    md5 = hashlib.md5()
+    with zip_file.open(info) as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def find_unsynced_files(source, dest):
+    """Find files that are missing, truncated or corrupted at a destination.
+
+    Files are matched by name (ignoring their folder) and size. Checksums are
+    compared too when both sides have one.
+
+    Args:
+        source (list): A list of file dictionaries (as given by
+            :py:func:`get_archive_manifest`) for the files that should
+            exist.
+        dest (list): A list of file dictionaries for the files that were
+            found at the destination.
+
+    Returns:
+        list: The names of the files in 'source' that had no match in
+            'dest'.
+    """
+    found = {}
+    for entry in dest:
+        found.setdefault(os.path.basename(entry["name"]), []).append(entry)
+
+    unsynced = []
+    for entry in source:
+        candidates = found.get(os.path.basename(entry["name"]), [])
+        match = None
+        for candidate in candidates:
+            if candidate["size"] != entry["size"]:
+                continue
+            if (
+                entry.get("md5")
+                and candidate.get("md5")
+                and entry["md5"] != candidate["md5"]
+            ):
+                continue
+            match = candidate
+            break
+        if match is None:
+            unsynced.append(entry["name"])
+        else:
+            # Each file can only account for one duplicate
+            candidates.remove(match)
+    return unsynced
+
+
 def is_named_like_a_dicom(path):
     dcm_exts = ("dcm", "img")
     return any([path.lower().endswith(x) for x in dcm_exts])
 
 
+def has_dicom_preamble(source):
+    """Check whether a file starts with a dicom preamble and 'DICM' prefix.
+
+    Only the first 132 bytes are read. These are the same files
+    pydicom.read_file accepts when force=True isn't given.
+
+    Args:
+        source: A path to a file or a binary file object. The position of a
+            file object is restored afterwards.
+
+    Returns:
+        bool: True if the file has a dicom preamble.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        try:
+            with open(source, "rb") as fh:
+                header = fh.read(132)
+        except IOError:
+            return False
+    else:
+        position = source.tell()
+        header = source.read(132)
+        source.seek(position)
+    return len(header) == 132 and header[128:] == b"DICM"
+
+
+def read_dicom_header(source, specific_tags=None):
+    """Read the header (everything but the pixel data) of a dicom file.
+
+    Args:
+        source: A path to a file or a seekable binary file object.
+        specific_tags (list, optional): Only read these tags (names or
+            tag numbers) from the header. Defaults to reading all of them.
+
+    Raises:
+        pydicom.errors.InvalidDicomError: If source is not a dicom file.
+
+    Returns:
+        :obj:`pydicom.dataset.FileDataset`: The dicom's header.
+    """
+    if not has_dicom_preamble(source):
+        raise dcm.filereader.InvalidDicomError(
+            f"{getattr(source, 'name', source)} is not a dicom file."
+        )
+    return dcm.read_file(
+        source, stop_before_pixels=True, specific_tags=specific_tags
+    )
+
+
 def is_dicom(fileobj):
-    try:
-        dcm.read_file(fileobj)
-        return True
-    except dcm.filereader.InvalidDicomError:
-        return False
+    return has_dicom_preamble(fileobj)
 
 
 def make_zip(source_dir, dest_zip):
@@ -1,22 +1,63 @@
 """Module to interact with the xnat server"""
 
 import getpass
+import io
 import json
 import logging
 import os
+import random
 import re
 import tempfile
+import threading
 import time
 import urllib.parse
 from abc import ABC
 from xml.etree import ElementTree
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from datman.exceptions import ExportException, UndefinedSetting, XnatException
+from datman.xnat_async import run_concurrently
+from datman.xnat_cache import XnatCache, get_cache_path
 
 logger = logging.getLogger(__name__)
 
+# Optional config settings that tune the transport used for a connection,
+# mapped to the matching datman.xnat.xnat argument name.
+CONNECTION_SETTINGS = {
+    "XnatPoolSize": "pool_size",
+    "XnatConnectRetries": "connect_retries",
+    "XnatKeepAlive": "keep_alive",
+    "XnatChunkSize": "chunk_size",
+    "XnatRetries": "retries",
+    "XnatRetryBackoff": "retry_backoff",
+    "XnatRetryDeadline": "retry_deadline",
+    "XnatRateLimit": "rate_limit",
+    "XnatRateBurst": "rate_burst",
+    "XnatBreakerThreshold": "breaker_threshold",
+    "XnatBreakerTimeout": "breaker_timeout",
+}
+
+# Response codes that mean the server is temporarily unable to handle a
+# request, and that it's worth trying again
+RETRY_STATUSES = (502, 503, 504)
+
+# Requests using these methods can be safely repeated
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+# The columns requested when listing all experiments in a project
+EXPERIMENT_COLUMNS = [
+    "ID",
+    "label",
+    "subject_label",
+    "date",
+    "insert_date",
+    "last_modified",
+    "xsiType",
+]
+
 
 def get_server(config=None, url=None, port=None):
     if not config and not url:
@@ -113,7 +154,36 @@ def get_auth(username=None, file_path=None):
     return (username, password)
 
 
-def get_connection(config, site=None, url=None, auth=None, server_cache=None):
+def get_connection_settings(config, site=None):
+    """Find any transport settings configured for an XNAT connection.
+
+    Args:
+        config (:obj:`datman.config.config`): A study's configuration
+        site (:obj:`str`, optional): A valid site for the current study. If
+            given, site-specific settings will be searched for before
+            defaulting to study or organization wide settings.
+            Defaults to None.
+
+    Returns:
+        dict: Keyword arguments for :obj:`datman.xnat.xnat` for each of
+            the settings in CONNECTION_SETTINGS that is defined. Undefined
+            settings are left out so the connection defaults are used.
+    """
+    settings = {}
+    if not config:
+        return settings
+
+    for key, arg_name in CONNECTION_SETTINGS.items():
+        try:
+            settings[arg_name] = config.get_key(key, site=site)
+        except UndefinedSetting:
+            continue
+    return settings
+
+
+def get_connection(
+    config, site=None, url=None, auth=None, server_cache=None, stats=None
+):
     """Create (or retrieve) a connection to an XNAT server
 
     Args:
@@ -131,6 +201,21 @@ def get_connection(config, site=None, url=None, auth=None, server_cache=None):
             open XNAT connections. If given, connections will be retrieved
             from the cache as needed or added if a new URL is requested.
             Defaults to None.
+        stats (:obj:`datman.xnat_stats.RequestStats`, optional): Where to
+            record the requests made by a new connection. Defaults to None.
+
+    Connection pool size, connection retries, keep-alive behaviour and the
+    download chunk size can be tuned per server with the XnatPoolSize,
+    XnatConnectRetries, XnatKeepAlive and XnatChunkSize settings. How failed
+    requests are retried is set with XnatRetries, XnatRetryBackoff and
+    XnatRetryDeadline (see :py:class:`datman.xnat.RetryPolicy`). The request
+    rate can be limited with XnatRateLimit and XnatRateBurst, and requests
+    can be made to fail fast while the server is down with
+    XnatBreakerThreshold and XnatBreakerTimeout (see
+    :py:class:`datman.xnat.RateLimiter` and
+    :py:class:`datman.xnat.CircuitBreaker`). If
+    XnatMetadataCache is set, the connection will also keep experiment
+    metadata in a local cache (see :py:mod:`datman.xnat_cache`).
 
     Raises:
         XnatException: If a connection can't be made.
@@ -148,9 +233,10 @@ def get_connection(config, site=None, url=None, auth=None, server_cache=None):
             pass
 
     server_url = get_server(url=url)
+    settings = get_connection_settings(config, site=site)
 
     if auth:
-        connection = xnat(server_url, auth[0], auth[1])
+        connection = xnat(server_url, auth[0], auth[1], **settings)
     else:
         try:
             auth_file = config.get_key("XnatCredentials", site=site)
@@ -161,7 +247,18 @@ def get_connection(config, site=None, url=None, auth=None, server_cache=None):
                 # User probably provided metadata file name only
                 auth_file = os.path.join(config.get_path("meta"), auth_file)
         username, password = get_auth(file_path=auth_file)
-        connection = xnat(server_url, username, password)
+        connection = xnat(server_url, username, password, **settings)
+    connection.stats = stats
+
+    cache_path = get_cache_path(config, site=site)
+    if cache_path:
+        try:
+            connection.cache = XnatCache(cache_path)
+        except Exception as e:
+            logger.error(
+                f"Failed to open XNAT metadata cache {cache_path}, "
+                f"continuing without it. Reason - {e}"
+            )
 
     if server_cache is not None:
         server_cache[url] = connection
@@ -169,17 +266,497 @@ def get_connection(config, site=None, url=None, auth=None, server_cache=None):
     return connection
 
 
+class RetryPolicy(object):
+    """Decides whether, and after how long, a failed XNAT request is retried.
+
+    The delay before each retry grows exponentially and is randomized, so
+    that clients that failed together (e.g. during a burst of 502s from an
+    overloaded server) don't all retry together. Only requests that are safe
+    to repeat are retried.
+
+    Args:
+        retries (int, optional): The maximum number of times to retry a
+            request. Defaults to 3.
+        backoff (float, optional): The base delay in seconds. Retry number n
+            (starting at 0) waits a random time between 0 and
+            backoff * 2 ** n seconds. Defaults to 2.
+        max_backoff (float, optional): The longest delay to use between
+            attempts, in seconds. Defaults to 60.
+        deadline (float, optional): The maximum number of seconds to spend
+            retrying a single request. Defaults to None, in which case only
+            'retries' limits how long a request can take.
+        statuses (tuple, optional): The response codes to retry. Defaults
+            to RETRY_STATUSES.
+    """
+
+    def __init__(
+        self,
+        retries=3,
+        backoff=2.0,
+        max_backoff=60.0,
+        deadline=None,
+        statuses=RETRY_STATUSES,
+    ):
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.deadline = float(deadline) if deadline is not None else None
+        self.statuses = tuple(statuses)
+
+    def is_idempotent(self, method, idempotent=None):
+        """Check whether a request can be safely repeated.
+
+        Args:
+            method (:obj:`str`): The HTTP method of the request.
+            idempotent (bool, optional): Overrides the default for the
+                method, for requests known to be safe (or unsafe) to
+                repeat. Defaults to None.
+        """
+        if idempotent is not None:
+            return idempotent
+        return method.upper() in IDEMPOTENT_METHODS
+
+    def get_delay(self, attempt, started, retries=None):
+        """Get how long to wait before the next attempt at a request.
+
+        Args:
+            attempt (int): The number of retries already made.
+            started (float): When the first attempt was made, as given by
+                :py:func:`time.monotonic`.
+            retries (int, optional): Overrides the policy's maximum number
+                of retries. Defaults to None.
+
+        Returns:
+            float: The number of seconds to wait, or None if the request
+                should not be retried.
+        """
+        if retries is None:
+            retries = self.retries
+        if attempt >= retries:
+            return None
+
+        delay = random.uniform(
+            0, min(self.max_backoff, self.backoff * 2**attempt)
+        )
+
+        if self.deadline is not None:
+            remaining = self.deadline - (time.monotonic() - started)
+            if remaining <= delay:
+                return None
+
+        return delay
+
+    def __str__(self):
+        return (
+            f"<datman.xnat.RetryPolicy retries={self.retries} "
+            f"backoff={self.backoff} deadline={self.deadline}>"
+        )
+
+    def __repr__(self):
+        return self.__str__()
+
+
+# Rate limiters and circuit breakers, shared by all connections to a server
+_server_guards = {}
+_server_guards_lock = threading.Lock()
+
+
+def get_rate_limiter(server, rate, burst=None):
+    """Get the rate limiter shared by all of this process's connections to
+    an XNAT server, creating it if needed.
+    """
+    with _server_guards_lock:
+        key = ("rate", server)
+        if key not in _server_guards:
+            _server_guards[key] = RateLimiter(rate, burst)
+        return _server_guards[key]
+
+
+def get_circuit_breaker(server, threshold, timeout=None):
+    """Get the circuit breaker shared by all of this process's connections
+    to an XNAT server, creating it if needed.
+    """
+    with _server_guards_lock:
+        key = ("breaker", server)
+        if key not in _server_guards:
+            _server_guards[key] = CircuitBreaker(server, threshold, timeout)
+        return _server_guards[key]
+
+
+class RateLimiter(object):
+    """Limits the rate of requests sent to a server with a token bucket.
+
+    The rate is halved each time the server reports an error, down to a
+    sixteenth of the configured rate, and recovers gradually as requests
+    succeed.
+
+    Args:
+        rate (float): The average number of requests to allow per second.
+        burst (int, optional): The number of requests that can be sent at
+            once after a quiet period. Defaults to the rate (or 1 if the
+            rate is below 1 request per second).
+    """
+
+    def __init__(self, rate, burst=None):
+        self.max_rate = float(rate)
+        if self.max_rate <= 0:
+            raise ValueError(f"Invalid request rate {rate}")
+        self.rate = self.max_rate
+        self.min_rate = self.max_rate / 16
+        self.burst = float(burst or max(1, self.max_rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request can be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._updated) * self.rate,
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        """Reduce the request rate after the server reports an error."""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        """Raise the request rate back towards its limit after a success."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.min_rate)
+
+    def __str__(self):
+        return f"<datman.xnat.RateLimiter {self.rate}/{self.max_rate} per s>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to a server that appears to be down.
+
+    After 'threshold' consecutive failed requests (timeouts, dropped
+    connections or gateway errors) the breaker 'opens' and all requests fail
+    immediately for 'timeout' seconds. A single trial request is then let
+    through. If it succeeds requests resume as normal, otherwise the breaker
+    opens again. A trial that never reports back (e.g. because its thread
+    died) is given up on after another 'timeout' seconds.
+
+    Args:
+        server (:obj:`str`): The URL of the server.
+        threshold (int): The number of consecutive failures that open the
+            breaker.
+        timeout (float, optional): The number of seconds to wait before
+            trying the server again. Defaults to 30.
+    """
+
+    def __init__(self, server, threshold, timeout=None):
+        self.server = server
+        self.threshold = int(threshold)
+        self.timeout = float(timeout) if timeout is not None else 30.0
+        self._failures = 0
+        self._opened = None
+        self._trial = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened is not None
+
+    def check(self):
+        """Make sure a request may be sent.
+
+        Raises:
+            XnatException: If the breaker is open.
+        """
+        with self._lock:
+            if self._opened is None:
+                return
+            now = time.monotonic()
+            trial_running = (
+                self._trial is not None and now - self._trial < self.timeout
+            )
+            if trial_running or now - self._opened < self.timeout:
+                raise XnatException(
+                    f"XNAT server {self.server} appears to be down, not "
+                    "sending request"
+                )
+            # Let one request through to test the server
+            self._trial = now
+
+    def record_success(self):
+        with self._lock:
+            if self._opened is not None:
+                logger.info(f"XNAT server {self.server} is responding again")
+            self._failures = 0
+            self._opened = None
+            self._trial = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial is None and self._failures < self.threshold:
+                return
+            if self._opened is None:
+                logger.error(
+                    f"XNAT server {self.server} failed {self._failures} "
+                    f"requests in a row, pausing requests for "
+                    f"{self.timeout}s"
+                )
+            self._opened = time.monotonic()
+            self._trial = None
+
+    def release_trial(self):
+        """End a trial request that says nothing about the server's health.
+
+        The breaker stays open but the next request may be the new trial.
+        """
+        with self._lock:
+            self._trial = None
+
+    def __str__(self):
+        state = "open" if self.is_open else "closed"
+        return f"<datman.xnat.CircuitBreaker {self.server} {state}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class UploadStream(object):
+    """A readable stream of data to upload to XNAT.
+
+    Data is read from the source a block at a time as it's sent, so memory
+    use doesn't grow with the size of the upload, and progress is logged as
+    it goes. Because the source can be reopened, a failed upload can be
+    retried from the start.
+
+    Args:
+        opener (callable): A function that takes no arguments and returns
+            a readable binary file object positioned at the start of the
+            data. It is called again each time the upload restarts.
+        size (int): The number of bytes that will be uploaded.
+        name (:obj:`str`, optional): A name for the data to use in log
+            messages. Defaults to 'upload'.
+        callback (callable, optional): A function to call with the number of
+            bytes sent so far and the total size after each read. Defaults to
+            None.
+    """
+
+    # Log progress each time this fraction of the data is sent, for uploads
+    # of at least progress_min_size bytes
+    progress_step = 0.1
+    progress_min_size = 64 * 1024 * 1024
+
+    def __init__(self, opener, size, name="upload", callback=None):
+        self.opener = opener
+        self.size = int(size)
+        self.name = name
+        self.callback = callback
+        self._stream = None
+        self._sent = 0
+        self._logged = 0
+        self._started = None
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Stream the contents of a file."""
+        return cls(
+            lambda: open(path, "rb"),
+            os.path.getsize(path),
+            name=kwargs.pop("name", os.path.basename(path)),
+            **kwargs,
+        )
+
+    @classmethod
+    def from_zip(cls, zip_file, member, **kwargs):
+        """Stream a member of an open :obj:`zipfile.ZipFile`."""
+        return cls(
+            lambda: zip_file.open(member),
+            zip_file.getinfo(member).file_size,
+            name=kwargs.pop("name", member),
+            **kwargs,
+        )
+
+    def read(self, size=-1):
+        if self._stream is None:
+            self._stream = self.opener()
+            self._started = time.monotonic()
+        block = self._stream.read(size)
+        if block:
+            self._sent += len(block)
+            self._report_progress()
+        return block
+
+    def tell(self):
+        return self._sent
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Move to a position in the stream.
+
+        Moving backwards reopens the source and reads forward to the
+        requested position.
+        """
+        if whence == os.SEEK_CUR:
+            offset += self._sent
+        elif whence == os.SEEK_END:
+            offset += self.size
+
+        if offset < self._sent:
+            if self._sent:
+                logger.info(f"Restarting upload of {self.name}")
+            self.close()
+            self._sent = 0
+            self._logged = 0
+        while self._sent < offset:
+            if not self.read(min(offset - self._sent, 1024 * 1024)):
+                break
+        return self._sent
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def _report_progress(self):
+        if self.callback:
+            self.callback(self._sent, self.size)
+
+        if self.size < self.progress_min_size:
+            return
+        done = self._sent / self.size
+        if done - self._logged < self.progress_step and done < 1:
+            return
+        self._logged = done
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        logger.info(
+            f"Uploaded {self._sent} of {self.size} bytes of {self.name} "
+            f"({done:.0%}, {self._sent / elapsed / 1024 / 1024:.1f} MiB/s)"
+        )
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __str__(self):
+        return f"<datman.xnat.UploadStream {self.name}>"
+
+    def __repr__(self):
+        return self.__str__()
+
+
 class xnat(object):
+    """A connection to an XNAT server.
+
+    All requests share one authenticated :obj:`requests.Session`, whose
+    connection pool keeps sockets open between requests so that many small
+    queries don't each pay for a new TLS handshake. The session may be shared
+    by multiple threads, up to 'pool_size' of which can have a request in
+    flight at once.
+
+    If 'stats' is set to a :obj:`datman.xnat_stats.RequestStats` every
+    request made is recorded in it.
+
+    Args:
+        server (:obj:`str`): The full URL of the XNAT server.
+        username (:obj:`str`): The user to log in as.
+        password (:obj:`str`): The user's password.
+        pool_size (int, optional): The maximum number of connections to keep
+            open to the server. Defaults to 10.
+        connect_retries (int, optional): How many times to retry establishing
+            a connection before failing. Defaults to 3.
+        keep_alive (bool, optional): Whether to reuse connections between
+            requests. Defaults to True.
+        chunk_size (int, optional): The number of bytes to read at a time
+            when downloading files. Defaults to 1 MiB.
+        retries (int, optional): The maximum number of times to retry a
+            failed request. Defaults to 3.
+        retry_backoff (float, optional): The base delay, in seconds, between
+            retries. Defaults to 2.
+        retry_deadline (float, optional): The maximum number of seconds to
+            spend retrying a request. Defaults to None (no limit).
+        rate_limit (float, optional): The maximum average number of requests
+            per second to send to the server. Defaults to None (no limit).
+        rate_burst (int, optional): The number of requests that may be sent
+            at once when rate_limit is set. Defaults to rate_limit.
+        breaker_threshold (int, optional): The number of consecutive failed
+            requests after which requests will fail immediately for
+            breaker_timeout seconds. Defaults to None (never).
+        breaker_timeout (float, optional): How many seconds to wait before
+            retrying a server that seems to be down. Defaults to 30.
+    """
+
     server = None
     auth = None
     headers = None
     session = None
-
-    def __init__(self, server, username, password):
+    cache = None
+    pool_size = 10
+    connect_retries = 3
+    keep_alive = True
+    chunk_size = 1024 * 1024
+    retry_policy = None
+    rate_limiter = None
+    circuit_breaker = None
+    stats = None
+
+    def __init__(
+        self,
+        server,
+        username,
+        password,
+        pool_size=None,
+        connect_retries=None,
+        keep_alive=None,
+        chunk_size=None,
+        retries=None,
+        retry_backoff=None,
+        retry_deadline=None,
+        rate_limit=None,
+        rate_burst=None,
+        breaker_threshold=None,
+        breaker_timeout=None,
+    ):
         if server.endswith("/"):
             server = server[:-1]
         self.server = server
         self.auth = (username, password)
+        if pool_size is not None:
+            self.pool_size = int(pool_size)
+        if connect_retries is not None:
+            self.connect_retries = int(connect_retries)
+        if keep_alive is not None:
+            self.keep_alive = keep_alive
+        if chunk_size is not None:
+            self.chunk_size = int(chunk_size)
+        policy = {}
+        if retries is not None:
+            policy["retries"] = retries
+        if retry_backoff is not None:
+            policy["backoff"] = retry_backoff
+        if retry_deadline is not None:
+            policy["deadline"] = retry_deadline
+        self.retry_policy = RetryPolicy(**policy)
+        if rate_limit:
+            self.rate_limiter = get_rate_limiter(server, rate_limit, rate_burst)
+        if breaker_threshold:
+            self.circuit_breaker = get_circuit_breaker(
+                server, breaker_threshold, breaker_timeout
+            )
+        self._session_lock = threading.Lock()
         try:
             self.open_session()
         except Exception:
@@ -192,27 +769,56 @@ class xnat(object):
         # Ends the session on the server side
         url = f"{self.server}/data/JSESSION"
         self.session.delete(url)
+        self.session.close()
 
     def open_session(self):
-        """Open a session with the XNAT server."""
+        """Open a session with the XNAT server.
+
+        If a session already exists it is re-authenticated in place, so that
+        threads sharing the connection keep using the same connection pool.
+        """
 
         url = f"{self.server}/data/JSESSION"
 
-        s = requests.Session()
+        with self._session_lock:
+            if self.session is None:
+                s = self._make_session()
+            else:
+                s = self.session
 
-        response = s.post(url, auth=self.auth)
+            response = s.post(url, auth=self.auth)
 
-        if not response.status_code == requests.codes.ok:
-            logger.warn(
-                f"Failed connecting to xnat server {self.server} "
-                f"with response code {response.status_code}"
-            )
-            logger.debug("Username: {}")
-            response.raise_for_status()
+            if not response.status_code == requests.codes.ok:
+                logger.warn(
+                    f"Failed connecting to xnat server {self.server} "
+                    f"with response code {response.status_code}"
+                )
+                logger.debug("Username: {}")
+                response.raise_for_status()
 
-        # Cookies are set automatically, don't manually set them or it wipes
-        # out other session info
-        self.session = s
+            # Cookies are set automatically, don't manually set them or it
+            # wipes out other session info
+            self.session = s
+
+    def _make_session(self):
+        """Create a session with a connection pool sized for this server."""
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            max_retries=Retry(
+                total=self.connect_retries,
+                read=False,
+                status=False,
+                backoff_factor=0.5,
+            ),
+            pool_block=True,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+        return session
 
     def get_projects(self, project=""):
         """Query the XNAT server for project metadata.
@@ -471,6 +1077,10 @@ class xnat(object):
             :obj:`datman.xnat.XNATExperiment`: An XNATExperiment instance
                 matching the given experiment ID.
         """
+        cached = self._get_cached_experiment(project, exper_id, subject_id)
+        if cached:
+            return cached
+
         logger.debug(
             f"Querying XNAT server {self.server} for experiment {exper_id} "
             f"belonging to {subject_id} in project {project}"
@@ -506,8 +1116,206 @@ class xnat(object):
                 f"Could not access metadata for experiment {exper_id}"
             )
 
+        self._cache_experiment(project, exper_id, subject_id, exper_json)
+        return XNATExperiment(project, subject_id, exper_json)
+
+    def _get_cached_experiment(self, project, exper_id, subject_id=None):
+        if not self.cache:
+            return None
+        if subject_id and not self.cache.is_listed(
+            self.server, project, exper_id
+        ):
+            # Without a project listing, list the subject's experiments to
+            # find out if the cached copy is current. This is much smaller
+            # than the experiment itself and lets the new copy be cached.
+            try:
+                self.get_experiment_listing(project, subject=subject_id)
+            except XnatException as e:
+                logger.debug(
+                    f"Can't check cached copy of experiment {exper_id}. "
+                    f"Reason - {e}"
+                )
+                return None
+        cached = self.cache.get(self.server, project, exper_id)
+        if not cached:
+            return None
+        subject_id, exper_json = cached
         return XNATExperiment(project, subject_id, exper_json)
 
+    def _discard_cached_experiment(self, project, exper_id):
+        if self.cache:
+            self.cache.discard(self.server, project, exper_id)
+
+    def _cache_experiment(self, project, exper_id, subject_id, exper_json):
+        if not self.cache:
+            return
+        try:
+            self.cache.put(
+                self.server, project, exper_id, subject_id, exper_json
+            )
+        except Exception as e:
+            logger.warning(
+                f"Failed to cache metadata for experiment {exper_id}. "
+                f"Reason - {e}"
+            )
+
+    def get_experiment_listing(self, project, subject=""):
+        """Retrieve summary metadata for every experiment in a project.
+
+        This takes a single request, regardless of the size of the project.
+
+        Args:
+            project (:obj:`str`): An XNAT project ID.
+            subject (:obj:`str`, optional): An existing XNAT subject within
+                'project' to restrict the listing to. Defaults to ''.
+
+        Raises:
+            XnatException: If server/API access fails.
+
+        Returns:
+            list: A list of dictionaries, one per experiment, each holding
+                the fields named in EXPERIMENT_COLUMNS.
+        """
+        logger.debug(
+            f"Querying XNAT server {self.server} for all experiments in "
+            f"project {project} {subject}"
+        )
+
+        if subject:
+            subject = f"subjects/{subject}/"
+
+        url = (
+            f"{self.server}/data/projects/{project}/{subject}experiments/"
+            f"?format=json&columns={','.join(EXPERIMENT_COLUMNS)}"
+        )
+
+        try:
+            result = self._make_xnat_query(url)
+        except Exception:
+            raise XnatException(
+                f"Failed getting experiment listing for project {project} "
+                f"with URL {url}"
+            )
+
+        if not result:
+            return []
+
+        try:
+            listing = result["ResultSet"]["Result"]
+        except KeyError as e:
+            raise XnatException(
+                f"get_experiment_listing - Malformed response. {e}"
+            )
+
+        if self.cache:
+            self.cache.record_listing(self.server, project, listing)
+
+        return listing
+
+    def get_project_experiments(
+        self, project, labels=None, workers=None, listing=None
+    ):
+        """Get many (or all) experiments from an XNAT project at once.
+
+        The project's experiments are found with a single listing request
+        and their full metadata is then fetched concurrently (see
+        :py:mod:`datman.xnat_async`) over this connection's pool, instead of
+        one experiment at a time. If the connection has a metadata cache,
+        only experiments that are new or were modified since they were
+        cached are fetched.
+
+        The per-experiment requests can't be folded into the listing (or a
+        search with extra ``columns=``) because those return one flat row per
+        experiment, while :py:class:`XNATExperiment` needs the nested scan
+        and resource children (resource IDs, file content labels, resource
+        names) that only the experiment's own JSON includes.
+
+        Args:
+            project (:obj:`str`): The XNAT project to retrieve experiments
+                from.
+            labels (:obj:`list`, optional): A list of experiment names to
+                restrict the results to. Defaults to None, in which case all
+                experiments in the project are retrieved.
+            workers (int, optional): The number of experiments to request
+                at once. Defaults to the connection's pool size.
+            listing (:obj:`list`, optional): The project's experiment listing,
+                if the caller has already retrieved it with
+                :py:meth:`get_experiment_listing`. Defaults to None, in which
+                case the project is listed again.
+
+        Raises:
+            XnatException: If the project's experiments can't be listed.
+
+        Returns:
+            dict: A dictionary mapping each experiment name to a
+                :obj:`datman.xnat.XNATExperiment`. Experiments that couldn't be
+                retrieved are logged and left out.
+        """
+        if listing is None:
+            listing = self.get_experiment_listing(project)
+        if labels is not None:
+            labels = set(labels)
+            listing = [entry for entry in listing if entry["label"] in labels]
+
+        found = {}
+        if self.cache:
+            uncached = []
+            for entry in listing:
+                experiment = self._get_cached_experiment(
+                    project, entry["label"]
+                )
+                if experiment:
+                    found[experiment.name] = experiment
+                else:
+                    uncached.append(entry)
+            logger.debug(
+                f"Found {len(found)} unchanged experiments in cache for "
+                f"project {project}"
+            )
+            listing = uncached
+
+        if not listing:
+            return found
+
+        results = run_concurrently(
+            self,
+            self._get_listed_experiment,
+            [(project, entry) for entry in listing],
+            concurrency=workers,
+        )
+        for entry, result in zip(listing, results):
+            if isinstance(result, XnatException):
+                logger.error(
+                    f"Failed getting experiment {entry['label']} from "
+                    f"project {project}. Reason - {result}"
+                )
+                continue
+            if isinstance(result, BaseException):
+                raise result
+            found[result.name] = result
+        return found
+
+    def _get_listed_experiment(self, project, entry):
+        """Get an experiment using an entry from get_experiment_listing()"""
+        url = f"{self.server}/data/experiments/{entry['ID']}?format=json"
+
+        try:
+            result = self._make_xnat_query(url)
+        except Exception:
+            raise XnatException(f"Failed getting experiment with URL {url}")
+
+        try:
+            exper_json = result["items"][0]
+        except (TypeError, IndexError, KeyError):
+            raise XnatException(
+                f"Could not access metadata for experiment {entry['label']}"
+            )
+
+        self._cache_experiment(
+            project, entry["label"], entry["subject_label"], exper_json
+        )
+        return XNATExperiment(project, entry["subject_label"], exper_json)
+
     def make_experiment(self, project, subject, experiment):
         """Make a new (empty) experiment on the XNAT server.
 
@@ -524,6 +1332,7 @@ class xnat(object):
             f"{self.server}/data/archive/projects/{project}/subjects/{subject}/"
             f"experiments/{experiment}?xsiType=xnat:mrSessionData"
         )
+        self._discard_cached_experiment(project, experiment)
         try:
             self._make_xnat_put(url)
         except requests.exceptions.RequestException as e:
@@ -714,7 +1523,66 @@ class xnat(object):
 
         return items
 
-    def put_dicoms(self, project, subject, experiment, filename, retries=3):
+    def get_file_listing(self, experiment_id, resource_ids):
+        """List the files in one or more of an experiment's resource folders.
+
+        All folders are listed with a single request. Scan folders (e.g. a
+        scan's DICOM folder) may be included as well as experiment resources.
+
+        Args:
+            experiment_id (:obj:`str`): The XNAT ID (not the name) of the
+                experiment.
+            resource_ids (list): The 'xnat_abstractresource_id' of each folder
+                to list.
+
+        Raises:
+            XnatException: If the files can't be listed.
+
+        Returns:
+            list: A list of dictionaries, one per file, with the keys 'name'
+                (the file's URI on the server), 'path' (the file's path
+                within its folder), 'size', 'md5' (None if XNAT hasn't
+                stored a checksum), 'resource' (the ID of the folder the file
+                is in) and 'collection' (the folder's label).
+        """
+        if not resource_ids:
+            return []
+
+        url = (
+            f"{self.server}/data/experiments/{experiment_id}/resources/"
+            f"{','.join(resource_ids)}/files?format=json"
+        )
+        try:
+            result = self._make_xnat_query(url)
+        except Exception:
+            raise XnatException(f"Failed listing files with url: {url}")
+
+        if not result:
+            return []
+
+        files = []
+        for entry in result["ResultSet"]["Result"]:
+            cat_id = entry.get("cat_ID")
+            uri = entry.get("URI") or entry["Name"]
+            if "/files/" in uri:
+                path = urllib.parse.unquote(uri.split("/files/", 1)[1])
+            else:
+                path = entry["Name"]
+            files.append(
+                {
+                    "name": uri,
+                    "path": path,
+                    "size": int(entry.get("Size") or 0),
+                    "md5": entry.get("digest") or None,
+                    "resource": str(cat_id) if cat_id is not None else None,
+                    "collection": entry.get("collection"),
+                }
+            )
+        return files
+
+    def put_dicoms(
+        self, project, subject, experiment, filename, retries=None
+    ):
         """Upload an archive of dicoms to XNAT
         filename: archive to upload"""
         headers = {"Content-Type": "application/zip"}
@@ -724,10 +1592,19 @@ class xnat(object):
             f"&subject={subject}&session={experiment}&overwrite=delete"
             "&prearchive=false&inbody=true"
         )
+        self._discard_cached_experiment(project, experiment)
 
         try:
-            with open(filename, "rb") as data:
-                self._make_xnat_post(upload_url, data, retries, headers)
+            with UploadStream.from_file(filename) as data:
+                self._import_dicoms(
+                    upload_url,
+                    data,
+                    headers,
+                    project,
+                    subject,
+                    experiment,
+                    retries,
+                )
         except XnatException as e:
             e.study = project
             e.session = experiment
@@ -746,8 +1623,55 @@ class xnat(object):
             err.session = experiment
             raise err
 
+    def _import_dicoms(
+        self, url, data, headers, project, subject, experiment, retries=None
+    ):
+        """POST an archive to XNAT's import service.
+
+        The import isn't safe to repeat blindly. A 504 from a proxy often
+        means XNAT is still importing, and a second import would delete and
+        rewrite the session while the first runs. So only a 504 is retried,
+        once, and only if the session still doesn't exist on XNAT.
+        """
+        started = time.monotonic()
+        try:
+            self._make_xnat_post(url, data, retries, headers)
+            return
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 504:
+                raise
+            if retries is None:
+                retries = self.retry_policy.retries
+            delay = self.retry_policy.get_delay(0, started, min(retries, 1))
+            if delay is None:
+                raise
+            error = e
+
+        try:
+            imported = experiment in self.get_experiment_ids(project, subject)
+        except XnatException as e:
+            logger.error(
+                f"Can't check whether {experiment} was imported after a "
+                f"timeout, not uploading it again. Reason - {e}"
+            )
+            raise error
+        if imported:
+            logger.warning(
+                f"xnat server timed out importing {experiment}, but the "
+                "session exists so the import is not being sent again"
+            )
+            return
+
+        logger.warning(
+            f"xnat server timed out importing {experiment}, retrying in "
+            f"{delay:.1f}s"
+        )
+        time.sleep(delay)
+        data.seek(0)
+        self._make_xnat_post(url, data, retries, headers)
+
     def get_dicom(
-        self, project, session, experiment, scan, filename=None, retries=3
+        self, project, session, experiment, scan, filename=None, retries=None
     ):
         """Downloads a dicom file from xnat to filename
         If filename is not specified creates a temporary file
@@ -781,19 +1705,197 @@ class xnat(object):
             err.session = session
             raise err
 
+    def stream_dicom(
+        self,
+        project,
+        session,
+        experiment,
+        scan,
+        memory_limit=0,
+        temp_dir=None,
+        retries=None,
+    ):
+        """Download the zipped dicoms of a scan to a temporary file object.
+
+        Unlike :py:meth:`get_dicom` small archives are never written to
+        disk. If the server reports a size below memory_limit the archive is
+        held in memory, otherwise it's written to a temporary file that's
+        deleted when closed.
+
+        Args:
+            project (:obj:`str`): The XNAT project the scan belongs to.
+            session (:obj:`str`): The XNAT subject ID.
+            experiment (:obj:`str`): The XNAT experiment ID.
+            scan (:obj:`str`): The scan's ID (series number).
+            memory_limit (int, optional): The largest archive (in bytes) to
+                hold in memory. Defaults to 0.
+            temp_dir (:obj:`str`, optional): The folder to write larger
+                archives to. Defaults to the system's temp folder.
+            retries (int, optional): The number of times to retry a failed
+                request.
+
+        Raises:
+            XnatException: If the download fails or the scan has no dicoms.
+
+        Returns:
+            A seekable binary file object positioned at the start of the
+                archive. The caller must close it.
+        """
+        url = (
+            f"{self.server}/data/archive/projects/{project}/"
+            f"subjects/{session}/experiments/{experiment}/"
+            f"scans/{scan}/resources/DICOM/files?format=zip"
+        )
+        staged = []
+
+        def open_staging_file(response):
+            size = response.headers.get("Content-Length")
+            if size and int(size) < memory_limit:
+                staged.append(io.BytesIO())
+            else:
+                staged.append(
+                    tempfile.NamedTemporaryFile(
+                        prefix="dm2_xnat_extract_", dir=temp_dir
+                    )
+                )
+            return staged[0]
+
+        try:
+            found = self._stream_to_file(url, open_staging_file, retries)
+        except Exception as e:
+            for file_obj in staged:
+                file_obj.close()
+            err = XnatException(
+                f"Failed getting dicom with url: {url}. Reason - {e}"
+            )
+            err.study = project
+            err.session = session
+            raise err
+        if not found:
+            err = XnatException(f"No dicoms found at url: {url}")
+            err.study = project
+            err.session = session
+            raise err
+        staged[0].seek(0)
+        return staged[0]
+
     def put_resource(
-        self, project, subject, experiment, filename, data, folder, retries=3
+        self,
+        project,
+        subject,
+        experiment,
+        filename,
+        data,
+        folder,
+        retries=None,
+        overwrite=False,
     ):
         """
         POST a resource file to the xnat server
 
         Args:
             filename: string to store filename as
-            data: string containing data
-                (such as produced by zipfile.ZipFile.read())
+            data: the contents of the file, either as bytes (such as
+                produced by zipfile.ZipFile.read()) or as a stream. Large
+                files should be given as a :obj:`datman.xnat.UploadStream`
+                so they aren't held in memory and can be resent if the
+                upload fails.
+            overwrite (bool, optional): Whether to replace a file of the
+                same name already on XNAT. Only uploads that overwrite are
+                retried if they fail, since repeating one can't leave a
+                different result behind. Defaults to False.
+
+        """
 
+        resource_id = self._get_upload_folder(
+            project, subject, experiment, folder
+        )
+        self._put_resource_file(
+            project,
+            subject,
+            experiment,
+            resource_id,
+            filename,
+            data,
+            retries,
+            overwrite,
+        )
+
+    def put_resources(
+        self,
+        project,
+        subject,
+        experiment,
+        files,
+        folder,
+        workers=None,
+        retries=None,
+        overwrite=False,
+    ):
+        """Upload many resource files to the same experiment folder at once.
+
+        The experiment and resource folder are looked up (or created) once
+        for the whole batch, and the files are then uploaded concurrently.
+
+        Args:
+            project (:obj:`str`): The XNAT project to upload to.
+            subject (:obj:`str`): The XNAT subject the experiment belongs to.
+            experiment (:obj:`str`): The name of the experiment.
+            files (list): A list of (filename, data) tuples, where data is
+                as described for :py:meth:`put_resource`. Streams from the
+                same :obj:`zipfile.ZipFile` may be uploaded together.
+            folder (:obj:`str`): The resource folder to add the files to.
+            workers (int, optional): The number of files to upload at once.
+                Defaults to the connection's pool size.
+            retries (int, optional): Overrides the retry policy's maximum
+                number of retries for each file. Defaults to None.
+            overwrite (bool, optional): Whether to replace files already on
+                XNAT, see :py:meth:`put_resource`. Defaults to False.
+
+        Raises:
+            XnatException: If the experiment or resource folder can't be
+                found or created.
+
+        Returns:
+            list: The names of the files that were uploaded. Files that
+                failed to upload are logged and left out.
         """
+        resource_id = self._get_upload_folder(
+            project, subject, experiment, folder
+        )
+        calls = [
+            (
+                project,
+                subject,
+                experiment,
+                resource_id,
+                fname,
+                data,
+                retries,
+                overwrite,
+            )
+            for fname, data in files
+        ]
+        results = run_concurrently(
+            self, self._put_resource_file, calls, concurrency=workers
+        )
 
+        uploaded = []
+        for (fname, _), result in zip(files, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    f"Failed uploading file {fname} with error: {result}"
+                )
+                continue
+            if isinstance(result, BaseException):
+                raise result
+            uploaded.append(fname)
+        return uploaded
+
+    def _get_upload_folder(self, project, subject, experiment, folder):
+        """Get the ID of a resource folder to upload to, creating the
+        experiment and folder if needed.
+        """
         try:
             self.get_experiment(project, subject, experiment)
         except XnatException:
@@ -803,11 +1905,23 @@ class xnat(object):
             )
             self.make_experiment(project, subject, experiment)
 
-        resource_id = self.get_resource_ids(
+        return self.get_resource_ids(
             project, subject, experiment, folderName=folder
         )
 
+    def _put_resource_file(
+        self,
+        project,
+        subject,
+        experiment,
+        resource_id,
+        filename,
+        data,
+        retries=None,
+        overwrite=False,
+    ):
         uploadname = urllib.parse.quote(filename)
+        self._discard_cached_experiment(project, experiment)
 
         attach_url = (
             f"{self.server}/data/archive/projects/{project}/"
@@ -815,9 +1929,15 @@ class xnat(object):
             f"resources/{resource_id}/"
             f"files/{uploadname}?inbody=true"
         )
+        if overwrite:
+            attach_url += "&overwrite=true"
 
+        # An upload that overwrites is safe to replay from the start of
+        # the data if XNAT is briefly unavailable
         try:
-            self._make_xnat_post(attach_url, data)
+            self._make_xnat_post(
+                attach_url, data, retries, idempotent=overwrite
+            )
         except XnatException as err:
             err.study = project
             err.session = experiment
@@ -829,6 +1949,7 @@ class xnat(object):
             err = XnatException("Failed adding resource to xnat")
             err.study = project
             err.session = experiment
+            raise err
 
     def get_resource(
         self,
@@ -838,7 +1959,7 @@ class xnat(object):
         resource_group_id,
         resource_id,
         filename=None,
-        retries=3,
+        retries=None,
         zipped=True,
     ):
         """Download a single resource from xnat to filename
@@ -881,7 +2002,7 @@ class xnat(object):
         experiment,
         resource_id,
         filename=None,
-        retries=3,
+        retries=None,
     ):
         """Download a resource archive from xnat to filename
         If filename is not specified creates a temporary file and
@@ -924,16 +2045,17 @@ class xnat(object):
         experiment,
         resource_group_id,
         resource_id,
-        retries=3,
+        retries=None,
     ):
         """Delete a resource file from xnat"""
+        self._discard_cached_experiment(project, experiment)
         url = (
             f"{self.server}/data/archive/projects/{project}/"
             f"subjects/{session}/experiments/{experiment}/"
             f"resources/{resource_group_id}/files/{resource_id}"
         )
         try:
-            self._make_xnat_delete(url)
+            self._make_xnat_delete(url, retries)
         except Exception:
             raise XnatException(f"Failed deleting resource with url: {url}")
 
@@ -1027,6 +2149,7 @@ class xnat(object):
             f"/experiments/{old_name}?xsiType="
             f"xnat:mrSessionData&label={new_name}"
         )
+        self._discard_cached_experiment(project, old_name)
 
         try:
             self._make_xnat_put(url)
@@ -1059,69 +2182,410 @@ class xnat(object):
             )
             self._make_xnat_put(dismiss_url)
 
-    def _get_xnat_stream(self, url, filename, retries=3, timeout=120):
+    def _get_xnat_stream(self, url, filename, retries=None, timeout=120):
+        """Download the contents of a URL to a file.
+
+        Data is written to '<filename>.part', which is only renamed to
+        filename once the download is complete, so filename never holds
+        a partial download. If the download fails the '.part' file is kept,
+        and the next call for the same filename resumes from its end
+        instead of starting over.
+
+        Returns:
+            bool: True if the file was downloaded, False if the URL was
+                not found (in which case filename is left untouched).
+        """
         logger.debug(f"Getting {url} from XNAT")
+        part_file = filename + ".part"
+        with open(part_file, "ab") as f:
+            if f.tell():
+                logger.info(f"Resuming download of {url} from byte {f.tell()}")
+            found = self._stream_to_file(url, f, retries, timeout, start=0)
+
+        if not found:
+            self._remove_part_file(part_file)
+            return False
+
+        os.replace(part_file, filename)
+        return True
+
+    def _remove_part_file(self, part_file):
         try:
-            response = self.session.get(url, stream=True, timeout=timeout)
-        except requests.exceptions.Timeout as e:
-            if retries > 0:
-                return self._get_xnat_stream(
-                    url, filename, retries=retries - 1, timeout=timeout * 2
-                )
-            else:
-                raise e
+            os.remove(part_file)
+        except OSError:
+            pass
 
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info("Session may have expired, resetting")
-            self.open_session()
-            response = self.session.get(url, stream=True, timeout=timeout)
+    def _stream_to_file(
+        self, url, file_obj, retries=None, timeout=120, start=None
+    ):
+        """Write the contents of a URL to an open file.
 
-        if response.status_code == 404:
-            logger.info(
-                f"No records returned from xnat server for query: {url}"
+        If the transfer is interrupted it's resumed from the last byte
+        received using an HTTP range request, so that a dropped connection
+        late in a large download doesn't restart it from the beginning. If
+        the server ignores the range the download is restarted instead. A
+        response that ends before the length the server promised is treated
+        as an interruption too, since it can't be trusted to be complete.
+
+        Args:
+            url (:obj:`str`): The URL to download.
+            file_obj: An open binary file, or a function that's given the
+                first successful response and returns one (e.g. to pick
+                where to store the download based on its size).
+            start (:obj:`int`, optional): Where in file_obj the download
+                begins. Anything already written after it is treated as
+                received, and the download resumes from its end. Defaults
+                to file_obj's current position.
+
+        Returns:
+            bool: True if the contents were written, False if the URL was not
+                found.
+        """
+        open_file = None
+        if callable(file_obj):
+            open_file, file_obj = file_obj, None
+        if start is None:
+            start = file_obj.tell() if file_obj else 0
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            received = file_obj.tell() - start if file_obj else 0
+            headers = {"Range": f"bytes={received}-"} if received else None
+            response = self._request(
+                "GET",
+                url,
+                retries=retries,
+                stream=True,
+                timeout=timeout,
+                headers=headers,
             )
+
+            # The whole download, including resumes, is recorded as one
+            # request once it's finished
+            finished = True
+            error = None
+            try:
+                if response.status_code == 404:
+                    logger.info(
+                        f"No records returned from xnat server for query: {url}"
+                    )
+                    return False
+                elif response.status_code == 416 and received:
+                    # What was already received doesn't fit the file the
+                    # server has now, so it can't be resumed
+                    logger.info(f"Can't resume download of {url}, restarting")
+                    file_obj.seek(start)
+                    file_obj.truncate()
+                    finished = False
+                    continue
+                elif response.status_code not in (200, 206):
+                    logger.error(
+                        f"xnat error: {response.status_code} at data download"
+                    )
+                    response.raise_for_status()
+
+                if file_obj is None:
+                    file_obj = open_file(response)
+                    start = file_obj.tell()
+
+                if received and not self._is_resumed(response, received):
+                    logger.info(
+                        f"Server can't resume download of {url}, restarting"
+                    )
+                    file_obj.seek(start)
+                    file_obj.truncate()
+
+                expected = self._get_expected_size(response)
+                try:
+                    for chunk in response.iter_content(self.chunk_size):
+                        file_obj.write(chunk)
+                    self._check_download_size(file_obj, start, expected)
+                except (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout,
+                ) as e:
+                    delay = self.retry_policy.get_delay(
+                        attempt, started, retries
+                    )
+                    if delay is None:
+                        logger.error("Failed reading from xnat")
+                        raise e
+                    attempt += 1
+                    finished = False
+                    logger.warning(
+                        f"Download of {url} interrupted after "
+                        f"{file_obj.tell() - start} bytes, resuming in "
+                        f"{delay:.1f}s. Reason - {e}"
+                    )
+                    time.sleep(delay)
+                    continue
+                except IOError as e:
+                    logger.error("Failed writing to file")
+                    raise e
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                response.close()
+                if finished:
+                    self._record_request(
+                        "GET",
+                        url,
+                        started,
+                        attempt,
+                        response=response,
+                        received=file_obj.tell() - start if file_obj else 0,
+                        error=error,
+                    )
+
+            return True
+
+    def _get_expected_size(self, response):
+        """Find how long a download should be once a response is written.
+
+        Returns:
+            int: The number of bytes the whole download should contain, or
+                None if the server didn't say (or the body is compressed,
+                so the length sent won't match the data written).
+        """
+        if response.status_code == 206:
+            content_range = response.headers.get("Content-Range", "")
+            match = re.match(r"bytes \d+-(\d+)/(\d+|\*)", content_range)
+            if not match:
+                return None
+            if match.group(2) != "*":
+                return int(match.group(2))
+            return int(match.group(1)) + 1
+
+        if response.headers.get("Content-Encoding"):
+            return None
+        try:
+            return int(response.headers["Content-Length"])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _check_download_size(self, file_obj, start, expected):
+        """Raise an exception if a download ended short of its length.
+
+        Older versions of urllib3 don't enforce Content-Length, so a body
+        that gets cut off can otherwise look like a complete download.
+        """
+        size = file_obj.tell() - start
+        if expected is None or size == expected:
             return
-        elif response.status_code == 504:
-            if retries:
-                logger.warning("xnat server timed out, retrying")
-                time.sleep(30)
-                self._get_xnat_stream(
-                    url, filename, retries=retries - 1, timeout=timeout * 2
-                )
-            else:
-                logger.error("xnat server timed out, giving up")
-                response.raise_for_status()
-        elif response.status_code != 200:
-            logger.error(f"xnat error: {response.status_code} at data upload")
-            response.raise_for_status()
+        if size > expected:
+            # The data can't be trusted, so fetch all of it again
+            file_obj.seek(start)
+            file_obj.truncate()
+        raise requests.exceptions.ChunkedEncodingError(
+            f"Received {size} bytes, expected {expected}"
+        )
+
+    def _is_resumed(self, response, received):
+        """Check if a response continues a download from byte 'received'."""
+        if response.status_code != 206:
+            return False
+        content_range = response.headers.get("Content-Range", "")
+        return content_range.startswith(f"bytes {received}-")
+
+    def _request(self, method, url, retries=None, idempotent=None, **kwargs):
+        """Make a request to the XNAT server, retrying it if it fails.
+
+        Timeouts, failed connections and responses with one of the retry
+        policy's status codes are retried according to self.retry_policy,
+        but only if the request is safe to repeat. If the session has
+        expired it's renewed and the request is sent again.
+
+        Args:
+            method (:obj:`str`): The HTTP method to use.
+            url (:obj:`str`): The URL to send the request to.
+            retries (int, optional): Overrides the retry policy's maximum
+                number of retries. Defaults to None.
+            idempotent (bool, optional): Whether the request can be safely
+                repeated. Defaults to None, in which case this is decided by
+                the method.
+            **kwargs: Any other arguments accepted by
+                :py:meth:`requests.Session.request`.
+
+        If the connection has a rate limiter or circuit breaker the request
+        waits for (or is refused by) them before each attempt.
+
+        Raises:
+            requests.exceptions.RequestException: If the request can't be
+                sent or never gets a response.
+            XnatException: If the server's circuit breaker is open.
 
-        with open(filename, "wb") as f:
+        Returns:
+            :obj:`requests.Response`: The last response received. Error
+                responses are returned for the caller to handle.
+        """
+        data = kwargs.get("data")
+        position = data.tell() if hasattr(data, "seek") else None
+        # A body that can't be rewound can only be sent once
+        can_resend = (
+            data is None
+            or position is not None
+            or isinstance(data, (str, bytes, dict, list, tuple))
+        )
+        retryable = can_resend and self.retry_policy.is_idempotent(
+            method, idempotent
+        )
+
+        started = time.monotonic()
+        attempt = 0
+        renewed = False
+        renewing = False
+        while True:
+            if position is not None:
+                data.seek(position)
+
+            # Renewing the session is part of the same attempt, so it's
+            # covered by the breaker's earlier check
+            if self.circuit_breaker and not renewing:
+                self.circuit_breaker.check()
+            renewing = False
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+
+            # Every attempt must report its outcome to the circuit breaker,
+            # or a trial request would leave it refusing requests for good
+            reported = False
             try:
-                for chunk in response.iter_content(1024):
-                    f.write(chunk)
-            except requests.exceptions.RequestException as e:
-                logger.error("Failed reading from xnat")
-                raise (e)
-            except IOError as e:
-                logger.error("Failed writing to file")
-                raise (e)
-
-    def _make_xnat_query(self, url, retries=3):
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                ) as e:
+                    self._record_failure()
+                    reported = True
+                    delay = None
+                    if retryable:
+                        delay = self.retry_policy.get_delay(
+                            attempt, started, retries
+                        )
+                    if delay is None:
+                        logger.error(f"Failed {method} request to {url}: {e}")
+                        self._record_request(
+                            method,
+                            url,
+                            started,
+                            attempt + renewed,
+                            data=data,
+                            error=type(e).__name__,
+                        )
+                        raise e
+                    logger.warning(
+                        f"{method} request to {url} failed, retrying in "
+                        f"{delay:.1f}s. Reason - {e}"
+                    )
+                    attempt += 1
+                    time.sleep(delay)
+                    continue
+
+                if response.status_code == 401 and can_resend and not renewed:
+                    # possibly the session has timed out
+                    logger.info("Session may have expired, resetting")
+                    response.close()
+                    self.open_session()
+                    renewed = True
+                    # The outcome is reported by the repeated request
+                    renewing = True
+                    reported = True
+                    continue
+
+                if response.status_code in self.retry_policy.statuses:
+                    self._record_failure()
+                else:
+                    self._record_success()
+                reported = True
+            except requests.exceptions.RequestException:
+                if not reported:
+                    self._record_failure()
+                    reported = True
+                raise
+            finally:
+                if not reported and self.circuit_breaker:
+                    self.circuit_breaker.release_trial()
+
+            if retryable and response.status_code in self.retry_policy.statuses:
+                delay = self.retry_policy.get_delay(attempt, started, retries)
+                if delay is not None:
+                    logger.warning(
+                        f"xnat server returned {response.status_code} for "
+                        f"{url}, retrying in {delay:.1f}s"
+                    )
+                    response.close()
+                    attempt += 1
+                    time.sleep(delay)
+                    continue
+                logger.error(
+                    f"xnat server returned {response.status_code} for {url}, "
+                    "giving up"
+                )
+
+            if not kwargs.get("stream"):
+                # Streamed downloads are recorded once they're read
+                self._record_request(
+                    method,
+                    url,
+                    started,
+                    attempt + renewed,
+                    data=data,
+                    response=response,
+                )
+            return response
+
+    def _record_request(
+        self,
+        method,
+        url,
+        started,
+        retries,
+        data=None,
+        response=None,
+        received=None,
+        error=None,
+    ):
+        """Add a finished request to self.stats, if it's set."""
+        if not self.stats:
+            return
         try:
-            response = self.session.get(url, timeout=30)
-        except requests.exceptions.Timeout as e:
-            if retries > 0:
-                return self._make_xnat_query(url, retries=retries - 1)
-            else:
-                logger.error(f"Xnat server timed out getting url {url}")
-                raise e
+            sent = len(data) if data is not None else 0
+        except TypeError:
+            sent = 0
+        if received is None:
+            received = len(response.content) if response is not None else 0
+        self.stats.record(
+            method,
+            url,
+            response.status_code if response is not None else None,
+            sent=sent,
+            received=received,
+            elapsed=time.monotonic() - started,
+            retries=retries,
+            error=error,
+        )
 
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info("Session may have expired, resetting")
-            self.open_session()
-            response = self.session.get(url, timeout=30)
+    def _record_failure(self):
+        if self.circuit_breaker:
+            self.circuit_breaker.record_failure()
+        if self.rate_limiter:
+            self.rate_limiter.slow_down()
+
+    def _record_success(self):
+        if self.circuit_breaker:
+            self.circuit_breaker.record_success()
+        if self.rate_limiter:
+            self.rate_limiter.speed_up()
+
+    def _make_xnat_query(self, url, retries=None):
+        try:
+            response = self._request("GET", url, retries=retries, timeout=30)
+        except requests.exceptions.Timeout as e:
+            logger.error(f"Xnat server timed out getting url {url}")
+            raise e
 
         if response.status_code == 404:
             logger.info(
@@ -1137,20 +2601,8 @@ class xnat(object):
             response.raise_for_status()
         return response.json()
 
-    def _make_xnat_xml_query(self, url, retries=3):
-        try:
-            response = self.session.get(url, timeout=30)
-        except requests.exceptions.Timeout as e:
-            if retries > 0:
-                return self._make_xnat_xml_query(url, retries=retries - 1)
-            else:
-                raise e
-
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info("Session may have expired, resetting")
-            self.open_session()
-            response = self.session.get(url, timeout=30)
+    def _make_xnat_xml_query(self, url, retries=None):
+        response = self._request("GET", url, retries=retries, timeout=30)
 
         if response.status_code == 404:
             logger.info(f"No records returned from xnat server to query {url}")
@@ -1165,21 +2617,12 @@ class xnat(object):
         root = ElementTree.fromstring(response.content)
         return root
 
-    def _make_xnat_put(self, url, retries=3):
-        if retries == 0:
-            logger.info(f"Timed out making xnat put {url}")
-            requests.exceptions.HTTPError()
-
+    def _make_xnat_put(self, url, retries=None):
         try:
-            response = self.session.put(url, timeout=30)
-        except requests.exceptions.Timeout:
-            return self._make_xnat_put(url, retries=retries - 1)
-
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info("Session may have expired, resetting")
-            self.open_session()
-            response = self.session.put(url, timeout=30)
+            response = self._request("PUT", url, retries=retries, timeout=30)
+        except requests.exceptions.Timeout as e:
+            logger.info(f"Timed out making xnat put {url}")
+            raise e
 
         if response.status_code not in [200, 201]:
             logger.warn(
@@ -1187,29 +2630,30 @@ class xnat(object):
             )
             response.raise_for_status()
 
-    def _make_xnat_post(self, url, data, retries=3, headers=None):
-        logger.debug(f"POSTing data to xnat, {retries} retries left")
-        response = self.session.post(
-            url, headers=headers, data=data, timeout=60 * 60
+    def _make_xnat_post(
+        self, url, data, retries=None, headers=None, idempotent=False
+    ):
+        """POST data to XNAT.
+
+        POST requests are only retried if 'idempotent' is True, since
+        repeating one that reached the server could duplicate its effects.
+        """
+        logger.debug(f"POSTing data to xnat {url}")
+        response = self._request(
+            "POST",
+            url,
+            retries=retries,
+            idempotent=idempotent,
+            headers=headers,
+            data=data,
+            timeout=60 * 60,
         )
 
         reply = str(response.content)
 
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info("Session may have expired, resetting")
-            self.open_session()
-            response = self.session.post(url, headers=headers, data=data)
-
         if response.status_code == 504:
-            if retries:
-                logger.warning("xnat server timed out, retrying")
-                time.sleep(30)
-                self._make_xnat_post(url, data, retries=retries - 1)
-            else:
-                logger.warn("xnat server timed out, giving up")
-                response.raise_for_status()
-
+            logger.warn("xnat server timed out, giving up")
+            response.raise_for_status()
         elif response.status_code != 200:
             if "multiple imaging sessions." in reply:
                 raise XnatException("Multiple imaging sessions in archive,"
@@ -1225,17 +2669,8 @@ class xnat(object):
                                     f"reason: {reply}")
         return reply
 
-    def _make_xnat_delete(self, url, retries=3):
-        try:
-            response = self.session.delete(url, timeout=30)
-        except requests.exceptions.Timeout:
-            return self._make_xnat_delete(url, retries=retries - 1)
-
-        if response.status_code == 401:
-            # possibly the session has timed out
-            logger.info("Session may have expired, resetting")
-            self.open_session()
-            response = self.session.delete(url, timeout=30)
+    def _make_xnat_delete(self, url, retries=None):
+        response = self._request("DELETE", url, retries=retries, timeout=30)
 
         if response.status_code not in [200, 201]:
             logger.warn(
@@ -1251,23 +2686,43 @@ class xnat(object):
 
 
 class XNATObject(ABC):
-    def _get_field(self, key):
-        if not self.raw_json.get("data_fields"):
+    """Base class for objects read from XNAT's JSON.
+
+    Only the fields datman uses are kept, in slots rather than a __dict__,
+    and the JSON itself is discarded once it has been parsed. This keeps
+    memory use down when the metadata for a whole project is held at once.
+    """
+
+    __slots__ = ()
+
+    @staticmethod
+    def _get_field(xnat_json, key):
+        if not xnat_json.get("data_fields"):
             return ""
-        return self.raw_json["data_fields"].get(key, "")
+        return xnat_json["data_fields"].get(key, "")
 
 
 class XNATSubject(XNATObject):
+    __slots__ = ("name", "project", "_children", "_experiments")
+
     def __init__(self, subject_json):
-        self.raw_json = subject_json
-        self.name = self._get_field("label")
-        self.project = self._get_field("project")
-        self.experiments = self._get_experiments()
+        self.name = self._get_field(subject_json, "label")
+        self.project = self._get_field(subject_json, "project")
+        # Experiments are only parsed if they're used
+        self._children = subject_json.get("children", [])
+        self._experiments = None
+
+    @property
+    def experiments(self):
+        if self._experiments is None:
+            self._experiments = self._get_experiments()
+            self._children = None
+        return self._experiments
 
     def _get_experiments(self):
         experiments = [
             exp
-            for exp in self.raw_json["children"]
+            for exp in self._children
             if exp["field"] == "experiments/experiment"
         ]
 
@@ -1290,126 +2745,122 @@ class XNATSubject(XNATObject):
 
 
 class XNATExperiment(XNATObject):
+    """An XNAT experiment (scan session).
+
+    The experiment's scans and resources are read from its JSON the first
+    time any of them are used, all in one pass, after which the JSON is
+    dropped.
+    """
+
+    __slots__ = (
+        "project",
+        "subject",
+        "uid",
+        "id",
+        "name",
+        "date",
+        "_children",
+        "_scans",
+        "_scan_UIDs",
+        "_scan_resource_IDs",
+        "_resource_files",
+        "_resource_IDs",
+        "_misc_resource_IDs",
+    )
+
     def __init__(self, project, subject_name, experiment_json):
-        self.raw_json = experiment_json
         self.project = project
         self.subject = subject_name
-        self.uid = self._get_field("UID")
-        self.id = self._get_field("ID")
-        self.name = self._get_field("label")
-        self.date = self._get_field("date")
-
-        # Scan attributes
-        self.scans = self._get_scans()
-        self.scan_UIDs = self._get_scan_UIDs()
-        self.scan_resource_IDs = self._get_scan_rIDs()
+        self.uid = self._get_field(experiment_json, "UID")
+        self.id = self._get_field(experiment_json, "ID")
+        self.name = self._get_field(experiment_json, "label")
+        self.date = self._get_field(experiment_json, "date")
+        self._children = experiment_json.get("children", [])
+        self._scans = None
+
+    @property
+    def scans(self):
+        self._read_children()
+        return self._scans
+
+    @property
+    def scan_UIDs(self):
+        self._read_children()
+        return self._scan_UIDs
+
+    @property
+    def scan_resource_IDs(self):
+        # These can be used to download a series from xnat
+        self._read_children()
+        return self._scan_resource_IDs
 
-        # Resource attributes
-        self.resource_files = self._get_contents("resources/resource")
-        self.resource_IDs = self._get_resource_IDs()
+    @property
+    def resource_files(self):
+        self._read_children()
+        return self._resource_files
 
-        # Misc - basically just OPT CU1 needs this
-        self.misc_resource_IDs = self._get_other_resource_IDs()
+    @property
+    def resource_IDs(self):
+        self._read_children()
+        return self._resource_IDs
 
-    def _get_contents(self, data_type):
-        children = self.raw_json.get("children", [])
+    @property
+    def misc_resource_IDs(self):
+        """
+        OPT's CU site uploads niftis to their server. These niftis are neither
+        classified as resources nor as scans so our code misses them entirely.
+        This holds the abstractresource_id for these and any other unique
+        files aside from snapshots so they can be downloaded
+        """
+        self._read_children()
+        return self._misc_resource_IDs
 
-        contents = [
-            child["items"] for child in children if child["field"] == data_type
-        ]
-        return contents
+    def _read_children(self):
+        if self._scans is not None:
+            return
 
-    def _get_scans(self):
         scans = self._get_contents("scans/scan")
         if not scans:
             logger.debug(f"No scans found for experiment {self.name}")
-            return scans
-        xnat_scans = []
-        for scan_json in scans[0]:
-            xnat_scans.append(
+            xnat_scans = []
+        else:
+            xnat_scans = [
                 XNATScan(self.project, self.subject, self.name, scan_json)
-            )
-        return xnat_scans
+                for scan_json in scans[0]
+            ]
 
-    def _get_scan_UIDs(self):
-        return [scan.uid for scan in self.scans]
+        self._resource_files = self._get_contents("resources/resource")
+        self._resource_IDs = self._get_resource_IDs()
+        self._scan_UIDs = [scan.uid for scan in xnat_scans]
+        self._scan_resource_IDs = [
+            r_id for scan in xnat_scans for r_id in scan.dicom_resource_IDs
+        ]
+        self._misc_resource_IDs = [
+            r_id for scan in xnat_scans for r_id in scan.other_resource_IDs
+        ]
+        self._scans = xnat_scans
+        self._children = None
 
-    def _get_scan_rIDs(self):
-        # These can be used to download a series from xnat
-        resource_ids = []
-        for scan in self.scans:
-            for child in scan.raw_json["children"]:
-                if child["field"] != "file":
-                    continue
-                for item in child["items"]:
-                    try:
-                        label = item["data_fields"]["label"]
-                    except KeyError:
-                        continue
-                    if label != "DICOM":
-                        continue
-                    r_id = item["data_fields"]["xnat_abstractresource_id"]
-                    resource_ids.append(str(r_id))
-        return resource_ids
+    def _get_contents(self, data_type):
+        contents = [
+            child["items"]
+            for child in self._children
+            if child["field"] == data_type
+        ]
+        return contents
 
     def _get_resource_IDs(self):
-        if not self.resource_files:
+        if not self._resource_files:
             return {}
 
         resource_ids = {}
-        for resource in self.resource_files[0]:
+        for resource in self._resource_files[0]:
             label = resource["data_fields"].get("label", "No Label")
             resource_ids[label] = str(
                 resource["data_fields"]["xnat_abstractresource_id"]
             )
         return resource_ids
 
-    def _get_other_resource_IDs(self):
-        """
-        OPT's CU site uploads niftis to their server. These niftis are neither
-        classified as resources nor as scans so our code misses them entirely.
-        This functions grabs the abstractresource_id for these and
-        any other unique files aside from snapshots so they can be downloaded
-        """
-        r_ids = []
-        for scan in self.scans:
-            for child in scan.raw_json["children"]:
-                for file_upload in child["items"]:
-                    data_fields = file_upload["data_fields"]
-                    try:
-                        label = data_fields["label"]
-                    except KeyError:
-                        # Some entries don't have labels. Only hold some header
-                        # values. These are safe to ignore
-                        continue
-
-                    try:
-                        data_format = data_fields["format"]
-                    except KeyError:
-                        # Some entries have labels but no format... or neither
-                        if not label:
-                            # If neither, ignore. Should just be an entry
-                            # containing scan parameters, etc.
-                            continue
-                        data_format = label
-
-                    try:
-                        r_id = str(data_fields["xnat_abstractresource_id"])
-                    except KeyError:
-                        # Some entries have labels and/or a format but no
-                        # actual files and so no resource id. These can also be
-                        # safely ignored.
-                        continue
-
-                    # ignore DICOM, it's grabbed elsewhere. Ignore snapshots
-                    # entirely. Some things may not be labelled DICOM but may
-                    # be format 'DICOM' so that needs to be checked for too.
-                    if label != "DICOM" and (
-                        data_format != "DICOM" and label != "SNAPSHOTS"
-                    ):
-                        r_ids.append(r_id)
-        return r_ids
-
     def get_autorun_ids(self, xnat):
         """Find the ID(s) of the 'autorun.xml' workflow
 
@@ -1478,7 +2929,9 @@ class XNATExperiment(XNATObject):
         )  # noqa: E501
 
         query_url = f"{xnat.server}/data/search?format=json"
-        response = xnat._make_xnat_post(query_url, data=query_xml)
+        response = xnat._make_xnat_post(
+            query_url, data=query_xml, idempotent=True
+        )
 
         if not response:
             raise XnatException("AutoRun.xml pipeline not found.")
@@ -1501,15 +2954,87 @@ class XNATExperiment(XNATObject):
         """
         Returns a list of all resource URIs from this session.
         """
-        resources = []
-        resource_ids = list(self.resource_IDs.values())
-        resource_ids.extend(self.misc_resource_IDs)
-        for r_id in resource_ids:
-            resource_list = xnat_connection.get_resource_list(
-                self.project, self.subject, self.name, r_id
+        return [
+            urllib.parse.quote(item["path"])
+            for item in self.get_resource_files(xnat_connection)
+        ]
+
+    def get_resource_files(self, xnat, resource_ids=None):
+        """List the files in this session's (non-dicom) resource folders.
+
+        All folders are listed with a single request. If the server can't
+        list them together each folder is listed separately, concurrently.
+
+        Args:
+            xnat (:obj:`datman.xnat.xnat`): A connection to the XNAT server
+                this experiment belongs to.
+            resource_ids (list, optional): The IDs of the folders to list.
+                Defaults to all resource folders, including the
+                misc_resource_IDs.
+
+        Raises:
+            XnatException: If the files can't be listed.
+
+        Returns:
+            list: A list of file dictionaries as given by
+                :py:meth:`datman.xnat.xnat.get_file_listing`.
+        """
+        if resource_ids is None:
+            resource_ids = list(self.resource_IDs.values())
+            resource_ids.extend(self.misc_resource_IDs)
+
+        try:
+            return xnat.get_file_listing(self.id, resource_ids)
+        except XnatException as e:
+            if len(resource_ids) < 2:
+                raise e
+            logger.info(
+                f"Failed listing resources for {self.name} together, "
+                f"listing them separately. Reason - {e}"
             )
-            resources.extend([item["URI"] for item in resource_list])
-        return resources
+
+        results = run_concurrently(
+            xnat,
+            xnat.get_file_listing,
+            [(self.id, [r_id]) for r_id in resource_ids],
+        )
+        files = []
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+            files.extend(result)
+        return files
+
+    def get_file_manifest(self, xnat):
+        """List the name, size and checksum of every file in this session.
+
+        Scan DICOM files and other resources are listed with a single
+        request. Snapshots are left out.
+
+        Args:
+            xnat (:obj:`datman.xnat.xnat`): A connection to the XNAT server
+                this experiment belongs to.
+
+        Returns:
+            dict: A dictionary with the keys 'dicoms' and 'resources', each
+                holding a list of file dictionaries as given by
+                :py:meth:`datman.xnat.xnat.get_file_listing`.
+        """
+        resource_ids = list(self.scan_resource_IDs)
+        resource_ids.extend(self.misc_resource_IDs)
+        resource_ids.extend(self.resource_IDs.values())
+
+        manifest = {"dicoms": [], "resources": []}
+        for entry in xnat.get_file_listing(self.id, resource_ids):
+            if entry["resource"] is None:
+                is_dicom = entry["collection"] == "DICOM"
+            else:
+                is_dicom = entry["resource"] in self.scan_resource_IDs
+            if is_dicom:
+                manifest["dicoms"].append(entry)
+            else:
+                manifest["resources"].append(entry)
+        return manifest
 
     def download(self, xnat, dest_folder, zip_name=None):
         """
@@ -1561,26 +3086,41 @@ class XNATExperiment(XNATObject):
 
 
 class XNATScan(XNATObject):
+    __slots__ = (
+        "project",
+        "subject",
+        "experiment",
+        "uid",
+        "series",
+        "image_type",
+        "multiecho",
+        "description",
+        "dicom_resource_IDs",
+        "other_resource_IDs",
+        "tags",
+        "names",
+        "echo_dict",
+        "_raw_dicoms",
+    )
+
     def __init__(self, project, subject_name, experiment_name, scan_json):
-        self.raw_json = scan_json
         self.project = project
         self.subject = subject_name
         self.experiment = experiment_name
-        self.uid = self._get_field("UID")
-        self.series = self._get_field("ID")
-        self.image_type = self._get_field("parameters/imageType")
-        self.multiecho = self.is_multiecho()
-        self.description = self._set_description()
-
-    def _set_description(self):
-        series_descr = self._get_field("series_description")
-        if series_descr:
-            return series_descr
-        return self._get_field("type")
-
-    def is_multiecho(self):
+        self.uid = self._get_field(scan_json, "UID")
+        self.series = self._get_field(scan_json, "ID")
+        self.image_type = self._get_field(scan_json, "parameters/imageType")
+        self.description = self._get_field(
+            scan_json, "series_description"
+        ) or self._get_field(scan_json, "type")
+
+        children = scan_json.get("children", [])
+        self.multiecho = self._is_multiecho(children)
+        self._read_files(children)
+
+    def _is_multiecho(self, children):
         try:
-            child = self.raw_json["children"][0]["items"][0]
+            child = children[0]["items"][0]
         except (KeyError, IndexError):
             return False
         name = child["data_fields"].get("name")
@@ -1588,13 +3128,61 @@ class XNATScan(XNATObject):
             return True
         return False
 
+    def _read_files(self, children):
+        """Find the scan's resource folders and whether it has raw dicoms."""
+        self._raw_dicoms = False
+        self.dicom_resource_IDs = []
+        self.other_resource_IDs = []
+        for child in children:
+            for file_upload in child["items"]:
+                data_fields = file_upload["data_fields"]
+                if data_fields.get("content") == "RAW":
+                    self._raw_dicoms = True
+
+                try:
+                    label = data_fields["label"]
+                except KeyError:
+                    # Some entries don't have labels. Only hold some header
+                    # values. These are safe to ignore
+                    continue
+
+                if child["field"] == "file" and label == "DICOM":
+                    # These can be used to download a series from xnat
+                    self.dicom_resource_IDs.append(
+                        str(data_fields["xnat_abstractresource_id"])
+                    )
+
+                try:
+                    data_format = data_fields["format"]
+                except KeyError:
+                    # Some entries have labels but no format... or neither
+                    if not label:
+                        # If neither, ignore. Should just be an entry
+                        # containing scan parameters, etc.
+                        continue
+                    data_format = label
+
+                try:
+                    r_id = str(data_fields["xnat_abstractresource_id"])
+                except KeyError:
+                    # Some entries have labels and/or a format but no
+                    # actual files and so no resource id. These can also be
+                    # safely ignored.
+                    continue
+
+                # ignore DICOM, it's grabbed elsewhere. Ignore snapshots
+                # entirely. Some things may not be labelled DICOM but may
+                # be format 'DICOM' so that needs to be checked for too.
+                if label != "DICOM" and (
+                    data_format != "DICOM" and label != "SNAPSHOTS"
+                ):
+                    self.other_resource_IDs.append(r_id)
+
+    def is_multiecho(self):
+        return self.multiecho
+
     def raw_dicoms_exist(self):
-        for child in self.raw_json["children"]:
-            for item in child["items"]:
-                file_type = item["data_fields"].get("content")
-                if file_type == "RAW":
-                    return True
-        return False
+        return self._raw_dicoms
 
     def is_derived(self):
         if not self.image_type:
@@ -0,0 +1,194 @@
+"""An asyncio interface to an XNAT server.
+
+:py:class:`AsyncXnat` wraps an existing :py:class:`datman.xnat.xnat`
+connection so that coroutines can issue many XNAT requests at once, for
+example:
+
+    async with AsyncXnat(connection, concurrency=50) as client:
+        experiments = await asyncio.gather(*[
+            client.get_experiment(project, subject, exp)
+            for subject, exp in sessions
+        ])
+
+Requests are run on a private thread pool over the connection's shared
+session, so they reuse its pooled connections, authentication and retry
+handling. An :py:class:`asyncio.Semaphore` limits how many may be in flight
+at once.
+
+Synchronous code (including the bulk methods of
+:py:class:`datman.xnat.xnat`) makes many calls at once through
+:py:func:`run_concurrently`, which runs an :py:class:`AsyncXnat` client on
+an event loop of its own.
+"""
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def run_concurrently(connection, func, calls, concurrency=None):
+    """Run many blocking XNAT calls concurrently from synchronous code.
+
+    The calls are made by an :py:class:`AsyncXnat` client on a new event
+    loop in a separate thread, so this is safe to use whether or not the
+    calling thread already has an event loop running.
+
+    Args:
+        connection (:obj:`datman.xnat.xnat`): The XNAT connection the calls
+            will use.
+        func (callable): The function to call.
+        calls (list): A list of argument tuples, one per call to make.
+        concurrency (int, optional): The maximum number of calls to run at
+            once. Defaults to the connection's pool size.
+
+    Returns:
+        list: The result of each call, in the same order as 'calls'. If a
+            call raised an exception the exception is returned in place of
+            its result.
+    """
+    if not calls:
+        return []
+
+    async def run_all():
+        async with AsyncXnat(connection, concurrency) as client:
+            return await client.call_many(func, calls)
+
+    with ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="xnat_loop"
+    ) as loop_thread:
+        return loop_thread.submit(asyncio.run, run_all()).result()
+
+
+class AsyncXnat(object):
+    """Makes requests to an XNAT server from asyncio code.
+
+    Args:
+        connection (:obj:`datman.xnat.xnat`): An open connection to the XNAT
+            server.
+        concurrency (int, optional): The maximum number of requests to have
+            in flight at once. Defaults to the connection's pool size.
+    """
+
+    def __init__(self, connection, concurrency=None):
+        self.connection = connection
+        self.concurrency = concurrency or connection.pool_size
+        self._semaphore = None
+        self._executor = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        executor, self._executor = self._executor, None
+        if executor:
+            # Wait for the threads to finish without blocking the event loop
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, executor.shutdown)
+
+    def close(self):
+        """Shut down the threads used to run requests.
+
+        This blocks until any running requests finish, so shouldn't be called
+        from a coroutine. Use 'async with' instead.
+        """
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def call(self, func, *args, **kwargs):
+        """Run a blocking function without blocking the event loop.
+
+        Args:
+            func (callable): The function to run. Usually a method of the
+                wrapped connection.
+            *args: Positional arguments to pass to func.
+            **kwargs: Keyword arguments to pass to func.
+
+        Returns:
+            The result of func.
+        """
+        if self._semaphore is None:
+            # Must be made here so it belongs to the running event loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.concurrency, thread_name_prefix="xnat"
+            )
+
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs)
+            )
+
+    async def call_many(self, func, calls):
+        """Run a blocking function once for each set of arguments given.
+
+        Args:
+            func (callable): The function to run.
+            calls (list): A list of argument tuples, one per call to make.
+
+        Returns:
+            list: The result of each call, in the same order as 'calls'.
+                Exceptions raised by a call are returned in place of its
+                result.
+        """
+        return await asyncio.gather(
+            *[self.call(func, *args) for args in calls],
+            return_exceptions=True,
+        )
+
+    async def get_experiment(self, project, subject_id, exper_id, **kwargs):
+        """See :py:meth:`datman.xnat.xnat.get_experiment`"""
+        return await self.call(
+            self.connection.get_experiment,
+            project,
+            subject_id,
+            exper_id,
+            **kwargs,
+        )
+
+    async def get_resource_list(self, study, session, experiment, resource_id):
+        """See :py:meth:`datman.xnat.xnat.get_resource_list`"""
+        return await self.call(
+            self.connection.get_resource_list,
+            study,
+            session,
+            experiment,
+            resource_id,
+        )
+
+    async def get_dicom(self, project, session, experiment, scan, **kwargs):
+        """See :py:meth:`datman.xnat.xnat.get_dicom`"""
+        return await self.call(
+            self.connection.get_dicom,
+            project,
+            session,
+            experiment,
+            scan,
+            **kwargs,
+        )
+
+    async def put_resource(
+        self, project, subject, experiment, filename, data, folder, **kwargs
+    ):
+        """See :py:meth:`datman.xnat.xnat.put_resource`"""
+        return await self.call(
+            self.connection.put_resource,
+            project,
+            subject,
+            experiment,
+            filename,
+            data,
+            folder,
+            **kwargs,
+        )
+
+    def __str__(self):
+        return f"<datman.xnat_async.AsyncXnat {self.connection.server}>"
+
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,150 @@
+"""A local, on-disk cache of XNAT experiment metadata.
+
+The cache lets unchanged experiments be read from disk instead of the XNAT
+server. An experiment is only read from the cache after a project (or
+subject) listing (see :py:meth:`datman.xnat.xnat.get_experiment_listing`)
+has shown that its modification date on the server still matches the one
+stored with it.
+
+Setting 'XnatMetadataCache' turns the cache on (see
+:py:func:`datman.utils.get_meta_file_setting` for the values it takes).
+Entries are keyed by server and project, so a single database given as a
+full path can be shared by every study.
+"""
+
+import json
+import logging
+
+from datman.utils import SqliteCache, get_meta_file_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_NAME = "xnat_cache.sqlite"
+
+
+def get_cache_path(config, site=None):
+    """Find the metadata cache file configured for a study (or site).
+
+    Args:
+        config (:obj:`datman.config.config`): A study's configuration
+        site (:obj:`str`, optional): A valid site for the current study.
+            Defaults to None.
+
+    Returns:
+        str: The full path to the cache file, or None if the cache has not
+            been enabled.
+    """
+    return get_meta_file_setting(
+        config, "XnatMetadataCache", DEFAULT_CACHE_NAME, site=site
+    )
+
+
+def get_stamp(listing_entry):
+    """Get a timestamp that changes whenever an experiment is modified."""
+    return listing_entry.get("last_modified") or listing_entry.get(
+        "insert_date"
+    )
+
+
+class XnatCache(SqliteCache):
+    """Stores experiment metadata from XNAT servers in an sqlite database.
+
+    Entries are keyed by server, project and experiment name. Each one is
+    saved with the experiment's modification date as reported by XNAT's
+    experiment listing, and is only returned while the most recently seen
+    listing still reports the same date. Experiments that haven't been
+    seen in a listing during the current run are never read from the cache.
+
+    The cache may be shared by multiple threads and processes.
+
+    Args:
+        path (:obj:`str`): The full path to the cache database. It will be
+            created if it doesn't exist.
+    """
+
+    def __init__(self, path):
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS experiments ("
+            "server TEXT, project TEXT, label TEXT, stamp TEXT, "
+            "subject TEXT, metadata TEXT, "
+            "PRIMARY KEY (server, project, label))",
+        )
+        self._stamps = {}
+
+    def record_listing(self, server, project, listing):
+        """Note the current modification dates of a project's experiments.
+
+        Args:
+            server (:obj:`str`): The URL of the XNAT server.
+            project (:obj:`str`): The XNAT project the listing is for.
+            listing (list): Entries from an XNAT experiment listing. Each
+                must contain a 'label' and at least one of 'last_modified'
+                or 'insert_date'.
+        """
+        with self._lock:
+            for entry in listing:
+                key = (server, project, entry.get("label"))
+                self._stamps[key] = get_stamp(entry)
+
+    def is_listed(self, server, project, label):
+        """Check whether an experiment has been seen in a listing this run."""
+        with self._lock:
+            return (server, project, label) in self._stamps
+
+    def get(self, server, project, label):
+        """Retrieve an experiment's metadata, if it is unchanged on XNAT.
+
+        Returns:
+            tuple: The subject name and experiment JSON stored for the
+                experiment, or None if it isn't cached or may be out of date.
+        """
+        stamp = self._stamps.get((server, project, label))
+        if not stamp:
+            return None
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT stamp, subject, metadata FROM experiments "
+                "WHERE server = ? AND project = ? AND label = ?",
+                (server, project, label),
+            ).fetchone()
+
+        if not row or row[0] != stamp:
+            return None
+
+        logger.debug(f"Using cached metadata for experiment {label}")
+        return row[1], json.loads(row[2])
+
+    def put(self, server, project, label, subject, exper_json):
+        """Store an experiment's metadata.
+
+        Nothing is stored if the experiment's modification date is unknown,
+        since the entry could never be safely used.
+        """
+        stamp = self._stamps.get((server, project, label))
+        if not stamp:
+            return
+
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO experiments VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    server,
+                    project,
+                    label,
+                    stamp,
+                    subject,
+                    json.dumps(exper_json),
+                ),
+            )
+
+    def discard(self, server, project, label):
+        """Stop using the cached entry for an experiment during this run.
+
+        This should be called whenever an experiment is modified, since its
+        new modification date won't be known until the project is listed
+        again.
+        """
+        with self._lock:
+            self._stamps.pop((server, project, label), None)
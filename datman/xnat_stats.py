@@ -0,0 +1,285 @@
+"""Records the requests made to XNAT servers, to find out which are slow.
+
+When a :py:class:`RequestStats` is assigned to a connection's ``stats``
+attribute (or passed to :py:func:`datman.xnat.get_connection`) every request
+the connection makes is recorded with its method, endpoint, status, bytes
+sent and received, latency and number of retries. A summary can be logged
+at the end of a run:
+
+    stats = RequestStats(log_file="requests.jsonl")
+    xnat = datman.xnat.get_connection(config, stats=stats)
+    ...
+    logger.info(stats.report())
+
+If a log file is given each request is also appended to it as a line of
+JSON, so that the requests of several processes can be combined (see
+:py:func:`read_log`) or analyzed later.
+
+Requests are grouped by endpoint, which is the request's path with the
+IDs of projects, subjects, experiments, etc. replaced by '*'. For example,
+'/data/projects/SPINS/experiments/?format=json' belongs to the endpoint
+'projects/*/experiments'.
+"""
+
+import json
+import logging
+import math
+import threading
+import time
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+# Path elements that are followed by the ID of an object
+ID_COLLECTIONS = (
+    "projects",
+    "subjects",
+    "subject_ids",
+    "experiments",
+    "exper_ids",
+    "scans",
+    "resources",
+    "workflows",
+)
+
+
+def get_endpoint(url):
+    """Find the endpoint a request URL is for.
+
+    Args:
+        url (:obj:`str`): The full URL of a request.
+
+    Returns:
+        str: The URL's path with the server, query, '/data' (or '/REST')
+            and '/archive' prefixes removed and any IDs replaced by '*'.
+    """
+    parts = [p for p in urllib.parse.urlsplit(url).path.split("/") if p]
+    if parts and parts[0] in ("data", "REST"):
+        parts = parts[1:]
+    if parts and parts[0] == "archive":
+        parts = parts[1:]
+
+    endpoint = []
+    previous = None
+    for part in parts:
+        if previous == "files":
+            # File names may contain any number of path elements
+            endpoint.append("*")
+            break
+        endpoint.append("*" if previous in ID_COLLECTIONS else part)
+        previous = part
+    return "/".join(endpoint) or "/"
+
+
+def read_log(path):
+    """Read the records from a request log.
+
+    Args:
+        path (:obj:`str`): The full path to a JSON lines file written by
+            :py:class:`RequestStats`.
+
+    Returns:
+        list: A list of request records (dictionaries). Lines that can't
+            be read are skipped.
+    """
+    records = []
+    with open(path, "r") as log:
+        for line in log:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.debug(f"Skipping malformed line in {path}: {line}")
+    return records
+
+
+def percentile(values, percent):
+    """Find a percentile of a list of numbers using the nearest rank.
+
+    Returns:
+        The value below which 'percent' percent of the values fall, or None
+            if values is empty.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def format_size(num_bytes):
+    """Format a number of bytes for humans (e.g. '1.5 MiB')."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(num_bytes) < 1024 or unit == "GiB":
+            break
+        num_bytes /= 1024
+    if unit == "B":
+        return f"{int(num_bytes)} B"
+    return f"{num_bytes:.1f} {unit}"
+
+
+class RequestStats(object):
+    """Collects timing information about requests to XNAT.
+
+    A single instance may be shared by several connections and threads.
+
+    Args:
+        log_file (:obj:`str`, optional): The full path to a file to append
+            each request to as a line of JSON. Defaults to None.
+    """
+
+    def __init__(self, log_file=None):
+        self.log_file = log_file
+        self.records = []
+        self._lock = threading.Lock()
+        self._log = open(log_file, "a") if log_file else None
+
+    def record(
+        self,
+        method,
+        url,
+        status,
+        sent=0,
+        received=0,
+        elapsed=0.0,
+        retries=0,
+        error=None,
+    ):
+        """Record a finished request.
+
+        Args:
+            method (:obj:`str`): The HTTP method used.
+            url (:obj:`str`): The URL requested.
+            status (int): The final status code, or None if no response was
+                received.
+            sent (int, optional): The number of bytes uploaded.
+            received (int, optional): The number of bytes downloaded.
+            elapsed (float, optional): The number of seconds taken, including
+                any retries.
+            retries (int, optional): The number of times the request was
+                repeated.
+            error (:obj:`str`, optional): The name of the exception that
+                ended the request, if any.
+        """
+        entry = {
+            "time": time.time(),
+            "method": method,
+            "endpoint": get_endpoint(url),
+            "url": url,
+            "status": status,
+            "sent": sent,
+            "received": received,
+            "elapsed": round(elapsed, 6),
+            "retries": retries,
+            "error": error,
+        }
+        with self._lock:
+            self.records.append(entry)
+            if self._log:
+                self._log.write(json.dumps(entry) + "\n")
+                self._log.flush()
+
+    def summarize(self, records=None):
+        """Summarize requests by method and endpoint.
+
+        Args:
+            records (list, optional): The records to summarize. Defaults to
+                the requests recorded by this instance.
+
+        Returns:
+            list: One dictionary per method and endpoint, slowest (by total
+                time spent) first, with the keys 'method', 'endpoint',
+                'count', 'failed' (requests with no response or an error
+                status), 'retries', 'p50', 'p95' and 'max' (latencies in
+                seconds), 'total' (seconds), 'sent' and 'received' (bytes)
+                and 'throughput' (bytes transferred per second spent).
+        """
+        if records is None:
+            with self._lock:
+                records = list(self.records)
+
+        groups = {}
+        for entry in records:
+            key = (entry["method"], entry["endpoint"])
+            groups.setdefault(key, []).append(entry)
+
+        summary = []
+        for (method, endpoint), entries in groups.items():
+            latencies = [entry["elapsed"] for entry in entries]
+            total = sum(latencies)
+            sent = sum(entry["sent"] for entry in entries)
+            received = sum(entry["received"] for entry in entries)
+            summary.append(
+                {
+                    "method": method,
+                    "endpoint": endpoint,
+                    "count": len(entries),
+                    "failed": sum(
+                        1
+                        for entry in entries
+                        if entry["status"] is None or entry["status"] >= 400
+                    ),
+                    "retries": sum(entry["retries"] for entry in entries),
+                    "p50": percentile(latencies, 50),
+                    "p95": percentile(latencies, 95),
+                    "max": max(latencies),
+                    "total": total,
+                    "sent": sent,
+                    "received": received,
+                    "throughput": (sent + received) / total if total else 0,
+                }
+            )
+        return sorted(summary, key=lambda item: item["total"], reverse=True)
+
+    def report(self, records=None):
+        """Make a human readable summary of the requests made.
+
+        Args:
+            records (list, optional): The records to report on. Defaults to
+                the requests recorded by this instance.
+
+        Returns:
+            str: A table with one row per method and endpoint.
+        """
+        if records is None:
+            with self._lock:
+                records = list(self.records)
+        if not records:
+            return "No XNAT requests made."
+
+        summary = self.summarize(records)
+        start = min(entry["time"] - entry["elapsed"] for entry in records)
+        wall_time = max(entry["time"] for entry in records) - start
+        received = sum(item["received"] for item in summary)
+        sent = sum(item["sent"] for item in summary)
+        width = max(len(item["endpoint"]) for item in summary)
+        width = max(width, len("ENDPOINT"))
+        lines = [
+            f"{len(records)} XNAT requests in {wall_time:.1f}s "
+            f"({len(records) / wall_time if wall_time else 0:.1f}/s), "
+            f"{format_size(received)} received, {format_size(sent)} sent, "
+            f"{sum(item['retries'] for item in summary)} retries, "
+            f"{sum(item['failed'] for item in summary)} failed",
+            f"{'METHOD':<7} {'ENDPOINT':<{width}} {'COUNT':>6} {'FAILED':>6} "
+            f"{'P50(s)':>8} {'P95(s)':>8} {'TOTAL(s)':>9} {'RATE':>10}",
+        ]
+        for item in summary:
+            lines.append(
+                f"{item['method']:<7} {item['endpoint']:<{width}} "
+                f"{item['count']:>6} {item['failed']:>6} "
+                f"{item['p50']:>8.3f} {item['p95']:>8.3f} "
+                f"{item['total']:>9.1f} "
+                f"{format_size(item['throughput']) + '/s':>10}"
+            )
+        return "\n".join(lines)
+
+    def close(self):
+        with self._lock:
+            if self._log:
+                self._log.close()
+                self._log = None
+
+    def __str__(self):
+        return f"<datman.xnat_stats.RequestStats {len(self.records)} requests>"
+
+    def __repr__(self):
+        return self.__str__()
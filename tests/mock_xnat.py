@@ -0,0 +1,1337 @@
+#!/usr/bin/env python
+"""
+Serves a synthetic XNAT archive for benchmarking and testing datman.xnat
+
+Implements the subset of XNAT's REST API used by datman.xnat (sessions,
+projects, subjects, experiments, scans, resources, file uploads, dicom
+imports and zip downloads) on top of a folder on disk. Latency, failed
+requests, dropped downloads and expiring sessions can be injected so that
+the retry, concurrency and caching behaviour of datman.xnat can be measured
+reproducibly without a real XNAT server.
+
+If the data folder is empty a synthetic archive is generated in it first. The
+folder is laid out as:
+
+    <data_dir>/<project>/<subject>/<experiment>/scans/<id>-<desc>/DICOM/
+    <data_dir>/<project>/<subject>/<experiment>/resources/<label>/
+
+Any username and password are accepted.
+
+Usage:
+    mock_xnat.py [options] <data_dir>
+
+Arguments:
+    <data_dir>              The folder to serve data from (and to generate
+                            data in, if it's empty).
+
+Options:
+    --port PORT             The port to listen on. [default: 8080]
+    --projects N            Projects to generate. [default: 1]
+    --experiments N         Experiments to generate per project.
+                            [default: 10]
+    --scans N               Scans to generate per experiment. [default: 5]
+    --files N               Dicom files to generate per scan. [default: 20]
+    --file-size BYTES       The size of each generated file. [default: 65536]
+    --resources N           Non-dicom files to generate per experiment.
+                            [default: 2]
+    --latency SECONDS       Delay before answering each request.
+                            [default: 0]
+    --jitter SECONDS        Extra random delay of up to this many seconds.
+                            [default: 0]
+    --failure-rate RATE     The fraction of requests to fail. [default: 0]
+    --failure-status CODE   The status to fail requests with. [default: 503]
+    --drop-rate RATE        The fraction of downloads to cut off part way
+                            through. [default: 0]
+    --session-timeout SEC   Expire sessions after this many idle seconds.
+    --seed SEED             Seed for generated data and injected failures.
+    -d --debug              Log every request.
+
+Example:
+    python tests/mock_xnat.py --latency 0.05 --failure-rate 0.01 /tmp/xnat
+
+    Then point datman at it with --server http://localhost:8080
+"""
+
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
+
+from docopt import docopt
+import pydicom
+from pydicom.dataset import Dataset, FileDataset
+
+logger = logging.getLogger(__name__)
+
+UID_ROOT = "1.2.826.0.1.3680043.8.498."
+MR_STORAGE = "1.2.840.10008.5.1.4.1.1.4"
+EXPLICIT_LITTLE_ENDIAN = "1.2.840.10008.1.2.1"
+CATALOG_NS = "http://nrg.wustl.edu/catalog"
+SERIES = ["T1", "RST", "DTI60-1000", "T2", "FMAP-AP", "FMAP-PA", "EMP"]
+CHUNK_SIZE = 1024 * 1024
+ZIP_DATE = (2020, 1, 1, 0, 0, 0)
+
+ElementTree.register_namespace("cat", CATALOG_NS)
+
+
+class NotFound(Exception):
+    pass
+
+
+class BadRequest(Exception):
+    pass
+
+
+def make_uid(*parts):
+    """Make a DICOM UID that's the same every time for the same inputs."""
+    digest = hashlib.md5("/".join(str(p) for p in parts).encode()).hexdigest()
+    return UID_ROOT + str(int(digest, 16))[:30]
+
+
+def make_dicom(path, experiment, series, description, instance, size, rng):
+    """Write a small, valid MR dicom file with 'size' bytes of pixel data."""
+    study_uid = make_uid(experiment)
+    series_uid = make_uid(experiment, series)
+    instance_uid = make_uid(experiment, series, instance)
+
+    meta_class = getattr(pydicom.dataset, "FileMetaDataset", Dataset)
+    meta = meta_class()
+    meta.MediaStorageSOPClassUID = MR_STORAGE
+    meta.MediaStorageSOPInstanceUID = instance_uid
+    meta.TransferSyntaxUID = EXPLICIT_LITTLE_ENDIAN
+
+    ds = FileDataset(path, {}, file_meta=meta, preamble=b"\0" * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = MR_STORAGE
+    ds.SOPInstanceUID = instance_uid
+    ds.StudyInstanceUID = study_uid
+    ds.SeriesInstanceUID = series_uid
+    ds.PatientName = experiment
+    ds.PatientID = experiment
+    ds.StudyDate = "20200101"
+    ds.Modality = "MR"
+    ds.ImageType = ["ORIGINAL", "PRIMARY", "M", "ND"]
+    ds.SeriesNumber = series
+    ds.SeriesDescription = description
+    ds.InstanceNumber = instance
+    size += size % 2
+    ds.add_new(0x7FE00010, "OB", random_bytes(rng, size))
+    ds.save_as(path, write_like_original=False)
+
+
+def random_bytes(rng, size):
+    if not size:
+        return b""
+    return rng.getrandbits(8 * size).to_bytes(size, "little")
+
+
+def generate_dataset(
+    data_dir,
+    projects=1,
+    experiments=10,
+    scans=5,
+    files=20,
+    file_size=65536,
+    resources=2,
+    seed=None,
+):
+    """Fill a folder with a synthetic archive.
+
+    Experiments are named like '<project>_SITE_0001_01_01', with a subject
+    of the same name.
+
+    Args:
+        data_dir (:obj:`str`): The folder to write to.
+        projects (int, optional): The number of projects to make.
+        experiments (int, optional): The number of experiments per project.
+        scans (int, optional): The number of scans per experiment.
+        files (int, optional): The number of dicoms per scan.
+        file_size (int, optional): The number of bytes of pixel data (or
+            random content, for non-dicom resources) in each file.
+        resources (int, optional): The number of non-dicom files to add
+            to each experiment.
+        seed (int, optional): Seed for the random file contents.
+    """
+    rng = random.Random(seed)
+    for p_num in range(1, projects + 1):
+        project = f"MOCK{p_num:02d}"
+        for e_num in range(1, experiments + 1):
+            label = f"{project}_SITE_{e_num:04d}_01_01"
+            exp_dir = os.path.join(data_dir, project, label, label)
+            for series in range(1, scans + 1):
+                description = SERIES[(series - 1) % len(SERIES)]
+                scan_dir = os.path.join(
+                    exp_dir, "scans", f"{series}-{description}", "DICOM"
+                )
+                os.makedirs(scan_dir)
+                for instance in range(1, files + 1):
+                    make_dicom(
+                        os.path.join(scan_dir, f"{instance:04d}.dcm"),
+                        label,
+                        series,
+                        description,
+                        instance,
+                        file_size,
+                        rng,
+                    )
+            res_dir = os.path.join(exp_dir, "resources", "MISC")
+            os.makedirs(res_dir)
+            for r_num in range(1, resources + 1):
+                with open(os.path.join(res_dir, f"file{r_num}.txt"), "wb") as f:
+                    f.write(random_bytes(rng, file_size))
+
+
+class Resource(object):
+    """A folder of files belonging to a scan or experiment."""
+
+    def __init__(self, r_id, label, path, scan=None):
+        self.id = str(r_id)
+        self.label = label
+        self.path = path
+        self.scan = scan
+
+    def files(self):
+        found = []
+        for root, _, fnames in os.walk(self.path):
+            for fname in fnames:
+                full_path = os.path.join(root, fname)
+                found.append(os.path.relpath(full_path, self.path))
+        return sorted(found)
+
+    def get_file(self, name):
+        path = os.path.join(self.path, name)
+        if not os.path.isfile(path):
+            raise NotFound(f"File {name} not found in resource {self.label}")
+        return path
+
+
+class Scan(object):
+    def __init__(self, scan_id, description, path, resource):
+        self.id = scan_id
+        self.description = description
+        self.path = path
+        self.resource = resource
+
+    @property
+    def sort_key(self):
+        return (0, int(self.id), "") if self.id.isdigit() else (1, 0, self.id)
+
+
+class Experiment(object):
+    def __init__(self, e_id, label, subject, path):
+        self.id = e_id
+        self.label = label
+        self.subject = subject
+        self.path = path
+        self.scans = {}
+        self.resources = {}
+
+    @property
+    def project(self):
+        return self.subject.project
+
+    @property
+    def last_modified(self):
+        stamp = os.stat(self.path).st_mtime
+        return datetime.datetime.fromtimestamp(stamp).strftime(
+            "%Y-%m-%d %H:%M:%S.%f"
+        )
+
+    @property
+    def date(self):
+        days = int(hashlib.md5(self.label.encode()).hexdigest(), 16) % 365
+        return str(datetime.date(2020, 1, 1) + datetime.timedelta(days))
+
+    def touch(self):
+        os.utime(self.path)
+
+    def get_scan(self, scan_id):
+        try:
+            return self.scans[scan_id]
+        except KeyError:
+            raise NotFound(f"Scan {scan_id} not found in {self.label}")
+
+    def get_resource(self, key):
+        """Find a resource by label or ID. Scan resources are found by ID."""
+        if key in self.resources:
+            return self.resources[key]
+        for resource in self.all_resources():
+            if resource.id == key:
+                return resource
+        raise NotFound(f"Resource {key} not found in {self.label}")
+
+    def all_resources(self):
+        resources = [scan.resource for scan in self.sorted_scans()]
+        return resources + list(self.resources.values())
+
+    def sorted_scans(self):
+        return sorted(self.scans.values(), key=lambda s: s.sort_key)
+
+
+class Subject(object):
+    def __init__(self, s_id, label, project, path):
+        self.id = s_id
+        self.label = label
+        self.project = project
+        self.path = path
+        self.experiments = {}
+
+
+class Archive(object):
+    """An index of the XNAT objects stored in a folder.
+
+    Objects are given IDs in sorted order when the folder is first read, so
+    the same folder always produces the same IDs.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.RLock()
+        self.projects = {}
+        self._num_subjects = 0
+        self._num_experiments = 0
+        self._num_resources = 0
+        self._digests = {}
+        self._load()
+
+    def _load(self):
+        for project in sorted(os.listdir(self.root)):
+            if not os.path.isdir(os.path.join(self.root, project)):
+                continue
+            self.projects[project] = {}
+            p_dir = os.path.join(self.root, project)
+            for subject in sorted(os.listdir(p_dir)):
+                self._add_subject(project, subject)
+                s_dir = os.path.join(p_dir, subject)
+                for experiment in sorted(os.listdir(s_dir)):
+                    self._add_experiment(project, subject, experiment)
+
+    def _add_subject(self, project, label):
+        self._num_subjects += 1
+        s_id = f"MOCK_S{self._num_subjects:05d}"
+        path = os.path.join(self.root, project, label)
+        os.makedirs(path, exist_ok=True)
+        subject = Subject(s_id, label, project, path)
+        self.projects[project][label] = subject
+        return subject
+
+    def _add_experiment(self, project, subject, label):
+        self._num_experiments += 1
+        e_id = f"MOCK_E{self._num_experiments:05d}"
+        subject = self.projects[project][subject]
+        path = os.path.join(subject.path, label)
+        os.makedirs(path, exist_ok=True)
+        experiment = Experiment(e_id, label, subject, path)
+        subject.experiments[label] = experiment
+
+        scans_dir = os.path.join(path, "scans")
+        if os.path.isdir(scans_dir):
+            for folder in sorted(os.listdir(scans_dir)):
+                scan_id, _, description = folder.partition("-")
+                self._add_scan(experiment, scan_id, description)
+
+        res_dir = os.path.join(path, "resources")
+        if os.path.isdir(res_dir):
+            for folder in sorted(os.listdir(res_dir)):
+                self._add_resource(experiment, folder)
+        return experiment
+
+    def _add_scan(self, experiment, scan_id, description):
+        path = os.path.join(
+            experiment.path, "scans", f"{scan_id}-{description}"
+        )
+        dicom_dir = os.path.join(path, "DICOM")
+        os.makedirs(dicom_dir, exist_ok=True)
+        self._num_resources += 1
+        resource = Resource(self._num_resources, "DICOM", dicom_dir)
+        scan = Scan(scan_id, description, path, resource)
+        resource.scan = scan
+        experiment.scans[scan_id] = scan
+        return scan
+
+    def _add_resource(self, experiment, label):
+        path = os.path.join(experiment.path, "resources", label)
+        os.makedirs(path, exist_ok=True)
+        self._num_resources += 1
+        resource = Resource(self._num_resources, label, path)
+        experiment.resources[label] = resource
+        return resource
+
+    def get_project(self, project):
+        try:
+            return self.projects[project]
+        except KeyError:
+            raise NotFound(f"Project {project} not found")
+
+    def get_subject(self, project, key):
+        subjects = self.get_project(project)
+        if key in subjects:
+            return subjects[key]
+        for subject in subjects.values():
+            if subject.id == key:
+                return subject
+        raise NotFound(f"Subject {key} not found in {project}")
+
+    def get_experiment(self, project=None, key=None, subject=None):
+        """Find an experiment by label or ID."""
+        if project:
+            subjects = [self.get_subject(project, subject)] if subject else (
+                self.get_project(project).values()
+            )
+        else:
+            subjects = [
+                subj
+                for proj in self.projects.values()
+                for subj in proj.values()
+            ]
+        for subj in subjects:
+            for experiment in subj.experiments.values():
+                if key in (experiment.label, experiment.id):
+                    return experiment
+        raise NotFound(f"Experiment {key} not found")
+
+    def make_subject(self, project, label):
+        with self.lock:
+            self.get_project(project)
+            try:
+                return self.get_subject(project, label), False
+            except NotFound:
+                return self._add_subject(project, label), True
+
+    def make_experiment(self, project, subject, label):
+        with self.lock:
+            subject, _ = self.make_subject(project, subject)
+            try:
+                return self.get_experiment(project, label, subject.label), False
+            except NotFound:
+                return self._add_experiment(
+                    project, subject.label, label
+                ), True
+
+    def make_resource(self, experiment, label):
+        with self.lock:
+            if label in experiment.resources:
+                return experiment.resources[label]
+            resource = self._add_resource(experiment, label)
+            experiment.touch()
+            return resource
+
+    def rename_experiment(self, experiment, new_label):
+        with self.lock:
+            subject = experiment.subject
+            if new_label in subject.experiments:
+                raise BadRequest(f"Experiment {new_label} already exists")
+            new_path = os.path.join(subject.path, new_label)
+            os.rename(experiment.path, new_path)
+            del subject.experiments[experiment.label]
+            experiment.label = new_label
+            experiment.path = new_path
+            for scan in experiment.scans.values():
+                scan.path = os.path.join(
+                    new_path, "scans", os.path.basename(scan.path)
+                )
+                scan.resource.path = os.path.join(scan.path, "DICOM")
+            for resource in experiment.resources.values():
+                resource.path = os.path.join(
+                    new_path, "resources", resource.label
+                )
+            subject.experiments[new_label] = experiment
+            experiment.touch()
+
+    def import_dicoms(self, project, subject, label, zip_file, overwrite):
+        """Add the dicoms from a zip file to an experiment.
+
+        Dicoms are grouped into scans by their series number and
+        description. Files that can't be read as dicoms are grouped by the
+        folder they're in instead.
+        """
+        with self.lock:
+            experiment, _ = self.make_experiment(project, subject, label)
+            if overwrite == "delete":
+                for scan in list(experiment.scans.values()):
+                    shutil.rmtree(scan.path)
+                    del experiment.scans[scan.id]
+
+            with zipfile.ZipFile(zip_file) as zf:
+                folders = {}
+                for member in zf.infolist():
+                    if member.is_dir():
+                        continue
+                    scan_id, description = self._get_series(
+                        zf, member, folders
+                    )
+                    scan = experiment.scans.get(scan_id)
+                    if not scan:
+                        scan = self._add_scan(experiment, scan_id, description)
+                    dest = os.path.join(
+                        scan.resource.path, os.path.basename(member.filename)
+                    )
+                    with zf.open(member) as src, open(dest, "wb") as out:
+                        shutil.copyfileobj(src, out, CHUNK_SIZE)
+            experiment.touch()
+            return experiment
+
+    def _get_series(self, zf, member, folders):
+        try:
+            with zf.open(member) as data:
+                header = pydicom.dcmread(data, stop_before_pixels=True)
+            return str(header.SeriesNumber), str(header.SeriesDescription)
+        except Exception:
+            folder = os.path.dirname(member.filename)
+            if folder not in folders:
+                folders[folder] = (
+                    str(len(folders) + 1),
+                    os.path.basename(folder) or "UNKNOWN",
+                )
+            return folders[folder]
+
+    def get_digest(self, path):
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._digests.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                md5.update(chunk)
+        self._digests[path] = (key, md5.hexdigest())
+        return md5.hexdigest()
+
+
+class MockXnatHandler(BaseHTTPRequestHandler):
+    """Answers a single request to the mock XNAT server."""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "MockXNAT/1.0"
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+    @property
+    def archive(self):
+        return self.server.archive
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def _handle(self, method):
+        self.method = method
+        url = urllib.parse.urlsplit(self.path)
+        self.query = {
+            key: values[-1]
+            for key, values in urllib.parse.parse_qs(
+                url.query, keep_blank_values=True
+            ).items()
+        }
+        parts = [urllib.parse.unquote(p) for p in url.path.split("/") if p]
+        if parts and parts[0] in ("data", "REST"):
+            parts = parts[1:]
+        if parts and parts[0] == "archive":
+            parts = parts[1:]
+        aliases = {"subject_ids": "subjects", "exper_ids": "experiments"}
+        self.parts = [aliases.get(p, p) for p in parts]
+
+        self.body = tempfile.SpooledTemporaryFile(max_size=8 * CHUNK_SIZE)
+        try:
+            self._read_body()
+            self.mock.wait()
+            route = self._route()
+            self.mock.record(method, route)
+            if route != "session" and self.mock.should_fail():
+                self._send(self.mock.failure_status, b"Injected failure")
+                return
+            if route != "session" and not self._has_session():
+                self._send(401, b"Login required")
+                return
+            getattr(self, f"_{route}")()
+        except NotFound as e:
+            self._send(404, str(e).encode())
+        except BadRequest as e:
+            self._send(400, str(e).encode())
+        except (ConnectionError, TimeoutError):
+            self.close_connection = True
+        except Exception as e:
+            logger.error(f"Failed handling {method} {self.path}", exc_info=True)
+            self._send(500, str(e).encode())
+        finally:
+            self.body.close()
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                self._copy_body(size)
+                self.rfile.readline()
+        else:
+            self._copy_body(int(self.headers.get("Content-Length") or 0))
+        self.body.seek(0)
+
+    def _copy_body(self, size):
+        while size:
+            chunk = self.rfile.read(min(size, CHUNK_SIZE))
+            if not chunk:
+                raise ConnectionError("Client closed connection")
+            self.body.write(chunk)
+            size -= len(chunk)
+
+    def _route(self):
+        """Find the name of the method that should answer the request."""
+        parts = self.parts
+        if parts == ["JSESSION"]:
+            return "session"
+        if parts[:1] == ["services"] and parts[1:] == ["import"]:
+            return "import"
+        if parts[:1] == ["workflows"]:
+            return "workflow"
+        if parts == ["search"]:
+            return "search"
+        if parts in ([], ["projects"]):
+            return "projects"
+        if parts[0] == "projects" and len(parts) == 2:
+            return "project"
+        if parts[0] == "projects" and parts[2:] == ["subjects"]:
+            return "subjects"
+        if parts[0] == "projects" and len(parts) == 4 and (
+            parts[2] == "subjects"
+        ):
+            return "subject"
+        if parts[0] == "projects" and parts[2:] == ["experiments"]:
+            return "experiments"
+        if parts[0] == "projects" and parts[4:] == ["experiments"]:
+            return "experiments"
+
+        self.experiment, rest = self._find_experiment()
+        if not rest:
+            return "experiment"
+        if rest == ["scans"]:
+            return "scans"
+        if rest[0] == "scans" and len(rest) == 2:
+            return "scan"
+        if rest[0] == "scans" and rest[2:3] == ["resources"]:
+            self.scan = self.experiment.get_scan(rest[1])
+            rest = rest[2:]
+        else:
+            self.scan = None
+        if rest == ["resources"]:
+            return "resources"
+        if rest[0] != "resources" or len(rest) < 2:
+            raise NotFound(f"Unknown URL {self.path}")
+        self.resource_key = rest[1]
+        if len(rest) == 2:
+            return "resource"
+        if rest[2:] == ["files"]:
+            return "files"
+        if rest[2] == "files":
+            self.file_name = "/".join(rest[3:])
+            if ".." in rest[3:]:
+                raise BadRequest(f"Invalid file name {self.file_name}")
+            return "file"
+        raise NotFound(f"Unknown URL {self.path}")
+
+    def _find_experiment(self):
+        parts = self.parts
+        with self.archive.lock:
+            if parts[0] == "experiments" and len(parts) > 1:
+                return self.archive.get_experiment(key=parts[1]), parts[2:]
+            if parts[0] != "projects" or len(parts) < 4:
+                raise NotFound(f"Unknown URL {self.path}")
+            if parts[2] == "experiments":
+                return (
+                    self.archive.get_experiment(parts[1], parts[3]),
+                    parts[4:],
+                )
+            if parts[2] != "subjects" or parts[4:5] != ["experiments"]:
+                raise NotFound(f"Unknown URL {self.path}")
+            if len(parts) < 6:
+                raise NotFound(f"Unknown URL {self.path}")
+            if self.method == "PUT" and len(parts) == 6:
+                # Experiment may be about to be made
+                try:
+                    exp = self.archive.get_experiment(
+                        parts[1], parts[5], parts[3]
+                    )
+                except NotFound:
+                    exp = None
+                return exp, []
+            return (
+                self.archive.get_experiment(parts[1], parts[5], parts[3]),
+                parts[6:],
+            )
+
+    def _has_session(self):
+        cookie = self.headers.get("Cookie", "")
+        match = re.search(r"JSESSIONID=([\w-]+)", cookie)
+        return bool(match) and self.mock.check_session(match.group(1))
+
+    def _session(self):
+        if self.method == "DELETE":
+            self._send(200)
+            return
+        if not self.headers.get("Authorization", "").startswith("Basic "):
+            self._send(401, b"Login required")
+            return
+        token = self.mock.new_session()
+        self._send(
+            200,
+            token.encode(),
+            "text/plain",
+            {"Set-Cookie": f"JSESSIONID={token}; Path=/; HttpOnly"},
+        )
+
+    def _projects(self):
+        result = [
+            {
+                "ID": project,
+                "secondary_ID": project,
+                "name": project,
+                "URI": f"/data/projects/{project}",
+            }
+            for project in sorted(self.archive.projects)
+        ]
+        self._send_result_set(result)
+
+    def _project(self):
+        project = self.parts[1]
+        self.archive.get_project(project)
+        self._send_json(
+            {
+                "items": [
+                    {
+                        "data_fields": {
+                            "ID": project,
+                            "secondary_ID": project,
+                            "name": project,
+                        }
+                    }
+                ]
+            }
+        )
+
+    def _subjects(self):
+        with self.archive.lock:
+            subjects = self.archive.get_project(self.parts[1]).values()
+            result = [
+                {"ID": subj.id, "label": subj.label, "project": subj.project}
+                for subj in subjects
+            ]
+        self._send_result_set(result)
+
+    def _subject(self):
+        project, label = self.parts[1], self.parts[3]
+        if self.method == "PUT":
+            if "label" in self.query:
+                raise BadRequest("Renaming subjects isn't supported")
+            _, created = self.archive.make_subject(project, label)
+            self._send(201 if created else 200)
+            return
+        with self.archive.lock:
+            subject = self.archive.get_subject(project, label)
+            experiments = [
+                self._experiment_json(exp)
+                for exp in subject.experiments.values()
+            ]
+        children = []
+        if experiments:
+            children.append(
+                {"field": "experiments/experiment", "items": experiments}
+            )
+        self._send_json(
+            {
+                "items": [
+                    {
+                        "data_fields": {
+                            "ID": subject.id,
+                            "label": subject.label,
+                            "project": subject.project,
+                        },
+                        "children": children,
+                    }
+                ]
+            }
+        )
+
+    def _experiments(self):
+        with self.archive.lock:
+            if len(self.parts) > 3:
+                subjects = [
+                    self.archive.get_subject(self.parts[1], self.parts[3])
+                ]
+            else:
+                subjects = self.archive.get_project(self.parts[1]).values()
+            result = [
+                {
+                    "ID": exp.id,
+                    "label": exp.label,
+                    "subject_label": subj.label,
+                    "date": exp.date,
+                    "insert_date": exp.date,
+                    "last_modified": exp.last_modified,
+                    "xsiType": "xnat:mrSessionData",
+                    "project": subj.project,
+                    "URI": f"/data/experiments/{exp.id}",
+                }
+                for subj in subjects
+                for exp in subj.experiments.values()
+            ]
+        self._send_result_set(result)
+
+    def _experiment(self):
+        if self.method == "PUT":
+            self._put_experiment()
+            return
+        with self.archive.lock:
+            exp_json = self._experiment_json(self.experiment)
+        self._send_json({"items": [exp_json]})
+
+    def _put_experiment(self):
+        if "label" in self.query:
+            if not self.experiment:
+                raise NotFound(f"Experiment {self.parts[5]} not found")
+            self.archive.rename_experiment(
+                self.experiment, self.query["label"]
+            )
+            self._send(200)
+            return
+        if self.experiment:
+            self._send(200)
+            return
+        self.archive.make_experiment(
+            self.parts[1], self.parts[3], self.parts[5]
+        )
+        self._send(201)
+
+    def _experiment_json(self, experiment):
+        children = []
+        scans = [
+            self._scan_json(experiment, scan)
+            for scan in experiment.sorted_scans()
+        ]
+        if scans:
+            children.append({"field": "scans/scan", "items": scans})
+        resources = [
+            {
+                "data_fields": {
+                    "label": resource.label,
+                    "file_count": len(resource.files()),
+                    "xnat_abstractresource_id": int(resource.id),
+                },
+                "meta": {"xsi:type": "xnat:resourceCatalog"},
+            }
+            for resource in experiment.resources.values()
+        ]
+        if resources:
+            children.append({"field": "resources/resource", "items": resources})
+        return {
+            "data_fields": {
+                "ID": experiment.id,
+                "label": experiment.label,
+                "UID": make_uid(experiment.label),
+                "date": experiment.date,
+                "subject_ID": experiment.subject.id,
+                "project": experiment.project,
+            },
+            "meta": {"xsi:type": "xnat:mrSessionData"},
+            "children": children,
+        }
+
+    def _scan_json(self, experiment, scan):
+        return {
+            "data_fields": {
+                "ID": scan.id,
+                "UID": make_uid(experiment.label, scan.id),
+                "series_description": scan.description,
+                "type": scan.description,
+                "parameters/imageType": "ORIGINAL\\PRIMARY\\M\\ND",
+            },
+            "meta": {"xsi:type": "xnat:mrScanData"},
+            "children": [
+                {
+                    "field": "file",
+                    "items": [
+                        {
+                            "data_fields": {
+                                "label": "DICOM",
+                                "format": "DICOM",
+                                "content": "RAW",
+                                "file_count": len(scan.resource.files()),
+                                "xnat_abstractresource_id": int(
+                                    scan.resource.id
+                                ),
+                            }
+                        }
+                    ],
+                }
+            ],
+        }
+
+    def _scans(self):
+        with self.archive.lock:
+            result = [
+                {
+                    "ID": scan.id,
+                    "type": scan.description,
+                    "series_description": scan.description,
+                    "xsiType": "xnat:mrScanData",
+                }
+                for scan in self.experiment.sorted_scans()
+            ]
+        self._send_result_set(result)
+
+    def _scan(self):
+        scan = self.experiment.get_scan(self.parts[-1])
+        self._send_json({"items": [self._scan_json(self.experiment, scan)]})
+
+    def _resources(self):
+        with self.archive.lock:
+            resources = (
+                [self.scan.resource]
+                if self.scan
+                else list(self.experiment.resources.values())
+            )
+        result = [
+            {
+                "xnat_abstractresource_id": resource.id,
+                "label": resource.label,
+                "element_name": "xnat:resourceCatalog",
+                "category": "scans" if self.scan else "resources",
+                "file_count": str(len(resource.files())),
+            }
+            for resource in resources
+        ]
+        self._send_result_set(result)
+
+    def _resource(self):
+        if self.method == "PUT":
+            self.archive.make_resource(self.experiment, self.resource_key)
+            self._send(200)
+            return
+
+        resource = self._get_resources()[0]
+        catalog = ElementTree.Element(
+            f"{{{CATALOG_NS}}}Catalog", {"ID": resource.label}
+        )
+        files = resource.files()
+        if files:
+            entries = ElementTree.SubElement(
+                catalog, f"{{{CATALOG_NS}}}entries"
+            )
+            for name in files:
+                ElementTree.SubElement(
+                    entries,
+                    f"{{{CATALOG_NS}}}entry",
+                    {"URI": name, "ID": name, "name": os.path.basename(name)},
+                )
+        self._send(200, ElementTree.tostring(catalog), "application/xml")
+
+    def _get_resources(self):
+        keys = self.resource_key
+        if self.scan:
+            if keys not in ("DICOM", self.scan.resource.id):
+                raise NotFound(f"Resource {keys} not found")
+            return [self.scan.resource]
+        with self.archive.lock:
+            return [
+                self.experiment.get_resource(key) for key in keys.split(",")
+            ]
+
+    def _files(self):
+        resources = self._get_resources()
+        if self.query.get("format") == "zip":
+            self._send_zip(resources)
+            return
+        result = []
+        for resource in resources:
+            for name in resource.files():
+                path = os.path.join(resource.path, name)
+                result.append(
+                    {
+                        "Name": os.path.basename(name),
+                        "Size": str(os.path.getsize(path)),
+                        "URI": (
+                            f"/data/experiments/{self.experiment.id}/"
+                            f"resources/{resource.id}/files/{name}"
+                        ),
+                        "collection": resource.label,
+                        "cat_ID": resource.id,
+                        "digest": self.archive.get_digest(path),
+                        "file_content": "",
+                        "file_format": "",
+                        "file_tags": "",
+                    }
+                )
+        self._send_result_set(result)
+
+    def _file(self):
+        resource = self._get_resources()[0]
+        if self.method == "POST":
+            self._upload_file(resource)
+            return
+        path = resource.get_file(self.file_name)
+        if self.method == "DELETE":
+            os.remove(path)
+            self.experiment.touch()
+            self._send(200)
+            return
+        if self.query.get("format") == "zip":
+            self._send_zip([resource], [self.file_name])
+            return
+        with open(path, "rb") as data:
+            self._send_file(data, os.path.getsize(path))
+
+    def _upload_file(self, resource):
+        dest = os.path.join(resource.path, self.file_name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest + ".part", "wb") as out:
+            shutil.copyfileobj(self.body, out, CHUNK_SIZE)
+        os.replace(dest + ".part", dest)
+        self.experiment.touch()
+        self._send(200)
+
+    def _import(self):
+        if self.method != "POST":
+            raise BadRequest("Import requires a POST")
+        try:
+            project = self.query["project"]
+            subject = self.query["subject"]
+            session = self.query["session"]
+        except KeyError as e:
+            raise BadRequest(f"Missing import parameter {e}")
+        try:
+            experiment = self.archive.import_dicoms(
+                project,
+                subject,
+                session,
+                self.body,
+                self.query.get("overwrite"),
+            )
+        except zipfile.BadZipFile:
+            raise BadRequest("Uploaded data is not a zip file")
+        self._send(
+            200,
+            f"/data/experiments/{experiment.id}".encode(),
+            "text/plain",
+        )
+
+    def _workflow(self):
+        self._send(200)
+
+    def _search(self):
+        self._send_result_set([])
+
+    def _send_result_set(self, result):
+        self._send_json(
+            {"ResultSet": {"Result": result, "totalRecords": str(len(result))}}
+        )
+
+    def _send_json(self, data, status=200):
+        self._send(status, json.dumps(data).encode(), "application/json")
+
+    def _send(self, status, body=b"", content_type="text/plain", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_zip(self, resources, names=None):
+        """Send the files from one or more resources as a zip.
+
+        The zip is always the same for the same files, so that interrupted
+        downloads can be resumed with a range request.
+        """
+        with tempfile.TemporaryFile() as tmp:
+            with zipfile.ZipFile(tmp, "w") as zf:
+                for resource in resources:
+                    scan = resource.scan
+                    if scan:
+                        prefix = (
+                            f"{self.experiment.label}/scans/"
+                            f"{scan.id}-{scan.description}/resources/DICOM"
+                        )
+                    else:
+                        prefix = (
+                            f"{self.experiment.label}/resources/"
+                            f"{resource.label}"
+                        )
+                    for name in names or resource.files():
+                        info = zipfile.ZipInfo(
+                            f"{prefix}/files/{name}", ZIP_DATE
+                        )
+                        with open(resource.get_file(name), "rb") as src:
+                            with zf.open(info, "w") as dest:
+                                shutil.copyfileobj(src, dest, CHUNK_SIZE)
+            size = tmp.tell()
+            tmp.seek(0)
+            self._send_file(tmp, size, "application/zip")
+
+    def _send_file(self, data, size, content_type="application/octet-stream"):
+        start = 0
+        status = 200
+        headers = {"Accept-Ranges": "bytes"}
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if start >= size:
+                self._send(416, headers={"Content-Range": f"bytes */{size}"})
+                return
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{size - 1}/{size}"
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(size - start))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+
+        data.seek(start)
+        remaining = size - start
+        if self.mock.should_drop():
+            # Send half of the data and hang up
+            remaining //= 2
+            self.close_connection = True
+        while remaining:
+            chunk = data.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+
+
+class MockXnat(object):
+    """Runs a mock XNAT server in a background thread.
+
+    Args:
+        data_dir (:obj:`str`): The folder to serve the archive from. See
+            :py:func:`generate_dataset`.
+        port (int, optional): The port to listen on. Defaults to any free
+            port.
+        latency (float, optional): Seconds to wait before answering each
+            request. Defaults to 0.
+        jitter (float, optional): Up to this many extra seconds of random
+            delay are added to each request. Defaults to 0.
+        failure_rate (float, optional): The fraction of requests to answer
+            with failure_status. Defaults to 0.
+        failure_status (int, optional): The status for failed requests.
+            Defaults to 503.
+        drop_rate (float, optional): The fraction of downloads to cut off
+            half way through. Defaults to 0.
+        session_timeout (float, optional): Seconds a session may be idle
+            before it expires. Defaults to None (never).
+        seed (int, optional): Seed for the injected failures.
+
+    Attributes:
+        url (:obj:`str`): The URL to connect to the server with.
+        requests (:obj:`collections.Counter`): The number of requests
+            received, keyed by method and route (e.g. 'GET experiment').
+    """
+
+    def __init__(
+        self,
+        data_dir,
+        port=0,
+        latency=0,
+        jitter=0,
+        failure_rate=0,
+        failure_status=503,
+        drop_rate=0,
+        session_timeout=None,
+        seed=None,
+        host="127.0.0.1",
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.drop_rate = drop_rate
+        self.session_timeout = session_timeout
+        self.requests = collections.Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._failures = 0
+        self._drops = 0
+        self._thread = None
+
+        self.server = ThreadingHTTPServer((host, port), MockXnatHandler)
+        self.server.daemon_threads = True
+        self.server.archive = Archive(data_dir)
+        self.server.mock = self
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        """Start answering requests in a background thread."""
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True
+        )
+        self._thread.start()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def fail_next(self, count=1):
+        """Fail the next 'count' requests with failure_status."""
+        with self._lock:
+            self._failures += count
+
+    def drop_next(self, count=1):
+        """Cut off the next 'count' downloads part way through."""
+        with self._lock:
+            self._drops += count
+
+    def expire_sessions(self):
+        """End all sessions, as if they had timed out."""
+        with self._lock:
+            self._sessions.clear()
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests.clear()
+
+    def record(self, method, route):
+        with self._lock:
+            self.requests[f"{method} {route}"] += 1
+
+    def wait(self):
+        delay = self.latency
+        if self.jitter:
+            with self._lock:
+                delay += self._random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def should_fail(self):
+        with self._lock:
+            if self._failures:
+                self._failures -= 1
+                return True
+            return bool(self.failure_rate) and (
+                self._random.random() < self.failure_rate
+            )
+
+    def should_drop(self):
+        with self._lock:
+            if self._drops:
+                self._drops -= 1
+                return True
+            return bool(self.drop_rate) and (
+                self._random.random() < self.drop_rate
+            )
+
+    def new_session(self):
+        token = uuid.uuid4().hex.upper()
+        with self._lock:
+            self._sessions[token] = time.monotonic()
+        return token
+
+    def check_session(self, token):
+        now = time.monotonic()
+        with self._lock:
+            last_used = self._sessions.get(token)
+            if last_used is None:
+                return False
+            if self.session_timeout and now - last_used > self.session_timeout:
+                del self._sessions[token]
+                return False
+            self._sessions[token] = now
+            return True
+
+
+def main():
+    arguments = docopt(__doc__)
+    data_dir = arguments["<data_dir>"]
+    seed = arguments["--seed"]
+    seed = int(seed) if seed is not None else None
+    timeout = arguments["--session-timeout"]
+
+    logging.basicConfig(
+        level=logging.DEBUG if arguments["--debug"] else logging.INFO,
+        format="%(asctime)s - %(message)s",
+    )
+
+    os.makedirs(data_dir, exist_ok=True)
+    if not os.listdir(data_dir):
+        logger.info(f"Generating synthetic archive in {data_dir}")
+        generate_dataset(
+            data_dir,
+            projects=int(arguments["--projects"]),
+            experiments=int(arguments["--experiments"]),
+            scans=int(arguments["--scans"]),
+            files=int(arguments["--files"]),
+            file_size=int(arguments["--file-size"]),
+            resources=int(arguments["--resources"]),
+            seed=seed,
+        )
+
+    mock = MockXnat(
+        data_dir,
+        port=int(arguments["--port"]),
+        latency=float(arguments["--latency"]),
+        jitter=float(arguments["--jitter"]),
+        failure_rate=float(arguments["--failure-rate"]),
+        failure_status=int(arguments["--failure-status"]),
+        drop_rate=float(arguments["--drop-rate"]),
+        session_timeout=float(timeout) if timeout else None,
+        seed=seed,
+        host="0.0.0.0",
+    )
+    logger.info(f"Serving {data_dir} on port {mock.server.server_address[1]}")
+    try:
+        mock.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.server.server_close()
+        for route, count in sorted(mock.requests.items()):
+            logger.info(f"{route}: {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,10 @@ Tests for datman/config.py
 """
 
 import os
+import timeit
+
+import pytest
+from mock import patch
 
 import datman.config as config
 
@@ -14,3 +18,180 @@ def test_initialise_from_environ():
     os.environ['DM_CONFIG'] = os.path.join(FIXTURE_DIR, 'site_config.yml')
     os.environ['DM_SYSTEM'] = 'test'
     config.config()
+
+
+def test_parsed_files_reused_until_changed(tmp_path):
+    settings = tmp_path / 'settings.yml'
+    settings.write_text("Paths:\n  nii: data/nii/\n")
+
+    first = config.read_yaml(str(settings))
+    first['Paths']['nii'] = 'changed'
+    with patch.object(config.yaml, 'load') as mock_load:
+        second = config.read_yaml(str(settings))
+        assert not mock_load.called
+    assert second == {'Paths': {'nii': 'data/nii/'}}
+
+    settings.write_text("Paths:\n  nii: data/nifti/\n")
+    os.utime(settings, ns=(0, 0))
+    assert config.read_yaml(str(settings))['Paths']['nii'] == 'data/nifti/'
+
+
+def test_snapshots_shared_between_processes(tmp_path, monkeypatch):
+    settings = tmp_path / 'settings.yml'
+    settings.write_text("StudyTag: SPN01\n")
+    monkeypatch.setenv('DM_CONFIG_CACHE', str(tmp_path / 'cache'))
+    config.read_yaml(str(settings))
+
+    # A new process starts without any files loaded
+    monkeypatch.setattr(config, '_loaded_yaml', {})
+    with patch.object(config.yaml, 'load') as mock_load:
+        assert config.read_yaml(str(settings)) == {'StudyTag': 'SPN01'}
+        assert not mock_load.called
+
+
+@pytest.mark.parametrize('unsafe', ['writable', 'foreign'])
+def test_untrusted_snapshots_not_loaded(tmp_path, monkeypatch, unsafe):
+    settings = tmp_path / 'settings.yml'
+    settings.write_text("StudyTag: SPN01\n")
+    cache = tmp_path / 'cache'
+    monkeypatch.setenv('DM_CONFIG_CACHE', str(cache))
+    config.read_yaml(str(settings))
+    monkeypatch.setattr(config, '_loaded_yaml', {})
+
+    if unsafe == 'writable':
+        for snapshot in cache.iterdir():
+            snapshot.chmod(0o666)
+    else:
+        monkeypatch.setattr(config.os, 'getuid', lambda: os.getuid() + 1)
+    with patch.object(config.yaml, 'load',
+                      return_value={'StudyTag': 'SPN01'}) as mock_load:
+        assert config.read_yaml(str(settings)) == {'StudyTag': 'SPN01'}
+        assert mock_load.called
+
+
+def _write_study_configs(tmp_path):
+    (tmp_path / 'main.yml').write_text(
+        "SystemSettings:\n"
+        "  test:\n"
+        "    DatmanProjectsDir: /archive/data\n"
+        f"    ConfigDir: {tmp_path}\n"
+        "Projects:\n"
+        "  SPINS: spins.yml\n"
+        "  OTHER: other.yml\n"
+        "  DTI15T: dti15t.yml\n"
+        "  DTI3T: dti3t.yml\n")
+    (tmp_path / 'spins.yml').write_text(
+        "StudyTag: SPN01\n"
+        "Sites:\n"
+        "  CMH:\n"
+        "    SiteTags: [SPINS, shared]\n")
+    (tmp_path / 'other.yml').write_text(
+        "StudyTag: OTH01\n"
+        "Sites:\n"
+        "  CMH:\n"
+        "    SiteTags: SHARED\n")
+    for name in ('dti15t', 'dti3t'):
+        (tmp_path / f'{name}.yml').write_text(
+            "StudyTag: DTI\n"
+            "Sites:\n"
+            "  TGH: {}\n"
+            "  CMH: {}\n")
+    return config.config(filename=str(tmp_path / 'main.yml'), system='test')
+
+
+@patch('datman.dashboard.get_project', return_value=None)
+def test_study_tags_mapped_to_first_matching_project(mock_project, tmp_path):
+    cfg = _write_study_configs(tmp_path)
+
+    assert cfg.map_xnat_archive_to_project('SPN01_CMH_0001_01_01') == 'SPINS'
+    assert cfg.study_name == 'SPINS'
+    assert cfg.map_xnat_archive_to_project('OTH01') == 'OTHER'
+    assert cfg.map_xnat_archive_to_project('SHARED_CMH_0001_01_01') == \
+        'SPINS'
+    assert cfg.map_xnat_archive_to_project('DTI_TGH_0001_01_01') == 'DTI15T'
+    assert cfg.map_xnat_archive_to_project('DTI_CMH_0001_01_01') == 'DTI3T'
+
+
+@patch('datman.dashboard.get_project', return_value=None)
+def test_tag_index_rebuilt_only_when_configs_change(mock_project, tmp_path):
+    cfg = _write_study_configs(tmp_path)
+    cfg.get_tag_index()
+
+    with patch.object(config.config, '_make_tag_index') as mock_make:
+        assert cfg.get_tag_index()['oth01'] == 'OTHER'
+        assert not mock_make.called
+
+    (tmp_path / 'other.yml').write_text(
+        "StudyTag: OTH02\n"
+        "Sites:\n"
+        "  CMH: {}\n")
+    os.utime(tmp_path / 'other.yml', ns=(0, 0))
+    assert cfg.get_tag_index()['oth02'] == 'OTHER'
+
+
+@patch('datman.dashboard.get_project', return_value=None)
+def test_tag_index_rebuilt_when_main_config_changes(mock_project, tmp_path):
+    cfg = _write_study_configs(tmp_path)
+    cfg.get_tag_index()
+
+    with open(tmp_path / 'main.yml', 'a') as main_config:
+        main_config.write("# Projects are unchanged\n")
+    with patch.object(config.config, '_make_tag_index',
+                      return_value={}) as mock_make:
+        cfg.get_tag_index()
+        assert mock_make.called
+
+
+@patch('datman.dashboard.get_project', return_value=None)
+def test_settings_remembered_until_study_changes(mock_project, tmp_path):
+    cfg = _write_study_configs(tmp_path)
+    cfg.set_study('SPINS')
+    cfg.get_key('Sites')
+
+    with patch.object(config.config, '_find_key') as mock_find:
+        assert list(cfg.get_key('Sites')) == ['CMH']
+        assert not mock_find.called
+
+    cfg.set_study('DTI3T')
+    assert list(cfg.get_key('Sites')) == ['TGH', 'CMH']
+
+
+@patch('datman.dashboard.get_project', return_value=None)
+def test_remembered_settings_faster_than_searching(mock_project, tmp_path):
+    cfg = _write_study_configs(tmp_path)
+    cfg.set_study('SPINS')
+    export_settings = {
+        f"TAG{num}": {"Formats": ["nii", "dcm"], "Pattern": f"series{num}"}
+        for num in range(100)
+    }
+    cfg.system_config['ExportSettings'] = export_settings
+    cfg.get_key('ExportSettings')
+
+    remembered = timeit.timeit(lambda: cfg.get_key('ExportSettings'),
+                               number=1000)
+    searched = timeit.timeit(
+        lambda: cfg._find_key('ExportSettings', None, False, False),
+        number=1000)
+
+    assert cfg.get_key('ExportSettings') == export_settings
+    assert remembered < searched
+
+
+def test_failed_searches_raise_every_time(tmp_path):
+    cfg = _write_study_configs(tmp_path)
+
+    for _ in range(2):
+        with pytest.raises(config.UndefinedSetting) as error:
+            cfg.get_key('MissingSetting')
+        assert "MissingSetting" in str(error.value)
+
+
+@patch('datman.dashboard.get_project', return_value=None)
+def test_study_can_be_given_by_position(mock_project, tmp_path):
+    cfg = _write_study_configs(tmp_path)
+
+    assert cfg.get_sites('DTI15T') == ['TGH', 'CMH']
+    assert cfg.study_name == 'DTI15T'
+    with patch.object(config.config, 'set_study') as mock_set:
+        cfg.get_sites(study='DTI15T')
+        assert not mock_set.called
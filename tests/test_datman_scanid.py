@@ -1,3 +1,5 @@
+import pickle
+
 import datman.scanid as scanid
 import pytest
 
@@ -124,6 +126,42 @@ def test_kcni_study_field_is_modified_when_settings_given():
     assert str(ident) == "DTI_CMH_H001_01_02"
 
 
+def test_datman_identifier_survives_pickling():
+    ident = scanid.parse("DTI_CMH_H001_01")
+
+    copy = pickle.loads(pickle.dumps(ident))
+
+    assert str(copy) == str(ident)
+    assert copy.get_xnat_experiment_id() == ident.get_xnat_experiment_id()
+
+
+def test_changed_identifier_fields_survive_pickling():
+    ident = scanid.parse("DTI_CMH_H001_01_01")
+    ident.session = "02"
+    ident.notes = "rescanned"
+
+    copy = pickle.loads(pickle.dumps(ident))
+
+    assert copy.__dict__.keys() == ident.__dict__.keys()
+    assert str(copy) == "DTI_CMH_H001_01_02"
+    assert copy.notes == "rescanned"
+    assert copy._match_groups.group("id") == "DTI_CMH_H001_01_01"
+
+
+def test_kcni_identifier_keeps_field_translations_when_pickled():
+    settings = {
+        'Study': {
+            'DTI01': 'DTI'
+        }
+    }
+    ident = scanid.parse("DTI01_CMH_H001_01_SE02_MR", settings=settings)
+
+    copy = pickle.loads(pickle.dumps(ident))
+
+    assert str(copy) == "DTI_CMH_H001_01_02"
+    assert copy.get_xnat_experiment_id() == "DTI01_CMH_H001_01_SE02_MR"
+
+
 def test_kcni_site_field_is_modified_when_settings_given():
     settings = {
         'Site': {
@@ -1,10 +1,13 @@
+import os
 import unittest
 import importlib
 import logging
+import zipfile
 
 from mock import patch, MagicMock
 
 import datman
+import datman.utils
 import datman.xnat
 import datman.scanid
 
@@ -73,3 +76,88 @@ class CheckFilesExist(unittest.TestCase):
         with open(text_file, 'r') as session_data:
             xnat_session = eval(session_data.read())
         return datman.xnat.XNATSubject(xnat_session)
+
+
+class VerifyFilesExist(unittest.TestCase):
+    archive = "some_dir/STUDY_SITE_9999_01_01.zip"
+
+    def _experiment(self, dicoms, resources):
+        experiment = MagicMock()
+        experiment.get_file_manifest.return_value = {
+            "dicoms": dicoms, "resources": resources}
+        return experiment
+
+    def _files(self, *sizes):
+        return [{"name": f"dir/file{num}", "size": size, "md5": None}
+                for num, size in enumerate(sizes)]
+
+    @patch('datman.utils.get_archive_manifest')
+    def test_all_data_found_when_counts_and_sizes_match(self, mock_manifest):
+        mock_manifest.return_value = {"dicoms": self._files(1, 2, 3),
+                                      "resources": self._files(5, 0)}
+        experiment = self._experiment(self._files(7, 8, 9), self._files(5))
+
+        result = upload.verify_files_exist(self.archive, experiment,
+                                           MagicMock())
+
+        assert result == (True, True)
+
+    @patch('datman.utils.get_archive_manifest')
+    def test_missing_dicoms_and_truncated_resources_found(self,
+                                                          mock_manifest):
+        mock_manifest.return_value = {"dicoms": self._files(1, 2, 3),
+                                      "resources": self._files(5, 6)}
+        experiment = self._experiment(self._files(7, 8), self._files(5, 3))
+
+        result = upload.verify_files_exist(self.archive, experiment,
+                                           MagicMock())
+
+        assert result == (False, False)
+
+
+class UploadNonDicomData(unittest.TestCase):
+    ident = datman.scanid.parse("STUDY_SITE_9999_01_01")
+
+    def _upload(self, uploaded):
+        xnat = self.xnat = MagicMock()
+        xnat.put_resources.return_value = uploaded
+        with datman.utils.make_temp_directory() as temp:
+            archive = os.path.join(temp, "STUDY_SITE_9999_01_01.zip")
+            with zipfile.ZipFile(archive, "w") as zf:
+                zf.writestr("session/notes.txt", b"some notes")
+                zf.writestr("session/behav.csv", b"1,2,3")
+            failed = upload.upload_non_dicom_data(archive, "STUDY",
+                                                  self.ident, xnat)
+        return failed, archive
+
+    def test_no_failures_when_all_files_uploaded(self):
+        failed, _ = self._upload(["session/notes.txt", "session/behav.csv"])
+
+        assert failed == []
+
+    def test_files_uploaded_as_overwrites(self):
+        self._upload([])
+
+        assert self.xnat.put_resources.call_args[1]["overwrite"] is True
+
+    def test_files_missing_from_upload_reported_as_failed(self):
+        failed, archive = self._upload(["session/notes.txt"])
+
+        assert failed == [os.path.join(archive, "session/behav.csv")]
+
+    @patch('bin.dm_xnat_upload.process_archive')
+    @patch('datman.config.config')
+    def test_exits_with_error_when_any_file_fails(self, mock_config,
+                                                  mock_process):
+        mock_process.side_effect = [[], ["STUDY_SITE_9999_01_01.zip"]]
+        argv = ["dm_xnat_upload.py", "STUDY"]
+
+        with patch('sys.argv', argv), \
+                patch('os.listdir', return_value=["a.zip", "b.zip"]), \
+                patch('datman.archive_cache.get_cache'), \
+                patch.object(upload, 'ARCHIVE_CACHE'), \
+                patch.object(upload, 'CFG'), \
+                self.assertRaises(SystemExit) as exit_:
+            upload.main()
+
+        assert exit_.exception.code == 1
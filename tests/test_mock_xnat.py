@@ -0,0 +1,408 @@
+import importlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+import logging
+
+from mock import patch
+
+import datman.config
+import datman.scanid
+import datman.xnat
+import datman.xnat_cache
+import datman.xnat_stats
+from mock_xnat import MockXnat, generate_dataset
+
+extract = importlib.import_module("bin.dm_xnat_extract")
+
+# Dont care about logging for these tests
+logging.disable(logging.CRITICAL)
+
+PROJECT = "MOCK01"
+SESSION = "MOCK01_SITE_0001_01_01"
+
+
+class TestMockXnat(unittest.TestCase):
+    """Runs datman.xnat against the mock XNAT server."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data_dir = tempfile.mkdtemp(prefix="mock_xnat_test_")
+        generate_dataset(
+            cls.data_dir,
+            experiments=3,
+            scans=2,
+            files=3,
+            file_size=256,
+            resources=1,
+            seed=0,
+        )
+        cls.mock = MockXnat(cls.data_dir)
+        cls.mock.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mock.stop()
+        shutil.rmtree(cls.data_dir)
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="mock_xnat_test_")
+        self.xnat = datman.xnat.xnat(
+            self.mock.url, "user", "pass", retry_backoff=0
+        )
+        self.mock.reset_counts()
+
+    def tearDown(self):
+        self.xnat.session.close()
+        shutil.rmtree(self.tmp)
+
+    def test_lists_projects(self):
+        projects = self.xnat.get_projects()
+
+        assert [p["ID"] for p in projects] == [PROJECT]
+
+    def test_experiment_has_scans_and_resources(self):
+        experiment = self.xnat.get_experiment(PROJECT, SESSION, SESSION)
+
+        assert [scan.series for scan in experiment.scans] == ["1", "2"]
+        assert len(experiment.scan_resource_IDs) == 2
+        assert list(experiment.resource_IDs) == ["MISC"]
+
+    def test_lists_resources_with_one_request(self):
+        experiment = self.xnat.get_experiment(PROJECT, SESSION, SESSION)
+        self.mock.reset_counts()
+
+        resources = experiment.get_resources(self.xnat)
+
+        assert "file1.txt" in resources
+        assert sum(self.mock.requests.values()) == 1
+
+    def test_gets_project_experiments_with_one_request_each(self):
+        found = self.xnat.get_project_experiments(PROJECT)
+
+        assert len(found) == 3
+        assert self.mock.requests["GET experiments"] == 1
+        assert self.mock.requests["GET experiment"] == 3
+
+    def test_experiments_collected_with_one_listing_per_project(self):
+        with patch.object(extract, "get_projects",
+                          return_value={PROJECT: ["SITE"]}), \
+                patch("datman.xnat.get_connection", return_value=self.xnat), \
+                patch("datman.utils.validate_subject_id",
+                      side_effect=lambda ident, _: datman.scanid.parse(ident)):
+            experiments = extract.collect_all_experiments(None)
+
+        assert len(experiments) == 3
+        assert all(exp[3] for exp in experiments)
+        assert self.mock.requests["GET experiments"] == 1
+
+    def test_cached_experiment_reused_by_later_run(self):
+        cache_path = os.path.join(self.tmp, "xnat_cache.sqlite")
+        for _ in range(2):
+            self.mock.reset_counts()
+            connection = datman.xnat.xnat(
+                self.mock.url, "user", "pass", retry_backoff=0
+            )
+            connection.cache = datman.xnat_cache.XnatCache(cache_path)
+            experiment = connection.get_experiment(PROJECT, SESSION, SESSION)
+            connection.cache.close()
+            connection.session.close()
+
+        assert [scan.series for scan in experiment.scans] == ["1", "2"]
+        assert self.mock.requests["GET experiments"] == 1
+        assert self.mock.requests["GET experiment"] == 0
+
+    def test_retries_failed_requests(self):
+        self.mock.fail_next(2)
+
+        projects = self.xnat.get_projects(PROJECT)
+
+        assert projects[0]["data_fields"]["ID"] == PROJECT
+        assert self.mock.requests["GET project"] == 3
+
+    def test_renews_expired_session(self):
+        self.mock.expire_sessions()
+
+        assert self.xnat.get_subject_ids(PROJECT)
+
+    def test_resumes_dropped_download(self):
+        self.mock.drop_next()
+        dest = os.path.join(self.tmp, "scan.zip")
+
+        self.xnat.get_dicom(PROJECT, SESSION, SESSION, "1", filename=dest)
+
+        with zipfile.ZipFile(dest) as zf:
+            assert zf.testzip() is None
+            assert len(zf.namelist()) == 3
+        assert self.mock.requests["GET files"] == 2
+
+    def test_small_archives_staged_in_memory(self):
+        archive = self.xnat.stream_dicom(
+            PROJECT, SESSION, SESSION, "1", memory_limit=2 ** 20,
+            temp_dir=self.tmp
+        )
+
+        with archive:
+            assert isinstance(archive, io.BytesIO)
+            assert os.listdir(self.tmp) == []
+            with zipfile.ZipFile(archive) as zf:
+                assert len(zf.namelist()) == 3
+
+    def test_large_archives_staged_on_disk(self):
+        archive = self.xnat.stream_dicom(
+            PROJECT, SESSION, SESSION, "1", memory_limit=0, temp_dir=self.tmp
+        )
+
+        with archive:
+            assert os.path.dirname(archive.name) == self.tmp
+            with zipfile.ZipFile(archive) as zf:
+                assert len(zf.namelist()) == 3
+        assert os.listdir(self.tmp) == []
+
+    def test_unpacks_series_without_writing_archive(self):
+        experiment = self.xnat.get_experiment(PROJECT, SESSION, SESSION)
+
+        for limit in (0, 2 ** 20):
+            dest = tempfile.mkdtemp(dir=self.tmp)
+            with patch.object(extract, "STAGING_MEMORY", limit):
+                series_dir = extract.get_dicom_archive_from_xnat(
+                    self.xnat, experiment.scans[0], dest
+                )
+
+            assert sorted(os.listdir(series_dir)) == [
+                "0001.dcm", "0002.dcm", "0003.dcm"
+            ]
+            for root, _, files in os.walk(dest):
+                assert not [f for f in files if not f.endswith(".dcm")]
+
+    def test_records_resumed_download_as_one_request(self):
+        self.xnat.stats = datman.xnat_stats.RequestStats()
+        self.mock.drop_next()
+        dest = os.path.join(self.tmp, "scan.zip")
+
+        self.xnat.get_dicom(PROJECT, SESSION, SESSION, "1", filename=dest)
+
+        downloads = [r for r in self.xnat.stats.records
+                     if r["endpoint"].endswith("files")]
+        assert len(downloads) == 1
+        assert downloads[0]["retries"] == 1
+        assert downloads[0]["received"] == os.path.getsize(dest)
+
+    def _get_exports(self, copies=3):
+        experiment = self.xnat.get_experiment(PROJECT, SESSION, SESSION)
+        scans = experiment.scans * copies
+        return [(scan, [(f"output{num}", ["nii"])])
+                for num, scan in enumerate(scans)]
+
+    def test_downloads_ahead_of_exports_bounded(self):
+        lock = threading.Lock()
+        held = []
+        counts = {"downloaded": 0, "exported": 0}
+        download = extract.get_dicom_archive_from_xnat
+
+        def counted_download(*args):
+            with lock:
+                counts["downloaded"] += 1
+                held.append(counts["downloaded"] - counts["exported"])
+            return download(*args)
+
+        def slow_export(*args):
+            time.sleep(0.05)
+            with lock:
+                counts["exported"] += 1
+
+        with patch.object(extract, "DOWNLOAD_WORKERS", 2), \
+                patch.object(extract, "get_dicom_archive_from_xnat",
+                             side_effect=counted_download), \
+                patch.object(extract, "export_scan", side_effect=slow_export):
+            extract.get_scans(self.xnat, datman.scanid.parse(SESSION),
+                              self._get_exports())
+
+        assert counts == {"downloaded": 6, "exported": 6}
+        assert max(held) == 4
+
+    def test_each_export_gets_its_own_series(self):
+        download = extract.get_dicom_archive_from_xnat
+
+        def first_series_slower(xnat, xnat_scan, tempdir):
+            if xnat_scan.series == "1":
+                time.sleep(0.05)
+            return download(xnat, xnat_scan, tempdir)
+
+        exported = {}
+
+        def record_export(ident, xnat_scan, src_dir, output_name, formats):
+            exported[output_name] = (xnat_scan.series, src_dir)
+
+        exports = self._get_exports(copies=2)
+        with patch.object(extract, "DOWNLOAD_WORKERS", 2), \
+                patch.object(extract, "get_dicom_archive_from_xnat",
+                             side_effect=first_series_slower), \
+                patch.object(extract, "export_scan",
+                             side_effect=record_export):
+            extract.get_scans(self.xnat, datman.scanid.parse(SESSION),
+                              exports)
+
+        assert list(exported) != [names[0][0] for _, names in exports]
+        assert len(exported) == 4
+        for scan, [(output_name, _)] in exports:
+            series, src_dir = exported[output_name]
+            assert series == scan.series
+            assert f"/scans/{scan.series}-" in src_dir
+
+    def test_failed_download_doesnt_stop_other_series(self):
+        download = extract.get_dicom_archive_from_xnat
+
+        def fail_first_series(xnat, xnat_scan, tempdir):
+            if xnat_scan.series == "1":
+                raise RuntimeError("Download failed")
+            return download(xnat, xnat_scan, tempdir)
+
+        with patch.object(extract, "DOWNLOAD_WORKERS", 2), \
+                patch.object(extract, "get_dicom_archive_from_xnat",
+                             side_effect=fail_first_series), \
+                patch.object(extract, "export_scan") as mock_export, \
+                patch.object(extract.logger, "error") as mock_error:
+            extract.get_scans(self.xnat, datman.scanid.parse(SESSION),
+                              self._get_exports())
+
+        exported = [call[0][1].series for call in mock_export.call_args_list]
+        assert exported == ["2", "2", "2"]
+        assert any("RuntimeError: Download failed" in call[0][0]
+                   for call in mock_error.call_args_list)
+
+    def _write_config(self):
+        with open(os.path.join(self.tmp, "main.yml"), "w") as fh:
+            fh.write(
+                "SystemSettings:\n"
+                "  test:\n"
+                f"    DatmanProjectsDir: {self.tmp}\n"
+                f"    ConfigDir: {self.tmp}\n"
+                "Projects:\n"
+                "  MOCK: mock.yml\n"
+                "Paths:\n"
+                "  meta: metadata/\n"
+                "  dcm: data/dcm/\n"
+                "  resources: data/RESOURCES/\n"
+                "ExportSettings:\n"
+                "  T1: {Formats: [dcm], Pattern: {SeriesDescription: T1}}\n"
+                "  RST: {Formats: [dcm], Pattern: {SeriesDescription: RST}}\n"
+            )
+        with open(os.path.join(self.tmp, "mock.yml"), "w") as fh:
+            fh.write(
+                "ProjectDir: MOCK\n"
+                f"StudyTag: {PROJECT}\n"
+                "Sites:\n"
+                "  SITE:\n"
+                f"    XnatArchive: {PROJECT}\n"
+                "    ExportInfo:\n"
+                "      T1: {}\n"
+                "      RST: {}\n"
+            )
+        metadata = os.path.join(self.tmp, "MOCK", "metadata")
+        os.makedirs(metadata)
+        with open(os.path.join(metadata, "blacklist.csv"), "w") as fh:
+            fh.write("series\treason\n")
+        return os.path.join(self.tmp, "main.yml")
+
+    def test_experiments_processed_by_worker_processes(self):
+        labels = sorted(self.xnat.get_experiment_ids(PROJECT))
+        experiments = [
+            (self.xnat, PROJECT, datman.scanid.parse(label),
+             self.xnat.get_experiment(PROJECT, label, label))
+            for label in labels
+        ]
+        # Leave one to be retrieved by the worker
+        experiments[0] = experiments[0][:3] + (None,)
+        missing = "MOCK01_SITE_9998_01_01"
+        experiments.append(
+            (self.xnat, PROJECT, datman.scanid.parse(missing), None)
+        )
+        worker_settings = {
+            "study": "MOCK",
+            "log_levels": (True, False, False),
+            "auth": ("user", "pass"),
+            "server_override": None,
+            "dryrun": False,
+            "db_ignore": True,
+            "wanted_tags": None,
+            "download_workers": 2,
+            "request_log": None
+        }
+
+        with patch.dict(os.environ, {"DM_CONFIG": self._write_config(),
+                                     "DM_SYSTEM": "test"}):
+            results = extract.process_in_parallel(experiments, 2,
+                                                  worker_settings)
+
+        assert sorted(results) == (
+            [(label, True) for label in labels] + [(missing, False)]
+        )
+        for label in labels:
+            dcm_dir = os.path.join(self.tmp, "MOCK", "data", "dcm",
+                                   label[:-3])
+            assert sorted(os.listdir(dcm_dir)) == [
+                f"{label}_RST_02_RST.dcm", f"{label}_T1_01_T1.dcm"
+            ]
+
+    def test_results_reported_with_failures_as_errors(self):
+        results = [("MOCK01_SITE_0002_01_01", False),
+                   ("MOCK01_SITE_0001_01_01", True)]
+
+        with patch.object(extract.logger, "info") as mock_info, \
+                patch.object(extract.logger, "error") as mock_error:
+            extract.report_results(results)
+
+        assert [call[0][0] for call in mock_info.call_args_list] == [
+            "Processed 2 experiments. 1 succeeded, 1 failed.",
+            "MOCK01_SITE_0001_01_01 - succeeded"
+        ]
+        mock_error.assert_called_once_with("MOCK01_SITE_0002_01_01 - failed")
+
+    def test_request_stats_logged(self):
+        self.xnat.stats = datman.xnat_stats.RequestStats()
+        self.xnat.get_projects()
+
+        with patch.object(extract.logger, "info") as mock_info, \
+                patch("builtins.print") as mock_print:
+            extract.report_request_stats(self.xnat.stats)
+
+        assert not mock_print.called
+        report = mock_info.call_args[0][0]
+        assert report.startswith("1 XNAT requests")
+
+    def test_uploaded_resources_are_listed(self):
+        self.xnat.put_resource(
+            PROJECT, SESSION, SESSION, "notes/new.txt", b"data", "MISC"
+        )
+        experiment = self.xnat.get_experiment(PROJECT, SESSION, SESSION)
+
+        files = self.xnat.get_file_listing(
+            experiment.id, [experiment.resource_IDs["MISC"]]
+        )
+
+        assert "new.txt" in [os.path.basename(f["name"]) for f in files]
+
+    def test_uploaded_dicoms_make_a_new_experiment(self):
+        source = os.path.join(
+            self.data_dir, PROJECT, SESSION, SESSION, "scans", "1-T1", "DICOM"
+        )
+        archive = os.path.join(self.tmp, "upload.zip")
+        with zipfile.ZipFile(archive, "w") as zf:
+            for fname in os.listdir(source):
+                zf.write(os.path.join(source, fname), f"T1/{fname}")
+
+        self.xnat.put_dicoms(
+            PROJECT, "MOCK01_SITE_9999_01_01", "MOCK01_SITE_9999_01_01",
+            archive
+        )
+        experiment = self.xnat.get_experiment(
+            PROJECT, "MOCK01_SITE_9999_01_01", "MOCK01_SITE_9999_01_01"
+        )
+
+        assert [scan.description for scan in experiment.scans] == ["T1"]
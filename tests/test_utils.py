@@ -1,14 +1,25 @@
 #!/usr/bin/env python
 
+import hashlib
+import io
+import os
+import random
+import shutil
+import tarfile
+import tempfile
+import time
 import unittest
 import logging
+import zipfile
 
 import pytest
 from mock import patch, MagicMock
 
 import datman.utils as utils
 import datman.config
+import datman.archive_cache
 from datman.exceptions import ParseException
+from mock_xnat import make_dicom
 
 logging.disable(logging.CRITICAL)
 
@@ -119,3 +130,323 @@ class TestValidateSubjectID:
         with pytest.raises(ParseException):
             bad_site = "AND01_UFO_0408_01_SE01_MR"
             utils.validate_subject_id(bad_site, dm_config)
+
+
+class TestGetMetaFileSetting(unittest.TestCase):
+    def _config(self, setting):
+        config = MagicMock()
+        if setting is None:
+            config.get_key.side_effect = datman.config.UndefinedSetting
+        else:
+            config.get_key.return_value = setting
+        config.get_path.return_value = "/study/metadata"
+        return config
+
+    def _get(self, setting):
+        return utils.get_meta_file_setting(
+            self._config(setting), "SomeCache", "cache.sqlite")
+
+    def test_nothing_returned_when_undefined_or_off(self):
+        assert self._get(None) is None
+        assert self._get(False) is None
+
+    def test_default_file_used_when_true(self):
+        assert self._get(True) == "/study/metadata/cache.sqlite"
+
+    def test_file_names_found_in_metadata_folder(self):
+        assert self._get("other.sqlite") == "/study/metadata/other.sqlite"
+
+    def test_full_paths_used_as_given(self):
+        assert self._get("/shared/cache.sqlite") == "/shared/cache.sqlite"
+
+
+class TestGetPositiveInt(unittest.TestCase):
+    def test_returns_value_as_int(self):
+        assert utils.get_positive_int({"--jobs": "4"}, "--jobs") == 4
+
+    def test_exits_for_values_that_arent_positive_ints(self):
+        for value in ["0", "-2", "many"]:
+            with self.assertRaises(SystemExit):
+                utils.get_positive_int({"--jobs": value}, "--jobs")
+
+
+class TestGetArchiveManifest(unittest.TestCase):
+    def _make_zip(self, temp, notes=b"some notes"):
+        archive = os.path.join(temp, "STUDY_SITE_0001_01_01.zip")
+        with zipfile.ZipFile(archive, "w") as zf:
+            zf.writestr("STUDY_SITE_0001_01_01/1/image.dcm", b"x" * 10)
+            zf.writestr("STUDY_SITE_0001_01_01/notes.txt", notes)
+        return archive
+
+    def test_files_sorted_into_dicoms_and_resources(self):
+        with utils.make_temp_directory() as temp:
+            manifest = utils.get_archive_manifest(self._make_zip(temp))
+
+        assert manifest["dicoms"] == [{
+            "name": "STUDY_SITE_0001_01_01/1/image.dcm", "size": 10,
+            "md5": None}]
+        assert manifest["resources"] == [{
+            "name": "STUDY_SITE_0001_01_01/notes.txt", "size": 10,
+            "md5": None}]
+
+    def test_checksums_computed_when_requested(self):
+        with utils.make_temp_directory() as temp:
+            manifest = utils.get_archive_manifest(self._make_zip(temp),
+                                                  checksums=True)
+
+        expected = hashlib.md5(b"some notes").hexdigest()
+        assert manifest["resources"][0]["md5"] == expected
+
+    def test_cached_manifest_used_until_archive_changes(self):
+        with utils.make_temp_directory() as temp:
+            cache = datman.archive_cache.ArchiveCache(
+                os.path.join(temp, "cache.sqlite"))
+            archive = self._make_zip(temp)
+            utils.get_archive_manifest(archive, cache=cache)
+
+            with patch.object(utils, "get_resources") as mock_resources:
+                utils.get_archive_manifest(archive, cache=cache)
+                assert not mock_resources.called
+
+            # Make sure modification time differs
+            time.sleep(0.01)
+            self._make_zip(temp, notes=b"updated notes")
+            manifest = utils.get_archive_manifest(archive, cache=cache)
+            cache.close()
+
+        assert manifest["resources"][0]["size"] == 13
+
+
+class TestReadDicomHeader(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp(prefix="dm_test_utils_")
+        self.dicom = os.path.join(self.temp, "0001.dcm")
+        make_dicom(self.dicom, "STUDY_SITE_0001_01_01", 3, "T1", 1, 1024,
+                   random.Random(0))
+        self.text = os.path.join(self.temp, "notes.txt")
+        with open(self.text, "w") as fh:
+            fh.write("some notes")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def test_preamble_identifies_dicoms(self):
+        assert utils.has_dicom_preamble(self.dicom)
+        assert not utils.has_dicom_preamble(self.text)
+        assert not utils.has_dicom_preamble(
+            os.path.join(self.temp, "missing.dcm"))
+
+    def test_file_object_position_is_kept(self):
+        with open(self.dicom, "rb") as fh:
+            assert utils.is_dicom(fh)
+            assert fh.tell() == 0
+
+    def test_reads_header_without_pixel_data(self):
+        header = utils.read_dicom_header(self.dicom)
+
+        assert header.SeriesDescription == "T1"
+        assert "PixelData" not in header
+
+    def test_reads_only_specific_tags(self):
+        header = utils.read_dicom_header(self.dicom,
+                                         specific_tags=["SeriesNumber"])
+
+        assert header.SeriesNumber == 3
+        assert "SeriesDescription" not in header
+
+    def test_raises_for_non_dicoms(self):
+        with pytest.raises(datman.utils.dcm.errors.InvalidDicomError):
+            utils.read_dicom_header(io.BytesIO(b"x" * 200))
+
+
+class TestGetArchiveHeaders(unittest.TestCase):
+    def setUp(self):
+        self.temp = tempfile.mkdtemp(prefix="dm_test_utils_")
+        self.folder = os.path.join(self.temp, "STUDY_SITE_0001_01_01")
+        rng = random.Random(0)
+        for series in (1, 2, 3):
+            series_dir = os.path.join(self.folder, str(series))
+            os.makedirs(series_dir)
+            with open(os.path.join(series_dir, "0000.txt"), "w") as fh:
+                fh.write("not a dicom")
+            for num in (1, 2):
+                make_dicom(os.path.join(series_dir, f"{num:04}.dcm"),
+                           "STUDY_SITE_0001_01_01", series, f"S{series}",
+                           num, 64, rng)
+        self.zip = shutil.make_archive(self.folder, "zip", self.temp,
+                                       "STUDY_SITE_0001_01_01")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp)
+
+    def test_finds_one_header_per_zip_folder(self):
+        manifest = utils.get_archive_headers(self.zip, workers=3)
+
+        assert sorted(manifest) == [
+            f"STUDY_SITE_0001_01_01/{series}" for series in (1, 2, 3)]
+        for folder, header in manifest.items():
+            assert header.SeriesNumber == int(folder[-1])
+            assert header.InstanceNumber == 1
+
+    def test_threads_give_same_manifest(self):
+        for path in (self.zip, self.folder):
+            serial = utils.get_archive_headers(path, workers=1)
+            threaded = utils.get_archive_headers(path, workers=4)
+
+            assert list(serial) == list(threaded)
+            assert ([h.SOPInstanceUID for h in serial.values()] ==
+                    [h.SOPInstanceUID for h in threaded.values()])
+
+    def test_stop_after_first_reads_one_header(self):
+        manifest = utils.get_archive_headers(self.zip, stop_after_first=True)
+
+        assert len(manifest) == 1
+
+    def test_reads_many_archives(self):
+        missing = os.path.join(self.temp, "missing.zip")
+
+        manifests = utils.get_headers_for_archives(
+            [self.zip, self.folder, missing], workers=2)
+
+        assert len(manifests[self.zip]) == 3
+        assert len(manifests[self.folder]) == 3
+        assert isinstance(manifests[missing], Exception)
+
+    def test_cached_headers_used_until_archive_changes(self):
+        cache = datman.archive_cache.ArchiveCache(
+            os.path.join(self.temp, "cache.sqlite"))
+        expected = utils.get_archive_headers(self.zip, cache=cache)
+
+        with patch.object(utils, "get_zipfile_headers") as mock_headers:
+            cached = utils.get_archive_headers(self.zip, cache=cache)
+            assert not mock_headers.called
+
+        assert list(cached) == list(expected)
+        for folder, header in cached.items():
+            assert header.SeriesInstanceUID == \
+                expected[folder].SeriesInstanceUID
+            assert str(header.PatientName) == "STUDY_SITE_0001_01_01"
+
+        # Make sure modification time differs
+        time.sleep(0.01)
+        shutil.rmtree(os.path.join(self.folder, "3"))
+        shutil.make_archive(self.folder, "zip", self.temp,
+                            "STUDY_SITE_0001_01_01")
+        manifests = utils.get_headers_for_archives(
+            [self.zip, self.folder], workers=1, cache=cache)
+        cache.close()
+
+        assert len(manifests[self.zip]) == 2
+        assert len(manifests[self.folder]) == 2
+
+    def test_tar_index_cached_for_later_reads(self):
+        tar = shutil.make_archive(self.folder, "gztar", self.temp,
+                                  "STUDY_SITE_0001_01_01")
+        cache = datman.archive_cache.ArchiveCache(
+            os.path.join(self.temp, "cache.sqlite"))
+        expected = utils.get_tarfile_headers(tar, cache=cache)
+        index = cache.get(tar, "tar_index")
+
+        with patch.object(tarfile.TarFile, "__iter__") as mock_iter:
+            indexed = utils.get_tarfile_headers(tar, cache=cache)
+            first = utils.get_tarfile_headers(tar, stop_after_first=True,
+                                              cache=cache)
+            assert not mock_iter.called
+        cache.close()
+
+        assert [entry[0] for entry in index["members"]] == list(expected)
+        assert list(indexed) == list(expected)
+        for folder, header in indexed.items():
+            assert header.SOPInstanceUID == expected[folder].SOPInstanceUID
+        assert list(first) == list(expected)[:1]
+
+    def test_tar_index_used_before_listing_archive(self):
+        tar = shutil.make_archive(self.folder, "gztar", self.temp,
+                                  "STUDY_SITE_0001_01_01")
+        cache = datman.archive_cache.ArchiveCache(
+            os.path.join(self.temp, "cache.sqlite"))
+        first = utils.get_archive_headers(tar, stop_after_first=True,
+                                          cache=cache)
+        assert not cache.get(tar, "tar_index")["complete"]
+
+        with patch.object(tarfile.TarFile, "__iter__") as mock_iter:
+            again = utils.get_headers_for_archives(
+                [tar], stop_after_first=True, workers=1, cache=cache)
+            assert not mock_iter.called
+
+        expected = utils.get_archive_headers(tar, cache=cache)
+
+        with patch.object(tarfile.TarFile, "__iter__") as mock_iter:
+            indexed = utils.get_archive_headers(tar, cache=cache)
+            both = utils.get_headers_for_archives([tar], workers=1,
+                                                  cache=cache)
+            assert not mock_iter.called
+        cache.close()
+
+        assert list(again[tar]) == list(first)
+        assert len(expected) == 3
+        assert list(indexed) == list(expected)
+        assert list(both[tar]) == list(expected)
+
+    def test_resources_found_without_reading_whole_files(self):
+        with zipfile.ZipFile(self.zip, "a") as zf:
+            zf.write(os.path.join(self.folder, "1", "0001.dcm"),
+                     "STUDY_SITE_0001_01_01/1/IM0001")
+        cache = datman.archive_cache.ArchiveCache(
+            os.path.join(self.temp, "cache.sqlite"))
+
+        with zipfile.ZipFile(self.zip) as zf, \
+                patch.object(zf, "read") as mock_read:
+            resources = utils.get_resources(zf, cache=cache)
+            assert not mock_read.called
+            with patch.object(zf, "open") as mock_open:
+                assert utils.get_resources(zf, cache=cache) == resources
+                assert not mock_open.called
+        cache.close()
+
+        assert sorted(resources) == [
+            f"STUDY_SITE_0001_01_01/{series}/0000.txt"
+            for series in (1, 2, 3)]
+
+    def test_reads_all_headers_in_folder(self):
+        manifest = utils.get_all_headers_in_folder(
+            os.path.join(self.folder, "1"))
+
+        assert sorted(os.path.basename(f) for f in manifest) == [
+            "0001.dcm", "0002.dcm"]
+
+
+class TestFindUnsyncedFiles:
+    local = [
+        {"name": "resources/behav/run1.log", "size": 100, "md5": "aaa"},
+        {"name": "resources/behav/run2.log", "size": 200, "md5": "bbb"}
+    ]
+
+    def test_returns_nothing_when_all_files_match(self):
+        remote = [
+            {"name": "/data/files/run2.log", "size": 200, "md5": "bbb"},
+            {"name": "/data/files/run1.log", "size": 100, "md5": None}
+        ]
+
+        assert utils.find_unsynced_files(self.local, remote) == []
+
+    def test_finds_missing_truncated_and_corrupted_files(self):
+        remote = [
+            {"name": "/data/files/run1.log", "size": 100, "md5": "ccc"}
+        ]
+        assert utils.find_unsynced_files(self.local, remote) == [
+            "resources/behav/run1.log", "resources/behav/run2.log"]
+
+        remote = [
+            {"name": "/data/files/run1.log", "size": 100, "md5": "aaa"},
+            {"name": "/data/files/run2.log", "size": 150, "md5": None}
+        ]
+        assert utils.find_unsynced_files(self.local, remote) == [
+            "resources/behav/run2.log"]
+
+    def test_duplicate_names_need_one_match_each(self):
+        local = [{"name": "a/notes.txt", "size": 5},
+                 {"name": "b/notes.txt", "size": 5}]
+        remote = [{"name": "notes.txt", "size": 5}]
+
+        assert utils.find_unsynced_files(local, remote) == ["b/notes.txt"]
@@ -1,11 +1,17 @@
+import io
 import os
+import pickle
+import time
 import unittest
+import zipfile
 import logging
 
 from mock import Mock, patch
 import pytest
 
+import datman.utils
 import datman.xnat
+import datman.xnat_stats
 # Used only to act as a spec for Mock
 from datman.config import config as Config
 
@@ -182,3 +188,835 @@ class TestGetAuth(unittest.TestCase):
         with pytest.raises(KeyError):
             with patch.dict('os.environ', env, clear=True):
                 datman.xnat.get_auth()
+
+
+class TestGetConnectionSettings(unittest.TestCase):
+    def setUp(self):
+        self.mock_config = Mock(spec=Config)
+
+    def test_returns_empty_dict_when_no_settings_defined(self):
+        def get_key(key, site=None):
+            raise datman.xnat.UndefinedSetting(key)
+        self.mock_config.get_key.side_effect = get_key
+
+        result = datman.xnat.get_connection_settings(self.mock_config)
+
+        assert result == {}
+
+    def test_maps_defined_settings_to_connection_arguments(self):
+        settings = {'XnatPoolSize': 20, 'XnatKeepAlive': False}
+
+        def get_key(key, site=None):
+            try:
+                return settings[key]
+            except KeyError:
+                raise datman.xnat.UndefinedSetting(key)
+        self.mock_config.get_key.side_effect = get_key
+
+        result = datman.xnat.get_connection_settings(self.mock_config)
+
+        assert result == {'pool_size': 20, 'keep_alive': False}
+
+
+class TestXnatSession(unittest.TestCase):
+    @patch('datman.xnat.xnat.open_session')
+    def test_session_pool_uses_configured_size(self, mock_open):
+        connection = datman.xnat.xnat("https://fakeserver.ca", "user",
+                                      "pass", pool_size=25)
+
+        session = connection._make_session()
+
+        adapter = session.get_adapter("https://fakeserver.ca")
+        assert adapter._pool_maxsize == 25
+
+    @patch('datman.xnat.xnat.open_session')
+    def test_connection_close_header_set_when_keep_alive_disabled(
+            self, mock_open):
+        connection = datman.xnat.xnat("https://fakeserver.ca", "user",
+                                      "pass", keep_alive=False)
+
+        session = connection._make_session()
+
+        assert session.headers["Connection"] == "close"
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_no_delay_given_once_retries_used_up(self):
+        policy = datman.xnat.RetryPolicy(retries=2)
+
+        assert policy.get_delay(1, time.monotonic()) is not None
+        assert policy.get_delay(2, time.monotonic()) is None
+
+    def test_delay_grows_exponentially_up_to_max(self):
+        policy = datman.xnat.RetryPolicy(retries=10, backoff=1,
+                                         max_backoff=5)
+
+        with patch('datman.xnat.random.uniform',
+                   side_effect=lambda low, high: high):
+            delays = [policy.get_delay(n, time.monotonic())
+                      for n in range(5)]
+
+        assert delays == [1, 2, 4, 5, 5]
+
+    def test_no_delay_given_when_it_would_pass_deadline(self):
+        policy = datman.xnat.RetryPolicy(backoff=1, deadline=10)
+
+        with patch('datman.xnat.random.uniform',
+                   side_effect=lambda low, high: high):
+            delay = policy.get_delay(0, time.monotonic() - 9.5)
+
+        assert delay is None
+
+    def test_post_only_idempotent_when_marked(self):
+        policy = datman.xnat.RetryPolicy()
+
+        assert policy.is_idempotent("GET")
+        assert not policy.is_idempotent("POST")
+        assert policy.is_idempotent("POST", idempotent=True)
+
+
+class TestRequest(unittest.TestCase):
+    url = "https://fakeserver.ca/data/projects"
+
+    def setUp(self):
+        with patch('datman.xnat.xnat.open_session'):
+            self.xnat = datman.xnat.xnat("https://fakeserver.ca", "user",
+                                         "pass", retry_backoff=0)
+        self.xnat.session = Mock()
+
+    def _response(self, status):
+        response = Mock()
+        response.status_code = status
+        return response
+
+    def test_retries_gateway_errors_for_idempotent_requests(self):
+        self.xnat.session.request.side_effect = [
+            self._response(502), self._response(504), self._response(200)
+        ]
+
+        response = self.xnat._request("GET", self.url)
+
+        assert response.status_code == 200
+        assert self.xnat.session.request.call_count == 3
+
+    def test_returns_error_response_when_retries_used_up(self):
+        self.xnat.session.request.return_value = self._response(503)
+
+        response = self.xnat._request("DELETE", self.url, retries=1)
+
+        assert response.status_code == 503
+        assert self.xnat.session.request.call_count == 2
+
+    def test_does_not_retry_post_unless_idempotent(self):
+        self.xnat.session.request.return_value = self._response(502)
+
+        self.xnat._request("POST", self.url, data=b"data")
+
+        assert self.xnat.session.request.call_count == 1
+
+    def test_rewinds_file_before_retrying(self):
+        data = io.BytesIO(b"some data")
+        positions = []
+
+        def request(method, url, **kwargs):
+            positions.append(kwargs['data'].tell())
+            kwargs['data'].read()
+            return self._response(504 if len(positions) == 1 else 200)
+        self.xnat.session.request.side_effect = request
+
+        self.xnat._request("POST", self.url, data=data, idempotent=True)
+
+        assert positions == [0, 0]
+
+    def test_records_request_with_retries(self):
+        self.xnat.stats = datman.xnat_stats.RequestStats()
+        response = self._response(200)
+        response.content = b"{}"
+        self.xnat.session.request.side_effect = [
+            self._response(503), response
+        ]
+
+        self.xnat._request("GET", self.url)
+
+        assert len(self.xnat.stats.records) == 1
+        record = self.xnat.stats.records[0]
+        assert record["status"] == 200
+        assert record["retries"] == 1
+        assert record["received"] == 2
+
+    def test_renews_session_once_when_unauthorized(self):
+        self.xnat.session.request.return_value = self._response(401)
+
+        with patch.object(self.xnat, 'open_session') as mock_open:
+            response = self.xnat._request("POST", self.url)
+
+        assert mock_open.call_count == 1
+        assert response.status_code == 401
+        assert self.xnat.session.request.call_count == 2
+
+    def test_timeouts_raised_when_retries_used_up(self):
+        self.xnat.session.request.side_effect = \
+            datman.xnat.requests.exceptions.Timeout()
+
+        with pytest.raises(datman.xnat.requests.exceptions.Timeout):
+            self.xnat._request("GET", self.url, retries=2)
+
+        assert self.xnat.session.request.call_count == 3
+
+    def test_failed_post_raises_instead_of_returning_reply(self):
+        response = self._response(504)
+        response.raise_for_status.side_effect = \
+            datman.xnat.requests.exceptions.HTTPError()
+        self.xnat.session.request.return_value = response
+
+        with pytest.raises(datman.xnat.requests.exceptions.HTTPError):
+            self.xnat._make_xnat_post(self.url, b"data", idempotent=True)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_burst_allowed_then_requests_delayed(self):
+        limiter = datman.xnat.RateLimiter(rate=100, burst=3)
+        sleep = time.sleep
+
+        with patch('datman.xnat.time.sleep') as mock_sleep:
+            for _ in range(3):
+                limiter.acquire()
+            assert not mock_sleep.called
+
+            mock_sleep.side_effect = lambda wait: sleep(0.01)
+            limiter.acquire()
+            assert mock_sleep.called
+
+    def test_rate_reduced_on_errors_and_recovers(self):
+        limiter = datman.xnat.RateLimiter(rate=16)
+
+        limiter.slow_down()
+        limiter.slow_down()
+        assert limiter.rate == 4
+
+        for _ in range(20):
+            limiter.speed_up()
+        assert limiter.rate == 16
+
+    def test_limiter_shared_by_connections_to_same_server(self):
+        server = "https://shared-limit.ca"
+        with patch('datman.xnat.xnat.open_session'):
+            first = datman.xnat.xnat(server, "user", "pass", rate_limit=5)
+            second = datman.xnat.xnat(server, "user", "pass", rate_limit=5)
+
+        assert first.rate_limiter is second.rate_limiter
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    url = "https://breaker-server.ca/data/projects"
+
+    def setUp(self):
+        with patch('datman.xnat.xnat.open_session'):
+            self.xnat = datman.xnat.xnat(
+                "https://breaker-server.ca", "user", "pass", retries=0)
+        self.xnat.session = Mock()
+        self.xnat.circuit_breaker = datman.xnat.CircuitBreaker(
+            self.xnat.server, threshold=2, timeout=30)
+
+    def _fail_request(self):
+        self.xnat.session.request.side_effect = \
+            datman.xnat.requests.exceptions.ConnectionError()
+        with pytest.raises(datman.xnat.requests.exceptions.ConnectionError):
+            self.xnat._request("GET", self.url)
+
+    def test_requests_fail_fast_once_threshold_reached(self):
+        self._fail_request()
+        self._fail_request()
+        self.xnat.session.request.reset_mock()
+
+        with pytest.raises(datman.xnat.XnatException):
+            self.xnat._request("GET", self.url)
+
+        assert not self.xnat.session.request.called
+
+    def test_success_resets_failure_count(self):
+        self._fail_request()
+        self.xnat.session.request.side_effect = None
+        self.xnat.session.request.return_value = Mock(status_code=200)
+        self.xnat._request("GET", self.url)
+        self._fail_request()
+
+        assert not self.xnat.circuit_breaker.is_open
+
+    def test_trial_request_sent_after_timeout(self):
+        self._fail_request()
+        self._fail_request()
+        self.xnat.circuit_breaker._opened -= 31
+        self.xnat.session.request.side_effect = None
+        self.xnat.session.request.return_value = Mock(status_code=200)
+
+        response = self.xnat._request("GET", self.url)
+
+        assert response.status_code == 200
+        assert not self.xnat.circuit_breaker.is_open
+
+    def test_failed_trial_reopens_breaker(self):
+        self._fail_request()
+        self._fail_request()
+        self.xnat.circuit_breaker._opened -= 31
+
+        self._fail_request()
+
+        with pytest.raises(datman.xnat.XnatException):
+            self.xnat._request("GET", self.url)
+
+    def _open_breaker(self):
+        self._fail_request()
+        self._fail_request()
+        self.xnat.circuit_breaker._opened -= 31
+        self.xnat.session.request.side_effect = None
+
+    def test_trial_can_renew_expired_session(self):
+        self._open_breaker()
+        self.xnat.session.request.side_effect = [
+            Mock(status_code=401), Mock(status_code=200), Mock(status_code=200)
+        ]
+
+        with patch.object(self.xnat, "open_session") as mock_open:
+            assert self.xnat._request("GET", self.url).status_code == 200
+            assert mock_open.called
+        assert not self.xnat.circuit_breaker.is_open
+        assert self.xnat._request("GET", self.url).status_code == 200
+
+    def test_unexpected_error_during_trial_counts_as_failure(self):
+        self._open_breaker()
+        self.xnat.session.request.side_effect = \
+            datman.xnat.requests.exceptions.ChunkedEncodingError()
+
+        with pytest.raises(
+                datman.xnat.requests.exceptions.ChunkedEncodingError):
+            self.xnat._request("GET", self.url)
+
+        # The breaker reopened, so the server is tried again after a timeout
+        self.xnat.circuit_breaker._opened -= 31
+        self.xnat.session.request.side_effect = None
+        self.xnat.session.request.return_value = Mock(status_code=200)
+        assert self.xnat._request("GET", self.url).status_code == 200
+
+    def test_error_unrelated_to_server_ends_trial(self):
+        self._open_breaker()
+        self.xnat.session.request.side_effect = ValueError()
+
+        with pytest.raises(ValueError):
+            self.xnat._request("GET", self.url)
+
+        self.xnat.session.request.side_effect = None
+        self.xnat.session.request.return_value = Mock(status_code=200)
+        assert self.xnat._request("GET", self.url).status_code == 200
+
+    def test_abandoned_trial_expires(self):
+        breaker = self.xnat.circuit_breaker
+        self._open_breaker()
+        breaker.check()
+
+        with pytest.raises(datman.xnat.XnatException):
+            breaker.check()
+        breaker._trial -= 31
+        breaker.check()
+
+
+class TestUploadStream(unittest.TestCase):
+    def _zip(self, contents):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w") as zf:
+            zf.writestr("scan/notes.txt", contents)
+        return zipfile.ZipFile(buffer)
+
+    def test_zip_member_streamed_in_blocks(self):
+        zf = self._zip(b"abcdefghij")
+        progress = []
+
+        stream = datman.xnat.UploadStream.from_zip(
+            zf, "scan/notes.txt",
+            callback=lambda sent, total: progress.append((sent, total)))
+
+        assert len(stream) == 10
+        assert stream.read(4) == b"abcd"
+        assert stream.read(4) == b"efgh"
+        assert stream.read(4) == b"ij"
+        assert progress == [(4, 10), (8, 10), (10, 10)]
+
+    def test_rewinding_reopens_source(self):
+        opener = Mock(side_effect=lambda: io.BytesIO(b"abcdef"))
+        stream = datman.xnat.UploadStream(opener, 6)
+        stream.read(4)
+
+        stream.seek(0)
+
+        assert stream.tell() == 0
+        assert stream.read() == b"abcdef"
+        assert opener.call_count == 2
+
+    def _import(self, statuses, imported=False):
+        with patch('datman.xnat.xnat.open_session'):
+            connection = datman.xnat.xnat("https://fakeserver.ca", "user",
+                                          "pass", retry_backoff=0)
+        connection.session = Mock()
+        bodies = []
+
+        def request(method, url, **kwargs):
+            response = Mock(content=b"")
+            if method == "GET":
+                labels = ["SUBJECT_01"] if imported else []
+                response.status_code = 200
+                response.json.return_value = {"ResultSet": {"Result": [
+                    {"label": label} for label in labels]}}
+                return response
+            bodies.append(kwargs['data'].read(3))
+            response.status_code = statuses.pop(0)
+            response.raise_for_status.side_effect = (
+                datman.xnat.requests.exceptions.HTTPError(response=response)
+                if response.status_code != 200 else None)
+            return response
+        connection.session.request.side_effect = request
+
+        with datman.utils.make_temp_directory() as temp:
+            archive = os.path.join(temp, "archive.zip")
+            with open(archive, "wb") as fh:
+                fh.write(b"zipdata")
+            connection.put_dicoms("STUDY", "SUBJECT", "SUBJECT_01", archive)
+        return bodies
+
+    def test_whole_upload_resent_once_after_gateway_timeout(self):
+        bodies = self._import([504, 200])
+
+        assert bodies == [b"zip", b"zip"]
+
+    def test_import_not_resent_if_session_exists_after_timeout(self):
+        bodies = self._import([504], imported=True)
+
+        assert bodies == [b"zip"]
+
+    def test_import_not_retried_for_other_errors(self):
+        with pytest.raises(datman.xnat.XnatException):
+            self._import([502, 200])
+
+    def test_import_retried_only_once(self):
+        with pytest.raises(datman.xnat.XnatException):
+            self._import([504, 504, 200])
+
+
+class TestPutResources(unittest.TestCase):
+    def setUp(self):
+        with patch('datman.xnat.xnat.open_session'):
+            self.xnat = datman.xnat.xnat("https://fakeserver.ca", "user",
+                                         "pass", retries=0)
+        self.xnat.session = Mock()
+        self.xnat.session.request.side_effect = self._request
+        self.posted = []
+
+    def _request(self, method, url, **kwargs):
+        self.posted.append(url)
+        response = Mock(content=b"")
+        response.status_code = 500 if "bad.txt" in url else 200
+        return response
+
+    def _upload(self, files, overwrite=False):
+        with patch.object(self.xnat, 'get_experiment') as mock_exp, \
+                patch.object(self.xnat, 'get_resource_ids',
+                             return_value="1234") as mock_ids:
+            uploaded = self.xnat.put_resources(
+                "STUDY", "SUBJECT", "SUBJECT_01", files, "MISC", workers=3,
+                overwrite=overwrite)
+        return uploaded, mock_exp, mock_ids
+
+    def test_experiment_and_folder_found_once_for_all_files(self):
+        files = [(f"file{i}.txt", b"data") for i in range(10)]
+
+        uploaded, mock_exp, mock_ids = self._upload(files)
+
+        assert sorted(uploaded) == sorted(name for name, _ in files)
+        assert mock_exp.call_count == 1
+        assert mock_ids.call_count == 1
+        assert len(self.posted) == 10
+        assert all("/resources/1234/files/" in url for url in self.posted)
+
+    def test_failed_files_left_out(self):
+        files = [("good.txt", b"data"), ("bad.txt", b"data")]
+
+        uploaded, _, _ = self._upload(files)
+
+        assert uploaded == ["good.txt"]
+
+    def test_unavailable_server_retried_from_start_of_file(self):
+        self.xnat.retry_policy.retries = 1
+        self.xnat.retry_policy.backoff = 0
+        bodies = []
+
+        def request(method, url, **kwargs):
+            self.posted.append(url)
+            bodies.append(kwargs['data'].read())
+            response = Mock(content=b"")
+            response.status_code = 503 if len(bodies) == 1 else 200
+            return response
+        self.xnat.session.request.side_effect = request
+
+        uploaded, _, _ = self._upload([("notes.txt", io.BytesIO(b"data"))],
+                                      overwrite=True)
+
+        assert uploaded == ["notes.txt"]
+        assert bodies == [b"data", b"data"]
+        assert all("overwrite=true" in url for url in self.posted)
+
+    def test_files_not_overwritten_or_retried_by_default(self):
+        self.xnat.retry_policy.retries = 1
+        self.xnat.retry_policy.backoff = 0
+        statuses = [503, 200]
+
+        def request(method, url, **kwargs):
+            self.posted.append(url)
+            return Mock(content=b"", status_code=statuses.pop(0))
+        self.xnat.session.request.side_effect = request
+
+        uploaded, _, _ = self._upload([("notes.txt", b"data")])
+
+        assert uploaded == []
+        assert len(self.posted) == 1
+        assert "overwrite" not in self.posted[0]
+
+    def test_gateway_timeout_retried(self):
+        self.xnat.retry_policy.retries = 1
+        self.xnat.retry_policy.backoff = 0
+        statuses = [504, 200]
+
+        def request(method, url, **kwargs):
+            self.posted.append(url)
+            return Mock(content=b"", status_code=statuses.pop(0))
+        self.xnat.session.request.side_effect = request
+
+        uploaded, _, _ = self._upload([("notes.txt", b"data")],
+                                      overwrite=True)
+
+        assert uploaded == ["notes.txt"]
+        assert len(self.posted) == 2
+
+
+class TestGetXnatStream(unittest.TestCase):
+    url = "https://fakeserver.ca/data/some/file?format=zip"
+
+    def setUp(self):
+        with patch('datman.xnat.xnat.open_session'):
+            self.xnat = datman.xnat.xnat("https://fakeserver.ca", "user",
+                                         "pass", chunk_size=2)
+        self.xnat.session = Mock()
+        self.xnat.retry_policy = datman.xnat.RetryPolicy(backoff=0)
+
+    def _make_response(self, status, chunks, headers=None, fail=False):
+        def iter_content(size):
+            for chunk in chunks:
+                yield chunk
+            if fail:
+                raise datman.xnat.requests.exceptions.ChunkedEncodingError()
+
+        response = Mock()
+        response.status_code = status
+        response.headers = headers or {}
+        response.iter_content.side_effect = iter_content
+        return response
+
+    def test_interrupted_download_resumes_from_last_byte(self):
+        self.xnat.session.request.side_effect = [
+            self._make_response(200, [b"ab", b"cd"], fail=True),
+            self._make_response(206, [b"ef"],
+                                headers={"Content-Range": "bytes 4-5/6"})
+        ]
+
+        with datman.utils.make_temp_directory() as temp:
+            dest = os.path.join(temp, "download.zip")
+            self.xnat._get_xnat_stream(self.url, dest)
+
+            with open(dest, "rb") as result:
+                assert result.read() == b"abcdef"
+
+        resume_headers = self.xnat.session.request.call_args[1]["headers"]
+        assert resume_headers == {"Range": "bytes=4-"}
+
+    def test_download_restarts_when_server_ignores_range(self):
+        self.xnat.session.request.side_effect = [
+            self._make_response(200, [b"ab"], fail=True),
+            self._make_response(200, [b"ab", b"cd"])
+        ]
+
+        with datman.utils.make_temp_directory() as temp:
+            dest = os.path.join(temp, "download.zip")
+            self.xnat._get_xnat_stream(self.url, dest)
+
+            with open(dest, "rb") as result:
+                assert result.read() == b"abcd"
+
+    def test_short_body_resumed_from_last_byte(self):
+        self.xnat.session.request.side_effect = [
+            self._make_response(200, [b"ab", b"cd"],
+                                headers={"Content-Length": "6"}),
+            self._make_response(206, [b"ef"],
+                                headers={"Content-Range": "bytes 4-5/6"})
+        ]
+
+        with datman.utils.make_temp_directory() as temp:
+            dest = os.path.join(temp, "download.zip")
+            self.xnat._get_xnat_stream(self.url, dest)
+
+            with open(dest, "rb") as result:
+                assert result.read() == b"abcdef"
+
+        resume_headers = self.xnat.session.request.call_args[1]["headers"]
+        assert resume_headers == {"Range": "bytes=4-"}
+
+    def test_short_body_not_accepted_when_retries_used_up(self):
+        self.xnat.session.request.side_effect = [
+            self._make_response(200, [b"ab"], headers={"Content-Length": "6"})
+        ]
+
+        with datman.utils.make_temp_directory() as temp:
+            dest = os.path.join(temp, "download.zip")
+            with pytest.raises(
+                    datman.xnat.requests.exceptions.ChunkedEncodingError):
+                self.xnat._get_xnat_stream(self.url, dest, retries=0)
+
+            assert os.listdir(temp) == ["download.zip.part"]
+
+    def test_partial_file_kept_and_dest_not_created_on_failure(self):
+        self.xnat.session.request.side_effect = [
+            self._make_response(200, [b"ab"], fail=True)
+        ]
+
+        with datman.utils.make_temp_directory() as temp:
+            dest = os.path.join(temp, "download.zip")
+            with pytest.raises(
+                    datman.xnat.requests.exceptions.ChunkedEncodingError):
+                self.xnat._get_xnat_stream(self.url, dest, retries=0)
+
+            assert os.listdir(temp) == ["download.zip.part"]
+
+    def test_failed_download_resumed_by_next_call(self):
+        self.xnat.session.request.side_effect = [
+            self._make_response(200, [b"ab", b"cd"], fail=True),
+            self._make_response(206, [b"ef"],
+                                headers={"Content-Range": "bytes 4-5/6"})
+        ]
+
+        with datman.utils.make_temp_directory() as temp:
+            dest = os.path.join(temp, "download.zip")
+            with pytest.raises(
+                    datman.xnat.requests.exceptions.ChunkedEncodingError):
+                self.xnat._get_xnat_stream(self.url, dest, retries=0)
+            self.xnat._get_xnat_stream(self.url, dest, retries=0)
+
+            with open(dest, "rb") as result:
+                assert result.read() == b"abcdef"
+            assert os.listdir(temp) == ["download.zip"]
+
+        resume_headers = self.xnat.session.request.call_args[1]["headers"]
+        assert resume_headers == {"Range": "bytes=4-"}
+
+    def test_partial_file_restarted_if_range_not_satisfiable(self):
+        self.xnat.session.request.side_effect = [
+            self._make_response(416, []),
+            self._make_response(200, [b"ab"])
+        ]
+
+        with datman.utils.make_temp_directory() as temp:
+            dest = os.path.join(temp, "download.zip")
+            with open(dest + ".part", "wb") as stale:
+                stale.write(b"stale data")
+            self.xnat._get_xnat_stream(self.url, dest)
+
+            with open(dest, "rb") as result:
+                assert result.read() == b"ab"
+
+        first_headers = self.xnat.session.request.call_args_list[0][1]
+        assert first_headers["headers"] == {"Range": "bytes=10-"}
+        assert self.xnat.session.request.call_args[1]["headers"] is None
+
+
+class TestGetProjectExperiments(unittest.TestCase):
+    listing = {
+        "ResultSet": {
+            "Result": [
+                {"ID": "XNAT_E001", "label": "STUDY_SITE_0001_01_01",
+                 "subject_label": "STUDY_SITE_0001_01_01"},
+                {"ID": "XNAT_E002", "label": "STUDY_SITE_0002_01_01",
+                 "subject_label": "STUDY_SITE_0002_01_01"},
+                {"ID": "XNAT_E003", "label": "STUDY_SITE_0003_01_01",
+                 "subject_label": "STUDY_SITE_0003_01_01"}
+            ]
+        }
+    }
+
+    def setUp(self):
+        with patch('datman.xnat.xnat.open_session'):
+            self.xnat = datman.xnat.xnat("https://fakeserver.ca", "user",
+                                         "pass")
+
+    def _query(self, url, retries=3):
+        if "columns=" in url:
+            return self.listing
+        exp_id = url.split("/")[-1].split("?")[0]
+        if exp_id == "XNAT_E003":
+            return None
+        label = exp_id.replace("XNAT_E", "STUDY_SITE_0") + "_01_01"
+        return {"items": [{"data_fields": {"ID": exp_id, "label": label}}]}
+
+    def test_retrieves_all_experiments_that_can_be_found(self):
+        with patch.object(self.xnat, '_make_xnat_query',
+                          side_effect=self._query):
+            result = self.xnat.get_project_experiments("STUDY")
+
+        assert sorted(result) == ["STUDY_SITE_0001_01_01",
+                                  "STUDY_SITE_0002_01_01"]
+        experiment = result["STUDY_SITE_0002_01_01"]
+        assert experiment.id == "XNAT_E002"
+        assert experiment.subject == "STUDY_SITE_0002_01_01"
+
+    def test_only_requests_experiments_in_given_labels(self):
+        with patch.object(self.xnat, '_make_xnat_query',
+                          side_effect=self._query) as mock_query:
+            result = self.xnat.get_project_experiments(
+                "STUDY", labels=["STUDY_SITE_0001_01_01"])
+
+        assert list(result) == ["STUDY_SITE_0001_01_01"]
+        assert mock_query.call_count == 2
+
+
+class TestGetFileManifest(unittest.TestCase):
+    experiment_json = {
+        "data_fields": {"ID": "XNAT_E001", "label": "STUDY_SITE_0001_01_01"},
+        "children": [
+            {"field": "scans/scan", "items": [{
+                "data_fields": {"ID": "1"},
+                "children": [{"field": "file", "items": [{
+                    "data_fields": {"label": "DICOM", "format": "DICOM",
+                                    "xnat_abstractresource_id": 11}}]}]}]},
+            {"field": "resources/resource", "items": [{
+                "data_fields": {"label": "MISC",
+                                "xnat_abstractresource_id": 22}}]}
+        ]
+    }
+    listing = {"ResultSet": {"Result": [
+        {"Name": "1.dcm", "Size": "10", "URI": "/data/files/1.dcm",
+         "cat_ID": "11", "collection": "DICOM", "digest": ""},
+        {"Name": "notes.txt", "Size": "5", "URI": "/data/files/notes.txt",
+         "cat_ID": "22", "collection": "MISC", "digest": "abc"}
+    ]}}
+
+    def test_lists_all_files_with_one_request(self):
+        with patch('datman.xnat.xnat.open_session'):
+            connection = datman.xnat.xnat("https://fakeserver.ca", "user",
+                                          "pass")
+        experiment = datman.xnat.XNATExperiment(
+            "STUDY", "STUDY_SITE_0001", self.experiment_json)
+
+        with patch.object(connection, '_make_xnat_query',
+                          return_value=self.listing) as mock_query:
+            manifest = experiment.get_file_manifest(connection)
+
+        assert mock_query.call_count == 1
+        assert "/resources/11,22/files" in mock_query.call_args[0][0]
+        assert manifest["dicoms"] == [{
+            "name": "/data/files/1.dcm", "path": "1.dcm", "size": 10,
+            "md5": None, "resource": "11", "collection": "DICOM"}]
+        assert manifest["resources"][0]["md5"] == "abc"
+
+
+class TestXNATExperiment(unittest.TestCase):
+    experiment_json = {
+        "data_fields": {"ID": "XNAT_E001", "label": "STUDY_SITE_0001_01_01",
+                        "UID": "1.2.3", "date": "2021-01-01"},
+        "children": [
+            {"field": "scans/scan", "items": [{
+                "data_fields": {"ID": "1", "UID": "1.2.3.1",
+                                "type": "T1",
+                                "parameters/imageType": "ORIGINAL"},
+                "children": [{"field": "file", "items": [
+                    {"data_fields": {"label": "DICOM", "format": "DICOM",
+                                     "content": "RAW",
+                                     "xnat_abstractresource_id": 11}},
+                    {"data_fields": {"label": "NIFTI", "format": "NIFTI",
+                                     "xnat_abstractresource_id": 12}},
+                    {"data_fields": {"label": "SNAPSHOTS",
+                                     "format": "GIF",
+                                     "xnat_abstractresource_id": 13}}
+                ]}]}]},
+            {"field": "resources/resource", "items": [{
+                "data_fields": {"label": "MISC",
+                                "xnat_abstractresource_id": 22}}]}
+        ]
+    }
+
+    def _experiment(self):
+        return datman.xnat.XNATExperiment(
+            "STUDY", "STUDY_SITE_0001", self.experiment_json)
+
+    def test_reads_scans_and_resources(self):
+        experiment = self._experiment()
+
+        assert experiment.scan_UIDs == ["1.2.3.1"]
+        assert experiment.scan_resource_IDs == ["11"]
+        assert experiment.misc_resource_IDs == ["12"]
+        assert experiment.resource_IDs == {"MISC": "22"}
+        assert experiment.scans[0].description == "T1"
+        assert experiment.scans[0].raw_dicoms_exist()
+
+    def test_scans_not_made_until_used(self):
+        with patch('datman.xnat.XNATScan') as mock_scan:
+            experiment = self._experiment()
+            assert mock_scan.call_count == 0
+
+            experiment.scans
+            experiment.scan_UIDs
+
+        assert mock_scan.call_count == 1
+
+    def test_json_not_kept_after_parsing(self):
+        experiment = self._experiment()
+        experiment.scans
+
+        assert not hasattr(experiment, '__dict__')
+        assert experiment._children is None
+        assert not hasattr(experiment.scans[0], '__dict__')
+
+    def test_can_be_pickled(self):
+        experiment = self._experiment()
+
+        copy = pickle.loads(pickle.dumps(experiment))
+
+        assert copy.name == "STUDY_SITE_0001_01_01"
+        assert copy.scan_resource_IDs == ["11"]
+
+    def test_lists_resource_files_with_one_request(self):
+        with patch('datman.xnat.xnat.open_session'):
+            connection = datman.xnat.xnat("https://fakeserver.ca", "user",
+                                          "pass")
+        listing = {"ResultSet": {"Result": [
+            {"Name": "b.txt", "Size": "5", "cat_ID": "22",
+             "URI": "/data/experiments/XNAT_E001/resources/22/files/a/b.txt"}
+        ]}}
+
+        with patch.object(connection, '_make_xnat_query',
+                          return_value=listing) as mock_query:
+            resources = self._experiment().get_resources(connection)
+
+        assert mock_query.call_count == 1
+        assert "/resources/22,12/files" in mock_query.call_args[0][0]
+        assert resources == ["a/b.txt"]
+
+    def test_lists_resources_separately_if_batch_fails(self):
+        with patch('datman.xnat.xnat.open_session'):
+            connection = datman.xnat.xnat("https://fakeserver.ca", "user",
+                                          "pass")
+
+        def get_listing(exp_id, resource_ids):
+            if len(resource_ids) > 1:
+                raise datman.xnat.XnatException("Too many")
+            return [{"path": f"{resource_ids[0]}.txt"}]
+
+        with patch.object(connection, 'get_file_listing',
+                          side_effect=get_listing):
+            files = self._experiment().get_resource_files(connection)
+
+        assert sorted(f["path"] for f in files) == ["12.txt", "22.txt"]
@@ -0,0 +1,119 @@
+import asyncio
+import threading
+import time
+import unittest
+import logging
+
+from mock import patch
+
+import datman.xnat
+import datman.xnat_async
+
+# Dont care about logging for these tests
+logging.disable(logging.CRITICAL)
+
+
+class TestAsyncXnat(unittest.TestCase):
+    def setUp(self):
+        with patch('datman.xnat.xnat.open_session'):
+            self.xnat = datman.xnat.xnat("https://fakeserver.ca", "user",
+                                         "pass")
+        self.lock = threading.Lock()
+        self.active = 0
+        self.most_active = 0
+
+    def _get_experiment(self, project, subject, experiment):
+        with self.lock:
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+        time.sleep(0.01)
+        with self.lock:
+            self.active -= 1
+        if experiment == "BAD":
+            raise datman.xnat.XnatException("Not found")
+        return experiment
+
+    def _get_many(self, client, experiments):
+        async def get_all():
+            async with client:
+                return await asyncio.gather(
+                    *[client.get_experiment("STUDY", exp, exp)
+                      for exp in experiments],
+                    return_exceptions=True)
+        return asyncio.run(get_all())
+
+    def test_requests_run_concurrently_up_to_limit(self):
+        client = datman.xnat_async.AsyncXnat(self.xnat, concurrency=4)
+        experiments = [f"STUDY_SITE_{i:04}_01_01" for i in range(20)]
+
+        with patch.object(self.xnat, 'get_experiment',
+                          side_effect=self._get_experiment):
+            result = self._get_many(client, experiments)
+
+        assert result == experiments
+        assert self.most_active == 4
+
+    def test_failures_dont_stop_other_requests(self):
+        client = datman.xnat_async.AsyncXnat(self.xnat, concurrency=2)
+
+        with patch.object(self.xnat, 'get_experiment',
+                          side_effect=self._get_experiment):
+            result = self._get_many(client, ["GOOD", "BAD"])
+
+        assert result[0] == "GOOD"
+        assert isinstance(result[1], datman.xnat.XnatException)
+
+    def test_run_concurrently_returns_results_in_order(self):
+        calls = [("STUDY", exp, exp) for exp in ["A", "BAD", "C"]]
+
+        result = datman.xnat_async.run_concurrently(
+            self.xnat, self._get_experiment, calls, concurrency=3)
+
+        assert result[0] == "A"
+        assert isinstance(result[1], datman.xnat.XnatException)
+        assert result[2] == "C"
+
+    def test_run_concurrently_works_inside_event_loop(self):
+        calls = [("STUDY", exp, exp) for exp in ["A", "B"]]
+
+        async def run():
+            return datman.xnat_async.run_concurrently(
+                self.xnat, self._get_experiment, calls, concurrency=2)
+
+        assert asyncio.run(run()) == ["A", "B"]
+
+    def test_exiting_client_doesnt_block_event_loop(self):
+        client = datman.xnat_async.AsyncXnat(self.xnat, concurrency=1)
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.005)
+
+        async def run():
+            ticker = asyncio.ensure_future(tick())
+            async with client:
+                # Leave a request running when the client exits
+                request = asyncio.ensure_future(client.call(time.sleep, 0.1))
+                await asyncio.sleep(0)
+            ticker.cancel()
+            await request
+
+        asyncio.run(run())
+
+        assert len(ticks) > 2
+
+    def test_run_concurrently_uses_async_client(self):
+        calls = [("STUDY", exp, exp) for exp in ["A", "B"]]
+
+        async def call_many(func, calls):
+            return [func(*args) for args in calls]
+
+        with patch.object(datman.xnat_async.AsyncXnat, 'call_many',
+                          side_effect=call_many) as mock_many:
+            result = datman.xnat_async.run_concurrently(
+                self.xnat, self._get_experiment, calls)
+
+        assert result == ["A", "B"]
+        assert mock_many.call_count == 1
@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+
+from mock import patch
+
+import datman.xnat
+import datman.xnat_cache
+
+# Dont care about logging for these tests
+logging.disable(logging.CRITICAL)
+
+SERVER = "https://fakeserver.ca"
+
+
+class TestXnatCache(unittest.TestCase):
+    exper_json = {"items": [{"data_fields": {
+        "ID": "XNAT_E001", "label": "STUDY_SITE_0001_01_01"}}]}
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="xnat_cache_test_")
+        self.path = os.path.join(self.tmp, "cache.sqlite")
+        self.cache = datman.xnat_cache.XnatCache(self.path)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmp)
+
+    def _listing(self, stamp):
+        return [{"label": "STUDY_SITE_0001_01_01", "last_modified": stamp}]
+
+    def _store(self, stamp="2021-01-01 10:00:00.0"):
+        self.cache.record_listing(SERVER, "STUDY", self._listing(stamp))
+        self.cache.put(SERVER, "STUDY", "STUDY_SITE_0001_01_01",
+                       "STUDY_SITE_0001", self.exper_json)
+
+    def test_entry_not_used_if_not_seen_in_a_listing(self):
+        self._store()
+        cache = datman.xnat_cache.XnatCache(self.path)
+
+        assert cache.get(SERVER, "STUDY", "STUDY_SITE_0001_01_01") is None
+
+    def test_entry_used_when_listing_stamp_matches(self):
+        self._store()
+        cache = datman.xnat_cache.XnatCache(self.path)
+        cache.record_listing(SERVER, "STUDY",
+                             self._listing("2021-01-01 10:00:00.0"))
+
+        result = cache.get(SERVER, "STUDY", "STUDY_SITE_0001_01_01")
+
+        assert result == ("STUDY_SITE_0001", self.exper_json)
+
+    def test_entry_not_used_when_experiment_modified(self):
+        self._store()
+        self.cache.record_listing(SERVER, "STUDY",
+                                  self._listing("2022-05-05 12:00:00.0"))
+
+        assert self.cache.get(
+            SERVER, "STUDY", "STUDY_SITE_0001_01_01") is None
+
+    def test_entry_not_used_after_discard(self):
+        self._store()
+        self.cache.discard(SERVER, "STUDY", "STUDY_SITE_0001_01_01")
+
+        assert self.cache.get(
+            SERVER, "STUDY", "STUDY_SITE_0001_01_01") is None
+
+    def test_nothing_stored_without_stamp(self):
+        self.cache.put(SERVER, "STUDY", "STUDY_SITE_0001_01_01",
+                       "STUDY_SITE_0001", self.exper_json)
+        self.cache.record_listing(SERVER, "STUDY", self._listing("2021"))
+
+        assert self.cache.get(
+            SERVER, "STUDY", "STUDY_SITE_0001_01_01") is None
+
+
+class TestProjectExperimentsWithCache(unittest.TestCase):
+    listing = {
+        "ResultSet": {
+            "Result": [
+                {"ID": "XNAT_E001", "label": "STUDY_SITE_0001_01_01",
+                 "subject_label": "STUDY_SITE_0001_01_01",
+                 "last_modified": "2021-01-01 10:00:00.0"},
+                {"ID": "XNAT_E002", "label": "STUDY_SITE_0002_01_01",
+                 "subject_label": "STUDY_SITE_0002_01_01",
+                 "last_modified": "2021-01-01 10:00:00.0"}
+            ]
+        }
+    }
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="xnat_cache_test_")
+        with patch('datman.xnat.xnat.open_session'):
+            self.xnat = datman.xnat.xnat(SERVER, "user", "pass")
+        self.xnat.cache = datman.xnat_cache.XnatCache(
+            os.path.join(self.tmp, "cache.sqlite"))
+
+    def tearDown(self):
+        self.xnat.cache.close()
+        shutil.rmtree(self.tmp)
+
+    def _query(self, url, retries=3):
+        if "columns=" in url:
+            return self.listing
+        exp_id = url.split("/")[-1].split("?")[0]
+        label = exp_id.replace("XNAT_E", "STUDY_SITE_0") + "_01_01"
+        return {"items": [{"data_fields": {"ID": exp_id, "label": label}}]}
+
+    def test_unchanged_experiments_not_requested_again(self):
+        with patch.object(self.xnat, '_make_xnat_query',
+                          side_effect=self._query):
+            self.xnat.get_project_experiments("STUDY")
+
+        with patch.object(self.xnat, '_make_xnat_query',
+                          side_effect=self._query) as mock_query:
+            result = self.xnat.get_project_experiments("STUDY")
+
+        assert sorted(result) == ["STUDY_SITE_0001_01_01",
+                                  "STUDY_SITE_0002_01_01"]
+        assert result["STUDY_SITE_0002_01_01"].id == "XNAT_E002"
+        # Only the listing itself should have been requested
+        assert mock_query.call_count == 1
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+import logging
+
+import datman.xnat_stats
+
+# Dont care about logging for these tests
+logging.disable(logging.CRITICAL)
+
+SERVER = "https://fakeserver.ca"
+
+
+class TestGetEndpoint(unittest.TestCase):
+
+    def test_replaces_ids_with_wildcards(self):
+        url = (f"{SERVER}/data/archive/projects/STUDY/subjects/"
+               "STUDY_SITE_0001_01/experiments/STUDY_SITE_0001_01_01"
+               "?format=json")
+
+        result = datman.xnat_stats.get_endpoint(url)
+
+        assert result == "projects/*/subjects/*/experiments/*"
+
+    def test_file_names_become_one_wildcard(self):
+        url = (f"{SERVER}/REST/experiments/XNAT_E001/resources/123/files/"
+               "behav/task/run1.csv")
+
+        result = datman.xnat_stats.get_endpoint(url)
+
+        assert result == "experiments/*/resources/*/files/*"
+
+    def test_keeps_collection_listings(self):
+        url = f"{SERVER}/data/projects/STUDY/experiments/?format=json"
+
+        result = datman.xnat_stats.get_endpoint(url)
+
+        assert result == "projects/*/experiments"
+
+
+class TestRequestStats(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="xnat_stats_test_")
+        self.log = os.path.join(self.tmp, "requests.jsonl")
+        self.stats = datman.xnat_stats.RequestStats(log_file=self.log)
+        for elapsed in range(1, 21):
+            self.stats.record("GET", f"{SERVER}/data/experiments/E{elapsed}",
+                              200, received=100, elapsed=elapsed / 10)
+        self.stats.record("PUT", f"{SERVER}/data/workflows/123", None,
+                          elapsed=0.5, retries=2, error="ConnectionError")
+
+    def tearDown(self):
+        self.stats.close()
+        shutil.rmtree(self.tmp)
+
+    def test_summarizes_by_method_and_endpoint(self):
+        summary = {item["endpoint"]: item for item in self.stats.summarize()}
+
+        experiments = summary["experiments/*"]
+        assert experiments["count"] == 20
+        assert experiments["p50"] == 1.0
+        assert experiments["p95"] == 1.9
+        assert experiments["received"] == 2000
+        assert summary["workflows/*"]["failed"] == 1
+        assert summary["workflows/*"]["retries"] == 2
+
+    def test_log_can_be_read_back(self):
+        records = datman.xnat_stats.read_log(self.log)
+
+        assert records == self.stats.records
+
+    def test_report_lists_each_endpoint(self):
+        report = self.stats.report()
+
+        assert report.startswith("21 XNAT requests")
+        assert "experiments/*" in report
+        assert "workflows/*" in report